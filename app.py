@@ -1,9 +1,25 @@
 import os
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import inspect
 import json
+import logging
+import queue
+import random
 import re
+import socket
+import sqlite3
+import sys
 import threading
 import time
-from datetime import datetime, timedelta
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime
 from typing import List, Tuple, Optional
 
 try:
@@ -13,6 +29,7 @@ except ImportError:
 
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_sdk.errors import SlackApiError
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -21,12 +38,68 @@ import certifi
 os.environ.setdefault("SSL_CERT_FILE", certifi.where())
 os.environ.setdefault("REQUESTS_CA_BUNDLE", certifi.where())
 
-# デバッグモード
-DEBUG = os.environ.get("DEBUG", "1") == "1"
+# ========== ログ ==========
+# LOG_LEVEL 以上を標準出力に出す（DEBUG=1 は LOG_LEVEL=DEBUG と同じ）
+# それとは別に LOG_BUFFER_LEVEL 以上の直近 LOG_BUFFER_SIZE 件をメモリに残し、管理者が /logs で見られる
+# メッセージは log.debug("... %s", value) の形で渡し、どこにも出さないものは組み立てない
 
-def debug_log(msg):
-    if DEBUG:
-        print(f"[DEBUG] {msg}")
+def log_level(name):
+    """"INFO" などのレベル名を数値にする"""
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError(f"unknown log level: {name}")
+    return level
+
+LOG_LEVEL = log_level(os.environ.get("LOG_LEVEL", "DEBUG" if os.environ.get("DEBUG") == "1" else "INFO"))
+# DEBUG にするとロガーもDEBUGになり、パーサーなどの log.debug がどこにも出さなくてもレコードを作るので、デフォルトは INFO
+LOG_BUFFER_LEVEL = log_level(os.environ.get("LOG_BUFFER_LEVEL", "INFO"))
+LOG_BUFFER_SIZE = int(os.environ.get("LOG_BUFFER_SIZE", "1000"))  # 0ならメモリに残さない
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+class RingBufferHandler(logging.Handler):
+    """直近 capacity 件のログレコードを持つ（メッセージは dump() するまで組み立てない）"""
+
+    def __init__(self, capacity=LOG_BUFFER_SIZE, level=LOG_BUFFER_LEVEL):
+        super().__init__(level)
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        # 例外はトレースバック（フレーム）を抱えたまま残さないよう、ここで文字列にする
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if isinstance(record.args, tuple) and any(isinstance(arg, BaseException) for arg in record.args):
+            record.args = tuple(str(arg) if isinstance(arg, BaseException) else arg for arg in record.args)
+        self.records.append(record)
+
+    def dump(self, limit=None, level=logging.NOTSET):
+        """level 以上の直近 limit 件を、古い順に組み立てた行のリストで返す"""
+        records = [record for record in list(self.records) if record.levelno >= level]
+        if limit:
+            records = records[-limit:]
+        return [self.format(record) for record in records]
+
+class LazyDates:
+    """ログ用: 日付のリストを、出力するときに初めて "YYYY-MM-DD" のリストにする"""
+    __slots__ = ("dates",)
+
+    def __init__(self, dates):
+        self.dates = dates
+
+    def __str__(self):
+        return str([d.strftime("%Y-%m-%d") for d in self.dates])
+
+log = logging.getLogger("presence")
+log.propagate = False
+log_buffer = RingBufferHandler()
+log_buffer.setFormatter(logging.Formatter(LOG_FORMAT))
+log_console = logging.StreamHandler(sys.stdout)
+log_console.setLevel(LOG_LEVEL)
+log_console.setFormatter(logging.Formatter(LOG_FORMAT))
+log.addHandler(log_console)
+if LOG_BUFFER_SIZE > 0:
+    log.addHandler(log_buffer)
+log.setLevel(min(LOG_LEVEL, LOG_BUFFER_LEVEL) if LOG_BUFFER_SIZE > 0 else LOG_LEVEL)
 
 ADMIN_USERS = set(
     uid for uid in os.environ.get("ADMIN_USERS", "").split(",") if uid
@@ -37,35 +110,1483 @@ def is_admin(user_id):
 
 TZ = ZoneInfo("Asia/Tokyo")
 DATA_FILE = "state.json"
+JOURNAL_FILE = "state.journal"
+DELETE_JOB_FILE = "delete_job.json"  # /delete の進捗（ページごとに書くので state とは別のファイル）
+
+# ジャーナルモード: 変更を1行ずつ追記し、一定件数ごとにstate.jsonへ畳み込む
+JOURNAL_MODE = os.environ.get("JOURNAL_MODE", "0") == "1"
+JOURNAL_COMPACT_EVERY = int(os.environ.get("JOURNAL_COMPACT_EVERY", "200"))
+
+# ストレージバックエンド: "json"（state.json）または "sqlite"（state.db, WALモード）
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_FILE = "state.db"
+
+# 複数プロセス: 同じ state.db を共有するボットを複数動かす（SQLiteバックエンドが必要）
+# 0時の処理・ボードの更新・中断した /delete の再開は、リースを持つリーダーの1プロセスだけが行う
+MULTI_PROCESS = os.environ.get("MULTI_PROCESS", "0") == "1"
+LEADER_FILE = "leader.db"
+LEASE_TTL = float(os.environ.get("LEASE_TTL", "15"))  # リーダーのリースの有効期間・秒
+if MULTI_PROCESS and STORAGE_BACKEND != "sqlite":
+    log.warning("[main] MULTI_PROCESS=1 requires the SQLite backend, using STORAGE_BACKEND=sqlite")
+    STORAGE_BACKEND = "sqlite"
+
+# ========== メトリクス ==========
+# コマンドの ack までの時間・保存・描画・Slack API 呼び出しの所要時間のヒストグラムと、ボード更新などの回数
+# METRICS_PORT を設定すると http://METRICS_HOST:METRICS_PORT/metrics でPrometheusのテキスト形式で公開する
+# 管理者は /stats で p50 / p99 と各コンポーネントの stats() を見られる
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # 0なら公開しない
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PREFIX = "presence_"
+
+# ヒストグラムのバケットの上端（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """バケットごとの件数・合計・最大値（分位数はバケットの中を線形補間して推定する）"""
+
+    __slots__ = ("bounds", "counts", "total", "count", "max")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は上限なし（+Inf）
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.bounds, self.counts):
+            if n and seen + n >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / n, self.max)
+            seen += n
+            lower = bound
+        return self.max
+
+class Metrics:
+    """
+    ラベル付きのカウンターとヒストグラム
+    - count(name, amount, **labels) / observe(name, seconds, **labels) / timer(name, **labels)
+    - register(name, stats) で各コンポーネントの stats() をゲージとして一緒に公開する
+    """
+
+    def __init__(self):
+        self._counters = {}  # (name, ((label, value), ...)) -> 回数
+        self._histograms = {}  # (name, ((label, value), ...)) -> Histogram
+        self._collectors = {}  # name -> (stats を返す関数, ラベル名)
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """関数（asyncも可）の所要時間を name{function=関数名} に記録するデコレーター"""
+        def decorator(func):
+            func_labels = dict(labels, function=func.__name__)
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name, **func_labels):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **func_labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register(self, name, stats, label=None):
+        """
+        stats() の数値をゲージ name_<キー> として公開する
+        labelを渡した場合、stats() は {ラベルの値: {キー: 数値}} を返し、ゲージにラベル label=ラベルの値 を付ける
+        """
+        self._collectors[name] = (stats, label)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def summary(self):
+        """{(name, labels): {"count", "p50_ms", "p99_ms", "max_ms"}}（/stats 用）"""
+        with self._lock:
+            return {
+                key: {
+                    "count": h.count,
+                    "p50_ms": h.quantile(0.5) * 1000,
+                    "p99_ms": h.quantile(0.99) * 1000,
+                    "max_ms": h.max * 1000,
+                }
+                for key, h in self._histograms.items()
+            }
+
+    def gauges(self):
+        """登録したコンポーネントの stats() を [(name, labels, value)] にする"""
+        result = []
+        for name, (stats, label) in list(self._collectors.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                log.warning("[Metrics] Failed to collect %s: %s", name, e)
+                continue
+            groups = values.items() if label else [(None, values)]
+            for label_value, group in groups:
+                labels = ((label, str(label_value)),) if label else ()
+                for key, value in group.items():
+                    if isinstance(value, (int, float)):
+                        result.append((f"{name}_{key}", labels, value))
+        return result
+
+    def prometheus(self):
+        """Prometheusのテキスト形式"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.total, h.count, h.bounds)) for key, h in self._histograms.items()
+            )
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            metric = METRICS_PREFIX + name
+            declare(metric, "counter")
+            lines.append(f"{metric}{prometheus_labels(labels)} {value}")
+        for (name, labels), (counts, total, count, bounds) in histograms:
+            metric = METRICS_PREFIX + name
+            declare(metric, "histogram")
+            cumulative = 0
+            for bound, n in zip(bounds + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{metric}_sum{prometheus_labels(labels)} {total}")
+            lines.append(f"{metric}_count{prometheus_labels(labels)} {count}")
+        for name, labels, value in sorted(self.gauges()):
+            metric = METRICS_PREFIX + name
+            declare(metric, "gauge")
+            lines.append(f"{metric}{prometheus_labels(labels)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+def prometheus_labels(labels):
+    """(("command", "/in"), ...) → {command="/in",...}"""
+    if not labels:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+metrics = Metrics()
+
+def serve_metrics(port=METRICS_PORT, host=METRICS_HOST):
+    """/metrics を返すHTTPサーバーをバックグラウンドスレッドで開始する"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug("[metrics] " + format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# ========== テナント ==========
+# MULTI_TENANT=1 のとき、ワークスペース（team_id）×チャンネルごとに state・保存先・ボードを分ける
+# tenants/<team_id>/<channel_id>/ に state.json（state.journal, state.db）を置き、最初に使うときに読み込む
+# ボードのないチャンネルのstateは読み込まず保存もしない。TENANT_IDLE_TTL 秒コマンドのないテナントはメモリから外す
+# 単一ボード（デフォルト）ではカレントディレクトリの state.json を使う1つのテナントだけがある
+
+MULTI_TENANT = os.environ.get("MULTI_TENANT", "0") == "1"
+TENANTS_DIR = os.environ.get("TENANTS_DIR", "tenants")
+TENANT_IDLE_TTL = float(os.environ.get("TENANT_IDLE_TTL", "3600"))  # 0ならメモリから外さない
+
+_current_tenant = contextvars.ContextVar("tenant")
+
+class Tenant:
+    """
+    1つのボードの state（StateManager）・保存先・ボードパブリッシャー・描画キャッシュ・削除ジョブ
+    state は store に最初に触れたときに読み込む
+    """
+
+    def __init__(self, key=None, directory=None):
+        self.key = key  # (team_id, channel_id)、単一ボードではNone
+        self.directory = directory  # 保存先（Noneならカレントディレクトリ）
+        self.journal = {"seq": 0, "pending": 0}
+        self.journal_lock = threading.RLock()
+        self.publisher = None
+        self.deletion = None  # 実行中の /delete のスレッド
+        self.last_used = 0.0  # 最後にコマンドを受けた time.monotonic()
+        self._render_cache = None
+        self._store = None
+        self._lock = threading.RLock()
 
-def load_state():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
+    def __repr__(self):
+        return f"Tenant({self.key!r})"
+
+    @property
+    def label(self):
+        """メトリクスのラベル（team_id/channel_id、単一ボードでは default）"""
+        return "/".join(self.key) if self.key else "default"
+
+    def path(self, name):
+        return os.path.join(self.directory, name) if self.directory else name
+
+    def prepare(self):
+        """保存先のディレクトリを作る（書き込む前に呼ぶ）"""
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def loaded(self):
+        return self._store is not None
+
+    @property
+    def persisted(self):
+        """保存先があるか（まだ何も保存していないチャンネルならFalse）"""
+        return self.directory is None or os.path.isdir(self.directory)
+
+    def has_board(self):
+        """ボードがあるか（保存先のないテナントは読み込まずにFalse）"""
+        if not self.loaded and not self.persisted:
+            return False
+        return bool(self.store.snapshot().board_message["channel"])
+
+    def idle(self, max_idle):
+        """メモリから外してよいか（max_idle 秒コマンドがなく、ボードの更新待ちも /delete もない）"""
+        if self.key is None or time.monotonic() - self.last_used < max_idle:
+            return False
+        if self.deletion is not None and self.deletion.is_alive():
+            return False
+        return self.publisher is None or self.publisher.idle
+
+    def close(self):
+        """メモリから外す（パブリッシャーを止める）"""
+        if self.publisher is not None:
+            self.publisher.stop()
+
+    @property
+    def store(self):
+        if self._store is None:
+            with self._lock, self.active():
+                if self._store is None:
+                    log.info("[Tenant] Loading %s state", self.key or 'default')
+                    self._store = StateManager(load_state(app.client))
+                    if tenants.on_load is not None:
+                        tenants.on_load(self)
+        return self._store
+
+    @property
+    def render_cache(self):
+        if self._render_cache is None:
+            self._render_cache = RenderCache()
+        return self._render_cache
+
+    @contextlib.contextmanager
+    def active(self):
+        """このブロックの中（と、そこから積んだジョブ）を、このテナントに対する処理にする"""
+        token = _current_tenant.set(self)
+        try:
+            yield self
+        finally:
+            _current_tenant.reset(token)
+
+    def board_publisher(self):
+        """このテナントのボードパブリッシャー（パブリッシャーを動かしていなければNone）"""
+        if self.publisher is None and tenants.publisher_factory is not None:
+            with self._lock:
+                if self.publisher is None:
+                    self.publisher = tenants.publisher_factory(self)
+        return self.publisher
+
+class TenantRegistry:
+    """(team_id, channel_id) → Tenant"""
+
+    def __init__(self):
+        self.default = Tenant()
+        self.publisher_factory = None  # Tenant → 開始済みのパブリッシャー（main で設定する）
+        self.on_load = None  # テナントのstateを読み込んだ直後に呼ぶ（中断した /delete の再開）
+        self._tenants = {}
+        self._lock = threading.Lock()
+
+    def get(self, team_id, channel_id):
+        key = (team_id or "_", channel_id)
+        with self._lock:
+            tenant = self._tenants.get(key)
+            if tenant is None:
+                tenant = self._tenants[key] = Tenant(key, os.path.join(TENANTS_DIR, *key))
+            return tenant
+
+    def for_body(self, body):
+        """リクエストのワークスペース・チャンネルのテナント（単一ボードでは常に同じ）"""
+        if not MULTI_TENANT:
+            return self.default
+        tenant = self.get(body.get("team_id"), body["channel_id"])
+        tenant.last_used = time.monotonic()
+        return tenant
+
+    def all(self):
+        """保存済みのものを含む全てのテナント（日付の変わり目など全ボードに対する処理用）"""
+        if not MULTI_TENANT:
+            return [self.default]
+        if os.path.isdir(TENANTS_DIR):
+            for team_id in sorted(os.listdir(TENANTS_DIR)):
+                team_dir = os.path.join(TENANTS_DIR, team_id)
+                if os.path.isdir(team_dir):
+                    for channel_id in sorted(os.listdir(team_dir)):
+                        if os.path.isdir(os.path.join(team_dir, channel_id)):
+                            self.get(team_id, channel_id)
+        with self._lock:
+            return list(self._tenants.values())
+
+    def by_label(self, label):
+        """Tenant.label（"default" か team_id/channel_id）のテナント"""
+        if label == "default":
+            return self.default
+        return self.get(*label.split("/", 1))
+
+    def loaded(self):
+        with self._lock:
+            tenants = [self.default] + list(self._tenants.values())
+        return [tenant for tenant in tenants if tenant.loaded]
+
+    def evict_idle(self, max_idle=TENANT_IDLE_TTL):
+        """しばらく使われていないテナントをメモリから外し、外した数を返す（次に使うときに読み込み直す）"""
+        if max_idle <= 0:
+            return 0
+        with self._lock:
+            evicted = [tenant for tenant in self._tenants.values() if tenant.idle(max_idle)]
+            for tenant in evicted:
+                del self._tenants[tenant.key]
+        for tenant in evicted:
+            tenant.close()
+            log.info("[TenantRegistry] Evicted idle %s", tenant)
+        return len(evicted)
+
+tenants = TenantRegistry()
+
+def current_tenant():
+    """今処理しているテナント（ハンドラー・ジョブ・パブリッシャーの外では単一ボードのテナント）"""
+    return _current_tenant.get(tenants.default)
+
+def command_handler(func):
+    """
+    コマンドのハンドラーを、リクエストのワークスペース・チャンネルのテナントに対して実行する
+    ハンドラーの開始から ack までの時間を command_ack_seconds{command} に、例外を command_errors_total に記録する
+    """
+    signature = inspect.signature(func)
+    is_async = asyncio.iscoroutinefunction(func)
+
+    def prepare(args, kwargs):
+        bound = signature.bind_partial(*args, **kwargs)
+        body = bound.arguments["body"]
+        command = body.get("command") or func.__name__
+        ack = bound.arguments.get("ack")
+        started = time.perf_counter()
+
+        def acked():
+            metrics.observe("command_ack_seconds", time.perf_counter() - started, command=command)
+
+        if ack is not None:
+            if is_async:
+                async def timed_ack(*ack_args, **ack_kwargs):
+                    try:
+                        return await ack(*ack_args, **ack_kwargs)
+                    finally:
+                        acked()
+            else:
+                def timed_ack(*ack_args, **ack_kwargs):
+                    try:
+                        return ack(*ack_args, **ack_kwargs)
+                    finally:
+                        acked()
+            bound.arguments["ack"] = timed_ack
+        metrics.count("commands_total", command=command)
+        return tenants.for_body(body), command, bound.args, bound.kwargs
+
+    if is_async:
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            tenant, command, args, kwargs = prepare(args, kwargs)
+            with tenant.active():
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    metrics.count("command_errors_total", command=command)
+                    raise
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tenant, command, args, kwargs = prepare(args, kwargs)
+        with tenant.active():
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                metrics.count("command_errors_total", command=command)
+                raise
+    return wrapper
+
+class CurrentStore:
+    """今のテナントの StateManager（store.commit(...) などはそのテナントに対して行われる）"""
+
+    def __getattr__(self, name):
+        return getattr(current_tenant().store, name)
+
+store = CurrentStore()
+
+NO_BOARD_MESSAGE = "⚠️ このチャンネルにはまだ在室ボードがありません（管理者が /setup で作成できます）"
+
+def board_missing():
+    """MULTI_TENANT=1 で今のチャンネルにまだボードがないか（ボードのないチャンネルでは予定を読み書きしない）"""
+    return MULTI_TENANT and not current_tenant().has_board()
+
+def load_state(client=None):
+    if STORAGE_BACKEND == "sqlite":
+        data = load_sqlite_state()
+    else:
+        data = load_json_state()
+    # 表示名をキーにしていた頃のschedulesを user_id キーへ移行
+    if data.get("key_format") != "user_id":
+        try:
+            migrate_schedule_keys(data, client)
+        except StaleStateError:
+            # 同時に起動した別のプロセスが先に書き込んだので、読み直す
+            return load_state(client)
+    return data
+
+def load_json_state():
+    data = None
+    migrated = False
+    data_file = current_tenant().path(DATA_FILE)
+    if os.path.exists(data_file):
+        with open(data_file, "r", encoding="utf-8") as f:
             data = json.load(f)
-            # 古いフォーマットから新しいフォーマットへ移行
-            if "board" in data and "schedules" not in data:
-                debug_log("Migrating old board format to schedules format")
-                schedules = {}
-                today = today_key()
-                for user, info in data["board"].items():
-                    if info.get("status"):
-                        schedules[user] = {today: {"status": info["status"], "note": info.get("note", "")}}
-                data["schedules"] = schedules
-                del data["board"]
-                save_state(data)
-            return data
-    return {"schedules": {}, "board_message": {"channel": None, "ts": None}}
+        # 古いフォーマットから新しいフォーマットへ移行
+        if "board" in data and "schedules" not in data:
+            log.info("Migrating old board format to schedules format")
+            schedules = {}
+            today = today_key()
+            for user, info in data["board"].items():
+                if info.get("status"):
+                    schedules[user] = {today: {"status": info["status"], "note": info.get("note", "")}}
+            data["schedules"] = schedules
+            del data["board"]
+            migrated = True
+    if data is None:
+        data = {"schedules": {}, "board_message": {"channel": None, "ts": None}, "key_format": "user_id"}
+    if "entry_table" in data:
+        data["schedules"] = unpack_schedules(data.pop("entry_table"), data["schedules"])
+    data["schedules"] = Schedules(data["schedules"])
+
+    replayed = replay_journal(data) if JOURNAL_MODE else 0
+    if migrated or replayed:
+        # 移行・リプレイした内容をスナップショットに畳み込む
+        save_state(data)
+    return data
 
+@metrics.timed("persist_seconds")
 def save_state(state):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    """stateをスナップショットとして保存（ジャーナルモードではログも畳み込む）"""
+    if isinstance(state["schedules"], SqliteSchedules):
+        # schedulesは変更のたびにDBへ書き込み済みなので、それ以外のキーだけ保存
+        state["schedules"].save_meta({k: v for k, v in state.items() if k != "schedules"})
+        return
+
+    tenant = current_tenant()
+    tenant.prepare()
+    with tenant.journal_lock:
+        if JOURNAL_MODE:
+            state["journal_seq"] = tenant.journal["seq"]
+
+        write_json_atomic(tenant.path(DATA_FILE), pack_state(state), indent=2)
+
+        if JOURNAL_MODE:
+            open(tenant.path(JOURNAL_FILE), "w", encoding="utf-8").close()
+            tenant.journal["pending"] = 0
+
+def write_json_atomic(path, obj, indent=None):
+    """書き込み途中でクラッシュしても壊れないよう、一時ファイルに書いてから置き換える"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def pack_state(state):
+    """
+    保存用のstate: 同じ内容のエントリは entry_table に1度だけ [status, note] で書き、
+    schedules の各日付には entry_table の番号を書く
+    """
+    index = {}
+    table = []
+    schedules = {}
+    for user, user_schedule in state["schedules"].items():
+        packed = {}
+        for date_key, info in user_schedule.items():
+            key = (info.get("status", ""), info.get("note", ""))
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(table)
+                table.append(list(key))
+            packed[date_key] = i
+        schedules[user] = packed
+    data = {k: v for k, v in state.items() if k != "schedules"}
+    data["entry_table"] = table
+    data["schedules"] = schedules
+    return data
+
+def unpack_schedules(table, schedules):
+    """pack_state の形式の schedules を Entry の辞書に戻す"""
+    entries = [Entry.of(status, note) for status, note in table]
+    return {
+        user: {date_key: entries[i] for date_key, i in user_schedule.items()}
+        for user, user_schedule in schedules.items()
+    }
+
+@metrics.timed("persist_seconds")
+def append_journal(record):
+    """変更レコードをジャーナルに1行追記し、必要ならコンパクションする"""
+    tenant = current_tenant()
+    tenant.prepare()
+    journal = tenant.journal
+    with tenant.journal_lock:
+        journal["seq"] += 1
+        line = json.dumps(dict(record, seq=journal["seq"]), ensure_ascii=False, separators=(",", ":"))
+        with open(tenant.path(JOURNAL_FILE), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        journal["pending"] += 1
+        if journal["pending"] >= JOURNAL_COMPACT_EVERY:
+            log.info("[append_journal] Compacting after %s records", journal['pending'])
+            save_state(tenant.store.state)
+
+def replay_journal(data):
+    """スナップショット以降のジャーナルをdataに適用し、適用件数を返す"""
+    journal = current_tenant().journal
+    journal_file = current_tenant().path(JOURNAL_FILE)
+    snapshot_seq = data.get("journal_seq", 0)
+    journal["seq"] = snapshot_seq
+    if not os.path.exists(journal_file):
+        return 0
+
+    replayed = 0
+    good_end = 0  # 最後に読めたレコードの終わりのバイト位置
+    with open(journal_file, "r+b") as f:
+        for line_no, raw in enumerate(f, 1):
+            line = raw.strip()
+            if line:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 追記途中でクラッシュした末尾行は捨てる（残すと次の追記がその行につながって読めなくなる）
+                    log.warning("[replay_journal] Truncating torn record at line %s", line_no)
+                    f.truncate(good_end)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    break
+                if record.get("seq", 0) > snapshot_seq:
+                    apply_record(data["schedules"], record)
+                    journal["seq"] = record["seq"]
+                    replayed += 1
+            good_end += len(raw)
+        else:
+            if good_end and not raw.endswith(b"\n"):
+                # 改行を書く前に止まった行は読めたので、改行を足して次の追記と分ける
+                f.write(b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    log.info("[replay_journal] Replayed %s record(s) after seq=%s", replayed, snapshot_seq)
+    return replayed
+
+def apply_record(schedules, record):
+    """
+    変更レコードをschedulesに適用し、変更した件数を返す
+    record["op"]: "set"（ステータス設定）, "note"（note更新）, "clear"（削除）, "expire"（過去日付の削除）,
+                  "rename"（キーの付け替え）
+    """
+    return schedules.apply(record)
+
+def commit_record(record):
+    """変更レコードをstateに適用して永続化し、変更した件数を返す"""
+    return store.commit(record)
+
+# matrix は STATUS_MATRIX=1 のときの StatusMatrix（無効ならNone）
+Snapshot = namedtuple("Snapshot", ["version", "schedules", "board_message", "matrix"])
+
+# 他のプロセスとの書き込みの競合（StaleStateError）を読み直してやり直す回数
+STALE_RETRIES = 5
+
+class StateManager:
+    """
+    stateへの唯一の書き込み口
+    - 書き込みはロックで1本に直列化し、変更ごとにバージョン付きのスナップショットを公開する
+    - 公開したスナップショットは以後変更されないので、読み手（レンダラー、/lab、sync_board.py）は
+      snapshot() で取得したものをロックなしで参照できる
+    - MULTI_PROCESS=1 では snapshot() のたびに他のプロセスの書き込みを確かめて取り込む
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._lock = threading.RLock()
+        self.foreign_changes = 0  # refresh() で取り込んだ他のプロセスの書き込みの回数
+        state["schedules"].freeze()
+        matrix = StatusMatrix.build(state["schedules"], today_ordinal()) if STATUS_MATRIX else None
+        self._snapshot = Snapshot(0, state["schedules"], dict(state["board_message"]), matrix)
+
+    def snapshot(self):
+        """最新のスナップショットを返す"""
+        if MULTI_PROCESS:
+            self.refresh()
+        return self._snapshot
+
+    def refresh(self):
+        """他のプロセスが state.db に書き込んでいたら読み直して新しいスナップショットを公開し、Trueを返す"""
+        schedules = self.state["schedules"]
+        if not isinstance(schedules, SqliteSchedules) or schedules.latest_revision() == schedules.revision:
+            return False
+        with self._lock:
+            if schedules.latest_revision() == schedules.revision:
+                return False
+            data_revision = schedules.data_revision
+            meta = schedules.load_meta() or {}
+            self.state.clear()
+            self.state.update(meta, schedules=schedules)
+            self.state.setdefault("board_message", {"channel": None, "ts": None})
+            if schedules.data_revision == data_revision:
+                # 予定は変わっていない（board_message などだけ）ので行列もボードもそのまま
+                self._publish()
+                return True
+            # どのユーザーの行が変わったか分からないので行列は作り直す
+            matrix = StatusMatrix.build(schedules, today_ordinal()) if STATUS_MATRIX else None
+            self._publish(matrix)
+            self.foreign_changes += 1
+            log.debug("[StateManager] Reloaded revision %s written by another process", schedules.revision)
+            return True
+
+    def _retrying(self, func):
+        """func() が他のプロセスと競合したら、読み直してやり直す"""
+        for attempt in range(STALE_RETRIES):
+            try:
+                return func()
+            except StaleStateError as e:
+                log.debug("[StateManager] %s, reloading (attempt %s)", e, attempt + 1)
+                self.refresh()
+        return func()
+
+    def commit(self, record):
+        """変更レコードを適用・永続化して新しいスナップショットを公開し、変更件数を返す"""
+        with self._lock:
+            current = self._snapshot.schedules
+            draft = current.evolve()
+            changed = self._retrying(lambda: apply_record(draft, record))
+            if not changed:
+                return 0
+
+            self.state["schedules"] = draft
+            try:
+                if not isinstance(draft, SqliteSchedules):
+                    if JOURNAL_MODE:
+                        append_journal(record)
+                    else:
+                        save_state(self.state)
+            except Exception:
+                self.state["schedules"] = current
+                raise
+            draft.freeze()
+            matrix = self._snapshot.matrix
+            if matrix is not None:
+                matrix = matrix.rolled(draft, today_ordinal()).updated(draft, records_users(record))
+            self._publish(matrix)
+            return changed
+
+    def set_board_message(self, channel, ts, shards=None):
+        """ボードのメッセージを記録する（shardsはシャード分割したときのメッセージ一覧、tsはその先頭）"""
+        board_message = {"channel": channel, "ts": ts}
+        if shards:
+            board_message["shards"] = shards
+
+        def save():
+            self.state["board_message"] = dict(board_message)
+            save_state(self.state)
+
+        with self._lock:
+            self._retrying(save)
+            self._publish()
+
+    def delete_job(self):
+        """実行中の /delete の進捗（なければNone）"""
+        try:
+            with open(current_tenant().path(DELETE_JOB_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # 以前のバージョンは state["delete_job"] に保存していた
+            job = self.state.get("delete_job")
+            return dict(job) if job else None
+
+    def set_delete_job(self, job):
+        """/delete の進捗を delete_job.json に保存する（Noneで削除、state.json は書き直さない）"""
+        tenant = current_tenant()
+        path = tenant.path(DELETE_JOB_FILE)
+
+        def save():
+            self.state.pop("delete_job", None)
+            save_state(self.state)
+
+        with self._lock:
+            if "delete_job" in self.state:
+                self._retrying(save)
+            if job is None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                return
+            tenant.prepare()
+            write_json_atomic(path, job)
+
+    def roll_matrix(self):
+        """日付が変わったらステータス行列の窓をずらす"""
+        with self._lock:
+            matrix = self._snapshot.matrix
+            if matrix is not None and matrix.base != today_ordinal():
+                self._publish(matrix.rolled(self.state["schedules"], today_ordinal()))
+
+    def _publish(self, matrix=None):
+        self._snapshot = Snapshot(
+            self._snapshot.version + 1,
+            self.state["schedules"],
+            dict(self.state["board_message"]),
+            matrix if matrix is not None else self._snapshot.matrix,
+        )
+
+def reading(schedules):
+    """描画の読み出しを1つの読み取りトランザクションにまとめる（SQLite以外は何もしない）"""
+    if isinstance(schedules, SqliteSchedules):
+        return schedules.reading()
+    return contextlib.nullcontext()
+
+def entries_on(schedules, date_key):
+    """指定日に登録があるユーザーのエントリ {user: entry} を返す"""
+    if isinstance(schedules, (Schedules, SqliteSchedules)):
+        return schedules.entries_on(date_key)
+    return {user: s[date_key] for user, s in schedules.items() if date_key in s}
+
+def entries_between(schedules, start_key, end_key):
+    """期間内（両端含む）に登録があるユーザーのエントリ {user: {date_key: entry}} を返す"""
+    if isinstance(schedules, (Schedules, SqliteSchedules)):
+        return schedules.entries_between(start_key, end_key)
+    result = {}
+    for user, user_schedule in schedules.items():
+        window = {k: v for k, v in user_schedule.items() if start_key <= k <= end_key}
+        if window:
+            result[user] = window
+    return result
+
+def user_entries(schedules, user, start_key=None, end_key=None):
+    """1ユーザーの期間内（両端含む、Noneなら上限・下限なし）のエントリを日付順の [(date_key, entry)] で返す"""
+    if isinstance(schedules, (Schedules, SqliteSchedules)):
+        return schedules.user_entries(user, start_key, end_key)
+    return sorted(
+        (k, v) for k, v in schedules.get(user, {}).items()
+        if (start_key is None or start_key <= k) and (end_key is None or k <= end_key)
+    )
+
+# ========== メモリ上のschedules ==========
+
+class Entry:
+    """
+    1日分の登録（ステータスとnote）
+    変更できない値オブジェクトで、Entry.of() は同じ内容なら同じインスタンスを返す
+    （/trip jan "出張" の31日分が1つのEntryを共有する）。{"status", "note"} の辞書と同じように読める
+    """
+
+    __slots__ = ("status", "note", "__weakref__")
+
+    _pool = weakref.WeakValueDictionary()
+    _pool_lock = threading.Lock()
+
+    def __init__(self, status="", note=""):
+        object.__setattr__(self, "status", status)
+        object.__setattr__(self, "note", note)
+
+    @classmethod
+    def of(cls, status="", note=""):
+        key = (status, note)
+        entry = cls._pool.get(key)
+        if entry is None:
+            with cls._pool_lock:
+                entry = cls._pool.get(key)
+                if entry is None:
+                    entry = cls(sys.intern(status) if type(status) is str else status, note)
+                    cls._pool[key] = entry
+        return entry
+
+    @classmethod
+    def from_info(cls, info):
+        """辞書（古いstate.json・SQLiteの行）またはEntryからEntryを返す"""
+        if isinstance(info, Entry):
+            return info
+        return cls.of(info.get("status", ""), info.get("note", ""))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Entry is immutable")
+
+    def __reduce__(self):
+        # copy / pickle しても共有のインスタンスに戻す
+        return (Entry.of, (self.status, self.note))
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in ("status", "note") else default
+
+    def __getitem__(self, key):
+        if key in ("status", "note"):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ("status", "note")
+
+    def to_dict(self):
+        return {"status": self.status, "note": self.note}
+
+    def __eq__(self, other):
+        if isinstance(other, Entry):
+            return self.status == other.status and self.note == other.note
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.status, self.note))
+
+    def __repr__(self):
+        return f"Entry({self.status!r}, {self.note!r})"
+
+class Timeline(dict):
+    """
+    日付キーの昇順を保つ辞書（1ユーザーの予定 {date_key: Entry}、by_date {date_key: {user: Entry}}）
+    キーは order に昇順で並べて持ち、期間の取り出し・削除は bisect で範囲を求めてスライスで行う
+    dict の変更メソッド（pop / update / setdefault / clear / popitem / |=）も order を保つ
+    """
+
+    __slots__ = ("order",)
+
+    def __init__(self, data=()):
+        super().__init__(data)
+        self.order = sorted(self)
+
+    def copy(self):
+        timeline = Timeline.__new__(Timeline)
+        dict.__init__(timeline, self)
+        timeline.order = list(self.order)
+        return timeline
+
+    def __reduce__(self):
+        return (Timeline, (dict(self),))
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            bisect.insort(self.order, key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        del self.order[bisect.bisect_left(self.order, key)]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.pop(self, key)
+        del self.order[bisect.bisect_left(self.order, key)]
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        del self.order[bisect.bisect_left(self.order, key)]
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        dict.clear(self)
+        self.order.clear()
+
+    def _bounds(self, start_key, end_key):
+        lo = 0 if start_key is None else bisect.bisect_left(self.order, start_key)
+        hi = len(self.order) if end_key is None else bisect.bisect_right(self.order, end_key)
+        return lo, max(lo, hi)
+
+    def keys_between(self, start_key=None, end_key=None):
+        """期間内（両端含む、Noneなら上限・下限なし）のキーを昇順で返す"""
+        lo, hi = self._bounds(start_key, end_key)
+        return self.order[lo:hi]
+
+    def _pop_slice(self, lo, hi):
+        keys = self.order[lo:hi]
+        del self.order[lo:hi]
+        return [(key, dict.pop(self, key)) for key in keys]
+
+    def pop_between(self, start_key=None, end_key=None):
+        """期間内（両端含む）をまとめて削除し、[(key, value)] を返す"""
+        return self._pop_slice(*self._bounds(start_key, end_key))
+
+    def pop_before(self, key):
+        """keyより前をまとめて削除し、[(key, value)] を返す"""
+        return self._pop_slice(0, bisect.bisect_left(self.order, key))
+
+class Schedules(dict):
+    """
+    メモリ上のschedules {user: Timeline{date_key: Entry}}
+    日付→ユーザーの逆引きインデックス by_date Timeline{date_key: {user: entry}} を常に同期して持つ
+
+    公開済みのスナップショットは freeze() されて変更できない。
+    変更は evolve() で作った下書きに対して行い、下書きは変更するユーザー・日付の辞書だけを
+    複製する（コピーオンライト）ので、読み手が参照中のスナップショットは壊れない。
+    """
+
+    def __init__(self, data=None):
+        super().__init__()
+        self.by_date = Timeline()
+        self._owned_users = None  # Noneなら全ての辞書を直接書き換えてよい
+        self._owned_dates = None
+        self._frozen = False
+        for user, user_schedule in (data or {}).items():
+            for date_key, info in user_schedule.items():
+                self._put(user, date_key, Entry.from_info(info))
+
+    def evolve(self):
+        """このスナップショットを元にしたコピーオンライトの下書きを返す"""
+        draft = Schedules.__new__(Schedules)
+        dict.__init__(draft, self)
+        draft.by_date = self.by_date.copy()
+        draft._owned_users = set()
+        draft._owned_dates = set()
+        draft._frozen = False
+        return draft
+
+    def freeze(self):
+        self._frozen = True
+
+    @staticmethod
+    def _writable(table, owned, key, factory=dict):
+        """table[key] の辞書を書き込み可能にして返す（下書きでは初回だけ複製する）"""
+        inner = table.get(key)
+        if inner is not None and (owned is None or key in owned):
+            return inner
+        inner = inner.copy() if inner else factory()
+        table[key] = inner
+        if owned is not None:
+            owned.add(key)
+        return inner
+
+    def _user_timeline(self, user):
+        return self._writable(self, self._owned_users, user, Timeline)
+
+    def _put(self, user, date_key, info):
+        self._user_timeline(user)[date_key] = info
+        self._writable(self.by_date, self._owned_dates, date_key)[user] = info
+
+    def _remove(self, user, date_key):
+        user_schedule = self._user_timeline(user)
+        del user_schedule[date_key]
+        if not user_schedule:
+            del self[user]
+        self._unindex(user, date_key)
+
+    def _unindex(self, user, date_key):
+        day = self._writable(self.by_date, self._owned_dates, date_key)
+        del day[user]
+        if not day:
+            del self.by_date[date_key]
+
+    # ---- インデックスを使う問い合わせ ----
+
+    def entries_on(self, date_key):
+        return dict(self.by_date.get(date_key, {}))
+
+    def entries_between(self, start_key, end_key):
+        result = {}
+        for date_key in self.by_date.keys_between(start_key, end_key):
+            for user, info in self.by_date[date_key].items():
+                result.setdefault(user, {})[date_key] = info
+        return result
+
+    def user_entries(self, user, start_key=None, end_key=None):
+        user_schedule = self.get(user)
+        if not user_schedule:
+            return []
+        return [(k, user_schedule[k]) for k in user_schedule.keys_between(start_key, end_key)]
+
+    # ---- 書き込み ----
+
+    def apply(self, record):
+        """変更レコードを適用し、変更した件数を返す"""
+        if self._frozen:
+            raise RuntimeError("published snapshot is read-only; apply records to evolve() instead")
+        op = record["op"]
+        user = record.get("user")
+
+        if op == "set":
+            info = Entry.of(record["status"], record["note"])
+            for date_key in record["dates"]:
+                self._put(user, date_key, info)
+            return len(record["dates"])
+
+        if op == "note":
+            # 既存のステータスを保持、なければ空
+            for date_key in record["dates"]:
+                current_status = self.get(user, {}).get(date_key, {}).get("status", "")
+                self._put(user, date_key, Entry.of(current_status, record["note"]))
+            return len(record["dates"])
+
+        if op == "clear":
+            user_schedule = self.get(user)
+            if user_schedule is None:
+                return 0
+            if "start" in record:
+                # start〜end（両端含む）の範囲のみ、スライスでまとめて削除
+                if not user_schedule.keys_between(record["start"], record["end"]):
+                    return 0
+                user_schedule = self._user_timeline(user)
+                doomed = user_schedule.pop_between(record["start"], record["end"])
+                if not user_schedule:
+                    del self[user]
+            else:
+                doomed = list(user_schedule.items())
+                del self[user]
+            for date_key, _ in doomed:
+                self._unindex(user, date_key)
+            return len(doomed)
+
+        if op == "expire":
+            # 過去の日付は by_date の先頭にまとまっているので、その部分だけを外す
+            # （日付ごと消すので by_date 側の辞書は複製しなくてよい）
+            expired = self.by_date.pop_before(record["before"])
+            users = {name for _, day in expired for name in day}
+            for name in users:
+                user_schedule = self._user_timeline(name)
+                user_schedule.pop_before(record["before"])
+                if not user_schedule:
+                    del self[name]
+            return sum(len(day) for _, day in expired)
+
+        if op == "rename":
+            # 移行先に同じ日付があればそちらを優先して統合
+            old_schedule = dict(self.get(user, {}))
+            target = self.get(record["to"], {})
+            for date_key, info in old_schedule.items():
+                if date_key not in target:
+                    self._put(record["to"], date_key, info)
+                    target = self[record["to"]]
+                self._remove(user, date_key)
+            return len(old_schedule)
+
+        raise ValueError(f"unknown record op: {op}")
+
+# ========== SQLiteバックエンド ==========
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    user     TEXT NOT NULL,
+    date_key TEXT NOT NULL,
+    status   TEXT NOT NULL DEFAULT '',
+    note     TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (user, date_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_by_date ON entries (date_key, user);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+class StaleStateError(Exception):
+    """他のプロセスが先に state.db に書き込んでいた（読み直してからやり直す）"""
+
+class SqliteSchedules:
+    """
+    state["schedules"] のSQLite版
+    {user: {date_key: {"status": ..., "note": ...}}} の辞書と同じように読めるが、
+    実体は (user, date_key) の主キーと (date_key, user) のインデックスを持つテーブル
+    書き込みのたびに meta の revision を1つ進める。最後に読んだ revision から進んでいたら
+    書き込まずに StaleStateError を送出する（楽観的排他、MULTI_PROCESS=1 で複数のプロセスが書く場合）
+    data_revision は予定が変わったときだけ進める（board_message などの書き込みでは進めない）
+    スナップショットは複製を持たない生のビューなので、1回の描画の読み出しは reading() で
+    1つの読み取りトランザクションにまとめる（その中では他の書き込みが見えない、スナップショットの version より新しいことはある）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SQLITE_SCHEMA)
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', '0')")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_revision', '0')")
+        self.revision = self.latest_revision()  # このプロセスが最後に読み書きした revision
+        self.data_revision = 0  # その時点の data_revision（load_meta() で読む）
+
+    def _conn(self):
+        # sqlite3の接続はスレッドをまたげないので、スレッドごとに接続する
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def evolve(self):
+        # 複製しない（読み手の一貫性は reading() の読み取りトランザクションで保つ）
+        return self
+
+    @contextlib.contextmanager
+    def reading(self):
+        """このスレッドの読み出しを1つの読み取りトランザクションにまとめる（入れ子なら外側のものを使う）"""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            conn.commit()
+
+    def freeze(self):
+        pass
+
+    # ---- 辞書互換の読み出し ----
+
+    def __contains__(self, user):
+        row = self._conn().execute("SELECT 1 FROM entries WHERE user = ? LIMIT 1", (user,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, user):
+        rows = self._conn().execute(
+            "SELECT date_key, status, note FROM entries WHERE user = ? ORDER BY date_key", (user,)
+        ).fetchall()
+        if not rows:
+            raise KeyError(user)
+        return {date_key: {"status": status, "note": note} for date_key, status, note in rows}
+
+    def get(self, user, default=None):
+        try:
+            return self[user]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [row[0] for row in self._conn().execute("SELECT DISTINCT user FROM entries ORDER BY user")]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(DISTINCT user) FROM entries").fetchone()[0]
+
+    def items(self):
+        result = {}
+        for user, date_key, status, note in self._conn().execute(
+            "SELECT user, date_key, status, note FROM entries ORDER BY user, date_key"
+        ):
+            result.setdefault(user, {})[date_key] = {"status": status, "note": note}
+        return result.items()
+
+    # ---- インデックスを使う問い合わせ ----
+
+    def entries_on(self, date_key):
+        rows = self._conn().execute(
+            "SELECT user, status, note FROM entries WHERE date_key = ?", (date_key,)
+        )
+        return {user: {"status": status, "note": note} for user, status, note in rows}
+
+    def entries_between(self, start_key, end_key):
+        result = {}
+        for user, date_key, status, note in self._conn().execute(
+            "SELECT user, date_key, status, note FROM entries WHERE date_key BETWEEN ? AND ?",
+            (start_key, end_key),
+        ):
+            result.setdefault(user, {})[date_key] = {"status": status, "note": note}
+        return result
+
+    def user_entries(self, user, start_key=None, end_key=None):
+        query = "SELECT date_key, status, note FROM entries WHERE user = ?"
+        params = [user]
+        if start_key is not None:
+            query += " AND date_key >= ?"
+            params.append(start_key)
+        if end_key is not None:
+            query += " AND date_key <= ?"
+            params.append(end_key)
+        rows = self._conn().execute(query + " ORDER BY date_key", params)
+        return [(date_key, {"status": status, "note": note}) for date_key, status, note in rows]
+
+    # ---- 書き込み ----
+
+    def latest_revision(self):
+        """state.db の最新の revision（他のプロセスの書き込みも含む）"""
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _advance(self, conn):
+        """トランザクションの中で revision を1つ進める（他のプロセスが先に進めていたら StaleStateError）"""
+        cur = conn.execute(
+            "UPDATE meta SET value = ? WHERE key = 'revision' AND value = ?",
+            (str(self.revision + 1), str(self.revision)),
+        )
+        if cur.rowcount != 1:
+            raise StaleStateError(f"{self.path}: revision {self.revision} is stale")
+
+    def _advance_data(self, conn):
+        """予定を変えたトランザクションの中で data_revision を1つ進める（_advance の後に呼ぶ）"""
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'data_revision'", (str(self.data_revision + 1),))
+
+    def apply(self, record):
+        """変更レコードを1トランザクションで適用し、変更した件数を返す"""
+        conn = self._conn()
+        with conn:
+            changed = self._apply(conn, record)
+            if changed:
+                self._advance(conn)
+                self._advance_data(conn)
+        if changed:
+            self.revision += 1
+            self.data_revision += 1
+        return changed
+
+    def _apply(self, conn, record):
+        op = record["op"]
+        user = record.get("user")
+        if op == "set":
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (user, date_key, status, note) VALUES (?, ?, ?, ?)",
+                [(user, date_key, record["status"], record["note"]) for date_key in record["dates"]],
+            )
+            return len(record["dates"])
+        if op == "note":
+            conn.executemany(
+                "INSERT INTO entries (user, date_key, status, note) VALUES (?, ?, '', ?) "
+                "ON CONFLICT (user, date_key) DO UPDATE SET note = excluded.note",
+                [(user, date_key, record["note"]) for date_key in record["dates"]],
+            )
+            return len(record["dates"])
+        if op == "clear":
+            if "start" in record:
+                cur = conn.execute(
+                    "DELETE FROM entries WHERE user = ? AND date_key BETWEEN ? AND ?",
+                    (user, record["start"], record["end"]),
+                )
+            else:
+                cur = conn.execute("DELETE FROM entries WHERE user = ?", (user,))
+            return cur.rowcount
+        if op == "expire":
+            cur = conn.execute("DELETE FROM entries WHERE date_key < ?", (record["before"],))
+            return cur.rowcount
+        if op == "rename":
+            # 移行先に同じ日付があればそちらを優先して統合
+            conn.execute(
+                "INSERT OR IGNORE INTO entries (user, date_key, status, note) "
+                "SELECT ?, date_key, status, note FROM entries WHERE user = ?",
+                (record["to"], user),
+            )
+            cur = conn.execute("DELETE FROM entries WHERE user = ?", (user,))
+            return cur.rowcount
+        raise ValueError(f"unknown record op: {op}")
+
+    def import_schedules(self, schedules, meta):
+        """辞書形式のschedulesとメタ情報を1トランザクションで取り込む（state.jsonからの移行用）"""
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (user, date_key, status, note) VALUES (?, ?, ?, ?)",
+                [
+                    (user, date_key, info.get("status", ""), info.get("note", ""))
+                    for user, user_schedule in schedules.items()
+                    for date_key, info in user_schedule.items()
+                ],
+            )
+            self._save_meta(conn, meta)
+            self._advance_data(conn)
+        self.revision += 1
+        self.data_revision += 1
+
+    def load_meta(self):
+        """保存したメタ情報（なければNone）を読み、revision・data_revision をその時点のものにする"""
+        rows = dict(self._conn().execute(
+            "SELECT key, value FROM meta WHERE key IN ('state', 'revision', 'data_revision')"
+        ))
+        self.revision = int(rows.get("revision", 0))
+        self.data_revision = int(rows.get("data_revision", 0))
+        return json.loads(rows["state"]) if "state" in rows else None
+
+    def save_meta(self, meta):
+        conn = self._conn()
+        with conn:
+            self._save_meta(conn, meta)
+        self.revision += 1
+
+    def _save_meta(self, conn, meta):
+        self._advance(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('state', ?)",
+            (json.dumps(meta, ensure_ascii=False),),
+        )
+
+def load_sqlite_state():
+    current_tenant().prepare()
+    schedules = SqliteSchedules(current_tenant().path(SQLITE_FILE))
+    meta = schedules.load_meta()
+    if meta is None:
+        # 初回起動: state.json があればその内容を移行する
+        data = load_json_state()
+        log.info("Migrating %s to %s: %s user(s) (%s)", DATA_FILE, SQLITE_FILE, len(data['schedules']), current_tenant())
+        meta = {k: v for k, v in data.items() if k not in ("schedules", "journal_seq")}
+        try:
+            schedules.import_schedules(data["schedules"], meta)
+        except StaleStateError:
+            # 同時に起動した別のプロセスが先に移行した
+            meta = schedules.load_meta()
+    return dict(meta, schedules=schedules)
 
 def today_key():
-    return datetime.now(TZ).strftime("%Y-%m-%d")
+    return calendar().today_key
 
 def date_to_key(date: datetime) -> str:
     return date.strftime("%Y-%m-%d")
 
+# ========== カレンダー ==========
+# 今日から CALENDAR_DAYS 日分の日付キー・曜日ラベルを1回だけ計算し、描画とパーサーで共有する
+# JSTの日付が変わったときだけ作り直す
+
+CALENDAR_DAYS = 71  # 今日 + 70日（/lab 10 の10週間分）
+WEEKDAY_JA = ("月", "火", "水", "木", "金", "土", "日")
+
+# ordinal: date.toordinal()、isoweekday: 月=1〜日=7、label: 曜日の漢字1文字、dt: JSTの0時のdatetime
+CalendarDay = namedtuple("CalendarDay", ["ordinal", "date_key", "month", "day", "label", "isoweekday", "dt"])
+
+def make_calendar_day(ordinal: int) -> CalendarDay:
+    d = date.fromordinal(ordinal)
+    return CalendarDay(
+        ordinal, d.isoformat(), d.month, d.day, WEEKDAY_JA[d.weekday()], d.isoweekday(),
+        datetime(d.year, d.month, d.day, tzinfo=TZ),
+    )
+
+class CalendarWindow:
+    """今日から並んだ CalendarDay の列（window[i] が今日からi日後）"""
+
+    def __init__(self, today: int, days: int = CALENDAR_DAYS):
+        self.today = today
+        self.days = tuple(make_calendar_day(today + i) for i in range(days))
+        self.by_key = {day.date_key: day for day in self.days}
+        self.today_key = self.days[0].date_key
+
+    def __len__(self):
+        return len(self.days)
+
+    def __getitem__(self, i):
+        return self.days[i]
+
+    def first(self, n: int):
+        """今日からn日分（窓より長ければ足りない分をその場で作る）"""
+        if n <= len(self.days):
+            return self.days[:n]
+        return self.days + tuple(make_calendar_day(self.today + i) for i in range(len(self.days), n))
+
+    def key_after(self, offset: int) -> str:
+        """今日からoffset日後の日付キー"""
+        return self.day(self.today + offset).date_key
+
+    def day(self, ordinal: int) -> CalendarDay:
+        offset = ordinal - self.today
+        if 0 <= offset < len(self.days):
+            return self.days[offset]
+        return make_calendar_day(ordinal)
+
+    def lookup(self, date_key: str) -> Optional[CalendarDay]:
+        """日付キーの CalendarDay（窓の外なら作る、不正なキーはNone）"""
+        day = self.by_key.get(date_key)
+        if day is not None:
+            return day
+        try:
+            return make_calendar_day(date.fromisoformat(date_key).toordinal())
+        except (TypeError, ValueError):
+            return None
+
+_calendar = None
+_calendar_lock = threading.Lock()
+
+def calendar() -> CalendarWindow:
+    """今日からのカレンダー（JSTの日付が変わっていれば作り直す）"""
+    global _calendar
+    today = datetime.now(TZ).date().toordinal()
+    window = _calendar
+    if window is None or window.today != today:
+        with _calendar_lock:
+            if _calendar is None or _calendar.today != today:
+                _calendar = CalendarWindow(today)
+                log.debug("[calendar] Built %s days from %s", len(_calendar), _calendar.today_key)
+            window = _calendar
+    return window
+
 # ========== 日付パーサー ==========
 
 WEEKDAY_MAP = {
@@ -82,216 +1603,348 @@ MONTH_MAP = {
     "october": 10, "november": 11, "december": 12
 }
 
-def get_next_weekday(target_weekday: int, from_date: Optional[datetime] = None) -> datetime:
-    """指定した曜日の次の日付を取得（今日から始まる7日間）"""
-    if from_date is None:
-        from_date = datetime.now(TZ)
-    
-    current_weekday = from_date.weekday()
-    days_ahead = target_weekday - current_weekday
-    if days_ahead < 0:
-        days_ahead += 7
-    
-    result = from_date + timedelta(days=days_ahead)
-    debug_log(f"get_next_weekday: target={target_weekday}, from={from_date.date()}, result={result.date()}")
-    return result
+def _alternation(words):
+    # 長い語を先に並べる（"monday" を "mon" より優先）
+    return "|".join(sorted(words, key=len, reverse=True))
 
-def parse_single_token(token: str) -> Tuple[Optional[List[datetime]], str]:
+# 1トークンの文法（範囲指定はハイフンの前後にスペースなし、日付は月/日の両方が必須）
+TOKEN_GRAMMAR = re.compile(
+    rf"""
+      (?P<weekday>{_alternation(WEEKDAY_MAP)})(?:-(?P<weekday_end>{_alternation(WEEKDAY_MAP)}))?
+    | (?P<month>{_alternation(MONTH_MAP)})
+    | (?P<m>\d{{1,2}})/(?P<d>\d{{1,2}})(?:-(?P<m_end>\d{{1,2}})/(?P<d_end>\d{{1,2}}))?
+    """,
+    re.VERBOSE,
+)
+
+# ""で囲まれたnote（Slackのスマートクォートにも対応）
+NOTE_PATTERN = re.compile(r'["\u201c]([^"\u201d]*)["\u201d]')
+
+def today_ordinal() -> int:
+    """JSTの今日の日付の通し番号（date.toordinal()）"""
+    return calendar().today
+
+def ordinal_to_datetime(ordinal: int) -> datetime:
+    return calendar().day(ordinal).dt
+
+def expand_spans(spans) -> List[datetime]:
+    """(start, end) の日付範囲（通し番号、両端含む）を日付のリストに展開する"""
+    return [ordinal_to_datetime(o) for start, end in spans for o in range(start, end + 1)]
+
+def _weekday_offsets_to_spans(offsets):
+    """今日からの日数のリストを、連続する部分ごとの範囲にまとめる（順序は保つ）"""
+    spans = []
+    for offset in offsets:
+        if spans and spans[-1][1] == offset - 1:
+            spans[-1][1] = offset
+        else:
+            spans.append([offset, offset])
+    return spans
+
+def _next_year_if_past(today: date, month: int, day: int) -> int:
+    """過去の月/日は来年として扱う"""
+    if month < today.month or (month == today.month and day < today.day):
+        return today.year + 1
+    return today.year
+
+@functools.lru_cache(maxsize=1024)
+def parse_token_spans(token: str, today: int) -> Tuple[Optional[Tuple[Tuple[int, int], ...]], str]:
     """
-    単一のトークンをパースして日付リストを返す
-    戻り値: (日付リスト or None, トークンの種類)
-    トークンの種類: "weekday", "weekday_range", "date", "date_range", "month", "invalid"
+    単一のトークンをパースして日付範囲を返す（todayはtoday_ordinal()、日ごとにメモ化される）
+    戻り値: ((start, end) のタプル or None, トークンの種類)
+    トークンの種類: "weekday", "weekday_range", "date", "date_range", "month", "invalid", "empty"
     """
-    token = token.strip().lower()
-    
     if not token:
         return None, "empty"
-    
-    # 範囲指定（ハイフン含む） - ハイフンの前後にスペースがないことが前提
-    if '-' in token:
-        parts = token.split('-', 1)
-        if len(parts) != 2:
-            return None, "invalid"
-        
-        start_token = parts[0].strip()
-        end_token = parts[1].strip()
-        
-        # 曜日範囲 "mon-fri"
-        start_day = WEEKDAY_MAP.get(start_token)
-        end_day = WEEKDAY_MAP.get(end_token)
-        
-        if start_day is not None and end_day is not None:
-            debug_log(f"  Weekday range: {start_token}-{end_token}")
-            dates = []
-            current = start_day
-            while True:
-                dates.append(get_next_weekday(current))
-                if current == end_day:
-                    break
-                current = (current + 1) % 7
-            return dates, "weekday_range"
-        
-        # 日付範囲 "2/1-2/5" (両方とも月/日形式必須)
-        start_match = re.fullmatch(r'(\d{1,2})/(\d{1,2})', start_token)
-        end_match = re.fullmatch(r'(\d{1,2})/(\d{1,2})', end_token)
-        
-        if start_match and end_match:
-            now = datetime.now(TZ)
-            current_year = now.year
-            
-            start_month = int(start_match.group(1))
-            start_day = int(start_match.group(2))
-            end_month = int(end_match.group(1))
-            end_day = int(end_match.group(2))
-            
-            # 年の判定
-            start_year = current_year
-            if start_month < now.month or (start_month == now.month and start_day < now.day):
-                start_year = current_year + 1
-            
-            end_year = start_year
-            if end_month < start_month:
-                end_year = start_year + 1
-            
-            try:
-                start_date = datetime(start_year, start_month, start_day, tzinfo=TZ)
-                end_date = datetime(end_year, end_month, end_day, tzinfo=TZ)
-                
-                debug_log(f"  Date range: {start_date.date()} to {end_date.date()}")
-                dates = []
-                current = start_date
-                while current <= end_date:
-                    dates.append(current)
-                    current += timedelta(days=1)
-                
-                return dates, "date_range"
-            except ValueError:
-                # 無効な日付
-                return None, "invalid"
-        
-        # どちらでもない範囲指定は無効
+    match = TOKEN_GRAMMAR.fullmatch(token)
+    if not match:
         return None, "invalid"
     
-    # 単一トークン（範囲指定なし）
+    today_date = date.fromordinal(today)
     
-    # 曜日
-    weekday = WEEKDAY_MAP.get(token)
-    if weekday is not None:
-        debug_log(f"  Weekday: {token}")
-        return [get_next_weekday(weekday)], "weekday"
+    if match.group("weekday"):
+        # 曜日は今日から始まる7日間のうちの該当日、"fri-mon" のような折り返しも可
+        start = WEEKDAY_MAP[match.group("weekday")]
+        end = WEEKDAY_MAP[match.group("weekday_end") or match.group("weekday")]
+        weekdays = [(start + i) % 7 for i in range((end - start) % 7 + 1)]
+        offsets = [(w - today_date.weekday()) % 7 for w in weekdays]
+        spans = tuple((today + s, today + e) for s, e in _weekday_offsets_to_spans(offsets))
+        return spans, ("weekday_range" if match.group("weekday_end") else "weekday")
     
-    # 月名
-    month_num = MONTH_MAP.get(token)
-    if month_num is not None:
-        now = datetime.now(TZ)
-        current_year = now.year
-        
-        # 過去の月は来年扱い
-        if month_num < now.month:
-            year = current_year + 1
-        else:
-            year = current_year
-        
-        # その月の全日を追加
-        if month_num == 12:
-            next_month = datetime(year + 1, 1, 1, tzinfo=TZ)
-        else:
-            next_month = datetime(year, month_num + 1, 1, tzinfo=TZ)
-        
-        debug_log(f"  Month: {token}")
-        dates = []
-        current_date = datetime(year, month_num, 1, tzinfo=TZ)
-        while current_date < next_month:
-            dates.append(current_date)
-            current_date += timedelta(days=1)
-        
-        return dates, "month"
+    if match.group("month"):
+        # その月の全日（過去の月は来年扱い）
+        month = MONTH_MAP[match.group("month")]
+        year = today_date.year + 1 if month < today_date.month else today_date.year
+        first = date(year, month, 1)
+        last = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+        return ((first.toordinal(), last.toordinal() - 1),), "month"
     
-    # 日付 "2/1" (月/日形式必須)
-    date_match = re.fullmatch(r'(\d{1,2})/(\d{1,2})', token)
-    if date_match:
-        now = datetime.now(TZ)
-        current_year = now.year
-        
-        month = int(date_match.group(1))
-        day = int(date_match.group(2))
-        
-        # 年の判定
-        year = current_year
-        if month < now.month or (month == now.month and day < now.day):
-            year = current_year + 1
-        
-        try:
-            date = datetime(year, month, day, tzinfo=TZ)
-            debug_log(f"  Date: {date.date()}")
-            return [date], "date"
-        except ValueError:
-            # 無効な日付
-            return None, "invalid"
-    
-    # 認識できないトークン
-    return None, "invalid"
+    month, day = int(match.group("m")), int(match.group("d"))
+    year = _next_year_if_past(today_date, month, day)
+    try:
+        start = date(year, month, day).toordinal()
+        if match.group("m_end") is None:
+            return ((start, start),), "date"
+        end_month, end_day = int(match.group("m_end")), int(match.group("d_end"))
+        end_year = year + 1 if end_month < month else year
+        end = date(end_year, end_month, end_day).toordinal()
+    except ValueError:
+        # 無効な日付
+        return None, "invalid"
+    # 終わりが始まりより前なら空の範囲
+    return (((start, end),) if start <= end else ()), "date_range"
 
-def parse_command_text(text: str, allow_weekday: bool = True, allow_date: bool = False) -> Tuple[List[datetime], str]:
+def parse_single_token(token: str) -> Tuple[Optional[List[datetime]], str]:
     """
-    コマンドのテキストをパースして日付リストとnoteを返す
-    allow_weekday: 曜日指定を許可
-    allow_date: 日付指定を許可
-    
-    noteは""で囲まれた部分のみ認識
+    単一のトークンをパースして日付リストを返す
+    戻り値: (日付リスト or None, トークンの種類)
     """
-    debug_log(f"parse_command_text: text='{text}', weekday={allow_weekday}, date={allow_date}")
-    
+    spans, token_type = parse_token_spans(token.strip().lower(), today_ordinal())
+    return (None if spans is None else expand_spans(spans)), token_type
+
+def parse_command_spans(text: str, allow_weekday: bool = True, allow_date: bool = False) -> Tuple[List[Tuple[int, int]], str]:
+    """
+    コマンドのテキストをパースして日付範囲のリストとnoteを返す
+    日付が1つもなければ今日。noteは""で囲まれた部分のみ認識
+    """
+    today = today_ordinal()
     if not text:
         # テキストが空なら今日
-        return [datetime.now(TZ)], ""
+        return [(today, today)], ""
     
-    # ""で囲まれたnoteを抽出（Slackのスマートクォートにも対応）
     note = ""
-    note_match = re.search(r'["\u201c]([^"\u201d]*)["\u201d]', text)
+    note_match = NOTE_PATTERN.search(text)
     if note_match:
         note = note_match.group(1)
         # noteを除去したテキストで日付パース
         text = text[:note_match.start()] + text[note_match.end():]
     
-    # カンマをスペースに置換
-    text = text.replace(',', ' ')
-    
-    # スペースで分割
-    tokens = text.split()
-    
-    dates = []
-    
-    for token in tokens:
-        if not token:  # 空のトークンはスキップ
+    spans = []
+    # カンマもスペースと同じ区切り
+    for token in text.replace(',', ' ').split():
+        token_spans, token_type = parse_token_spans(token.lower(), today)
+        if token_spans is None:
             continue
-            
-        parsed_dates, token_type = parse_single_token(token)
-        
-        if parsed_dates is not None:
-            # 曜日パースが許可されているか
-            if token_type in ["weekday", "weekday_range"] and not allow_weekday:
-                continue
-            
-            # 日付パースが許可されているか
-            if token_type in ["date", "date_range", "month"] and not allow_date:
-                continue
-            
-            dates.extend(parsed_dates)
-            debug_log(f"  Token '{token}' parsed as {token_type}: {len(parsed_dates)} date(s)")
+        # 曜日・日付の指定が許可されているか
+        if token_type in ("weekday", "weekday_range") and not allow_weekday:
+            continue
+        if token_type in ("date", "date_range", "month") and not allow_date:
+            continue
+        spans.extend(token_spans)
+        log.debug("  Token '%s' parsed as %s: %s", token, token_type, token_spans)
     
     # 日付が1つもパースできなかった場合は今日
-    if not dates:
-        debug_log(f"  No dates parsed, using today")
-        dates = [datetime.now(TZ)]
+    if not spans:
+        log.debug("  No dates parsed, using today")
+        spans = [(today, today)]
+    return spans, note
+
+def parse_command_text(text: str, allow_weekday: bool = True, allow_date: bool = False) -> Tuple[List[datetime], str]:
+    """
+    コマンドのテキストをパースして日付リストとnoteを返す
+    allow_weekday: 曜日指定を許可
+    allow_date: 日付指定を許可
     
-    debug_log(f"  Result: {len(dates)} date(s), note='{note}'")
+    noteは""で囲まれた部分のみ認識
+    """
+    log.debug("parse_command_text: text='%s', weekday=%s, date=%s", text, allow_weekday, allow_date)
+    spans, note = parse_command_spans(text, allow_weekday, allow_date)
+    dates = expand_spans(spans)
+    log.debug("  Result: %s date(s), note='%s'", len(dates), note)
     return dates, note
 
-def render_board(schedules, target_date=None):
+# ========== ステータス行列（オプション） ==========
+# STATUS_MATRIX=1 のとき、今日から MATRIX_DAYS 日間のステータスを ユーザー×日 の uint8 行列で持つ
+# （noteは別の表）。週表示・期間表示の行は行列のスライスから作り、0時には列をずらすだけで済む
+STATUS_MATRIX = os.environ.get("STATUS_MATRIX", "0") == "1"
+MATRIX_DAYS = CALENDAR_DAYS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STATUS_EMOJI = {
+    "in": "✅",
+    "pm": "🕒",
+    "out": "❌",
+    "home": "🏠",
+    "maybe": "🤔",
+    "trip": "✈️",
+    "will": "📅",
+    "can": "💡",
+}
+
+# ステータス → 行列のコード（0は登録なし、OTHER_STATUSは絵文字のないステータス）
+STATUS_CODES = {status: code for code, status in enumerate(STATUS_EMOJI, start=1)}
+OTHER_STATUS = 255
+
+def key_to_ordinal(date_key: str) -> int:
+    return date.fromisoformat(date_key).toordinal()
+
+class StatusMatrix:
+    """
+    今日（base）から width 日間のステータス行列とnoteの表
+    codes[row, i] は users[row] の base+i 日のステータスコード、notes は {user: {日付の通し番号: note}}
+    行は窓に予定のあるユーザーのもの（rolled() で予定がなくなった行を捨てる）
+    スナップショットと一緒に公開されるので、変更は updated() / rolled() で新しい行列を作る
+    """
+
+    def __init__(self, base, users, codes, notes, width=MATRIX_DAYS):
+        self.base = base
+        self.width = width
+        self.users = users
+        self.row_of = {user: row for row, user in enumerate(users)}
+        self.codes = codes
+        self.notes = notes
+
+    @classmethod
+    def build(cls, schedules, today, width=MATRIX_DAYS):
+        window = entries_between(
+            schedules, date.fromordinal(today).isoformat(), date.fromordinal(today + width - 1).isoformat()
+        )
+        users = sorted(window)
+        matrix = cls(today, users, np.zeros((len(users), width), dtype=np.uint8), {}, width)
+        for user, user_schedule in window.items():
+            matrix._fill(user, user_schedule)
+        return matrix
+
+    def _fill(self, user, user_schedule):
+        """userの行とnoteを user_schedule {date_key: entry} から作り直す"""
+        row = self.codes[self.row_of[user]]
+        row[:] = 0
+        notes = {}
+        for date_key, info in user_schedule.items():
+            offset = key_to_ordinal(date_key) - self.base
+            if 0 <= offset < self.width:
+                row[offset] = STATUS_CODES.get(info.get("status", ""), OTHER_STATUS)
+                if info.get("note"):
+                    notes[self.base + offset] = info["note"]
+        if notes:
+            self.notes[user] = notes
+        else:
+            self.notes.pop(user, None)
+
+    def covers(self, today, days):
+        return self.base == today and days <= self.width
+
+    def updated(self, schedules, users):
+        """users の行だけを schedules から作り直した新しい行列を返す"""
+        new_users = [user for user in users if user not in self.row_of]
+        codes = self.codes.copy()
+        if new_users:
+            codes = np.vstack([codes, np.zeros((len(new_users), self.width), dtype=np.uint8)])
+        matrix = StatusMatrix(self.base, self.users + new_users, codes, dict(self.notes), self.width)
+        for user in users:
+            matrix._fill(user, schedules.get(user) or {})
+        return matrix
+
+    def rolled(self, schedules, today):
+        """日付が変わったとき: 列を左にずらし、新しく窓に入った日だけを schedules から埋める"""
+        shift = today - self.base
+        if shift <= 0:
+            return self
+        if shift >= self.width:
+            return StatusMatrix.build(schedules, today, self.width)
+        codes = np.zeros_like(self.codes)
+        codes[:, :self.width - shift] = self.codes[:, shift:]
+        # 窓に予定が残っていない行は捨てる（過去の予定しかないユーザーの行が溜まり続けないように）
+        keep = np.flatnonzero(codes.any(axis=1))
+        users = [self.users[row] for row in keep]
+        codes = codes[keep]
+        notes = {}
+        for user, user_notes in self.notes.items():
+            kept = {o: note for o, note in user_notes.items() if o >= today}
+            if kept:
+                notes[user] = kept
+        matrix = StatusMatrix(today, users, codes, notes, self.width)
+        first_new = today + self.width - shift
+        entering = entries_between(
+            schedules, date.fromordinal(first_new).isoformat(), date.fromordinal(today + self.width - 1).isoformat()
+        )
+        new_users = [user for user in entering if user not in matrix.row_of]
+        if new_users:
+            matrix = matrix.updated(schedules, new_users)
+        for user, user_schedule in entering.items():
+            row = matrix.codes[matrix.row_of[user]]
+            for date_key, info in user_schedule.items():
+                offset = key_to_ordinal(date_key) - today
+                row[offset] = STATUS_CODES.get(info.get("status", ""), OTHER_STATUS)
+                if info.get("note"):
+                    matrix.notes.setdefault(user, {})[today + offset] = info["note"]
+        return matrix
+
+    def rows(self, days):
+        """status_rows と同じ形式の行を、行列のスライスから作る"""
+        window = self.codes[:, :days]
+        active = np.flatnonzero(window.any(axis=1))
+        emojis = EMOJI_BY_CODE[window[active]]
+        end = self.base + days
+        result = {}
+        for i, row in enumerate(active):
+            user = self.users[row]
+            notes = sorted(
+                (o - self.base, note) for o, note in self.notes.get(user, {}).items() if o < end
+            )
+            result[user] = (emojis[i].tolist(), notes)
+        return result
+
+if np is not None:
+    # コード → 絵文字（登録なし・絵文字のないステータスは ➖）
+    EMOJI_BY_CODE = np.array(["➖"] * 256, dtype=object)
+    for _status, _code in STATUS_CODES.items():
+        EMOJI_BY_CODE[_code] = STATUS_EMOJI[_status]
+elif STATUS_MATRIX:
+    log.warning("[StatusMatrix] numpy is not installed, STATUS_MATRIX is disabled")
+    STATUS_MATRIX = False
+
+def records_users(record):
+    """変更レコードで行が変わるユーザー"""
+    if record["op"] == "rename":
+        return [record["user"], record["to"]]
+    if "user" in record:
+        return [record["user"]]
+    return []
+
+def status_rows(schedules, days, matrix=None):
+    """
+    今日からdays日間に登録があるユーザーごとの (日ごとの絵文字のリスト, [(日のインデックス, note)]) を返す
+    matrixが今日からの窓を持っていれば、行列のスライスから作る
+    """
+    window = calendar()
+    if matrix is not None and matrix.covers(window.today, days):
+        return matrix.rows(days)
+    date_keys = [day.date_key for day in window.first(days)]
+    result = {}
+    for user, user_schedule in entries_between(schedules, date_keys[0], date_keys[-1]).items():
+        emojis = []
+        notes = []
+        for i, date_key in enumerate(date_keys):
+            info = user_schedule.get(date_key)
+            if info is None:
+                emojis.append("➖")
+                continue
+            emojis.append(STATUS_EMOJI.get(info.get("status", "—"), "➖"))
+            if info.get("note"):
+                notes.append((i, info["note"]))
+        result[user] = (emojis, notes)
+    return result
+
+def resolve_names(names, keys):
+    """
+    schedulesのキー → 表示名 の辞書を返す
+    names: キーの一覧を受け取って {key: 表示名} を返す関数（Noneならキーをそのまま表示）
+    """
+    keys = list(keys)
+    resolved = names(keys) if names else {}
+    return {key: resolved.get(key, key) for key in keys}
+
+@metrics.timed("render_seconds")
+def render_board(schedules, target_date=None, names=None):
     """
     指定日のボードを表示
-    schedules: {user_name: {date_key: {"status": "...", "note": "..."}}}
+    schedules: {user_id: {date_key: {"status": "...", "note": "..."}}}
+    names: 表示名を一括で解決する関数（resolve_names参照）
     """
     if target_date is None:
         target_date = datetime.now(TZ)
@@ -300,32 +1953,19 @@ def render_board(schedules, target_date=None):
     lines = [f"【在室ボード】{date_key}"]
     
     # ユーザー毎の状態を集計
-    board = {}
-    for user_name, user_schedule in schedules.items():
-        if date_key in user_schedule:
-            info = user_schedule[date_key]
-            board[user_name] = info
+    board = entries_on(schedules, date_key)
     
     if not board:
         lines.append("（まだ誰も登録していません）")
     else:
-        status_emoji = {
-            "in": "✅",
-            "pm": "🕒",
-            "out": "❌",
-            "home": "🏠",
-            "maybe": "🤔",
-            "trip": "✈️",
-            "will": "📅",
-            "can": "💡",
-        }
-        
-        for name in sorted(board.keys()):
-            s = board[name].get("status", "")
+        labels = resolve_names(names, board)
+        for key in sorted(board, key=labels.get):
+            s = board[key].get("status", "")
             if not s:
                 continue
-            note = board[name].get("note", "")
-            emoji = status_emoji.get(s, "")
+            name = labels[key]
+            note = board[key].get("note", "")
+            emoji = STATUS_EMOJI.get(s, "")
             status_part = f" {emoji} {s}" if emoji else f" {s}"
             tail = f"（{note}）" if note else ""
             lines.append(f"- {name}{status_part}{tail}")
@@ -333,163 +1973,925 @@ def render_board(schedules, target_date=None):
     lines.append(f"\n最終更新: {datetime.now(TZ).strftime('%H:%M')}")
     return "\n".join(lines)
 
-def render_board_week(schedules):
+@metrics.timed("render_seconds")
+def render_board_week(schedules, names=None, matrix=None):
     """今日から7日間のボードを表示（noteがある日付も表示）"""
     lines = ["【在室ボード - 今週】"]
-    now = datetime.now(TZ)
     
     # 全ユーザーを収集
-    all_users = set()
-    for i in range(7):
-        date = now + timedelta(days=i)
-        date_key = date_to_key(date)
-        for user_name, user_schedule in schedules.items():
-            if date_key in user_schedule:
-                all_users.add(user_name)
+    rows = status_rows(schedules, 7, matrix)
     
-    if not all_users:
+    if not rows:
         lines.append("（まだ誰も登録していません）")
         return "\n".join(lines)
     
-    status_emoji = {
-        "in": "✅",
-        "pm": "🕒",
-        "out": "❌",
-        "home": "🏠",
-        "maybe": "🤔",
-        "trip": "✈️",
-        "will": "📅",
-        "can": "💡",
-    }
+    day_labels = [f"{d.day}({d.label})" for d in calendar().first(7)]
     
-    for user_name in sorted(all_users):
-        user_line = f"\n**{user_name}**"
-        user_schedule = schedules.get(user_name, {})
-        
-        day_parts = []
-        note_parts = []  # noteがある日付を記録
-        
-        for i in range(7):
-            date = now + timedelta(days=i)
-            date_key = date_to_key(date)
-            weekday = ["月", "火", "水", "木", "金", "土", "日"][date.weekday()]
-            
-            if date_key in user_schedule:
-                info = user_schedule[date_key]
-                status = info.get("status", "—")
-                note = info.get("note", "")
-                emoji = status_emoji.get(status, "➖")
-                day_parts.append(f"{date.day}({weekday}){emoji}")
-                
-                # noteがあれば記録
-                if note:
-                    note_parts.append(f"{date.day}({weekday}): {note}")
-            else:
-                day_parts.append(f"{date.day}({weekday})➖")
-        
-        lines.append(user_line)
-        lines.append("  " + " | ".join(day_parts))
+    labels = resolve_names(names, rows)
+    for user_key in sorted(rows, key=labels.get):
+        emojis, notes = rows[user_key]
+        lines.append(f"\n**{labels[user_key]}**")
+        lines.append("  " + " | ".join(label + emoji for label, emoji in zip(day_labels, emojis)))
         
         # noteがあれば表示
-        if note_parts:
-            lines.append("  📝 " + " | ".join(note_parts))
+        if notes:
+            lines.append("  📝 " + " | ".join(f"{day_labels[i]}: {note}" for i, note in notes))
     
     lines.append(f"\n最終更新: {datetime.now(TZ).strftime('%H:%M')}")
     return "\n".join(lines)
 
-app = App(token=os.environ["SLACK_BOT_TOKEN"])
-state = load_state()
+# ========== Slack API ゲートウェイ ==========
+# Slack Web API の呼び出しは全て slack_api(client).メソッド(...) を通す
+# - メソッドごとのトークンバケットで、レート制限の段階（Tier）を超えないよう先に待つ
+# - 429 が返ったら Retry-After だけそのメソッドを止めてから再試行（ジッター付き）
+# - 通信エラーは指数バックオフで再試行
+
+# メソッドごとの上限（1分あたりの呼び出し数）https://api.slack.com/docs/rate-limits
+SLACK_RATE_LIMITS = {
+    "chat_update": 50,            # Tier 3
+    "chat_delete": 50,            # Tier 3
+    "conversations_history": 50,  # Tier 3
+    "users_info": 100,            # Tier 4
+    "users_list": 20,             # Tier 2
+    "chat_postMessage": 60,       # 1チャンネルあたり毎秒1件
+    "chat_postEphemeral": 100,    # Tier 4
+    "pins_add": 20,               # Tier 2
+    "pins_remove": 20,            # Tier 2
+    "auth_test": 100,             # Tier 4
+}
+
+# 429・通信エラーのときの再試行回数
+SLACK_MAX_RETRIES = int(os.environ.get("SLACK_MAX_RETRIES", "3"))
+
+class TokenBucket:
+    """
+    1分あたりper_minute回のトークンバケット
+    reserve() はトークンを1つ予約し、呼び出しまでに待つべき秒数を返す
+    （待ち方は呼び出し側が決めるので、スレッドからもasyncioからも使える）
+    """
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1, per_minute // 10)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """Retry-After などで、これから seconds 秒はトークンを出さない"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+def retry_after(error):
+    """429 なら Retry-After の秒数、それ以外はNone"""
+    if isinstance(error, SlackApiError) and error.response.status_code == 429:
+        return header_seconds(error.response.headers, "Retry-After", 1)
+    return None
+
+def header_seconds(headers, name, default):
+    """ヘッダーの秒数（名前は大文字小文字を区別しない、値がリストなら先頭、読めなければdefault）"""
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            if isinstance(value, (list, tuple)):
+                value = value[0] if value else default
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return default
+    return default
+
+def is_retryable(error):
+    """再試行すれば通る見込みのあるエラーか（レート制限・通信エラー）"""
+    return retry_after(error) is not None or isinstance(error, (OSError, TimeoutError))
+
+class SlackGateway:
+    """Slack Web API 呼び出しのレート制御・再試行とメソッドごとの集計"""
+
+    def __init__(self, limits=SLACK_RATE_LIMITS, max_retries=SLACK_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._buckets = {method: TokenBucket(per_minute) for method, per_minute in limits.items()}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _count(self, method, key, amount=1):
+        with self._lock:
+            counters = self._counters.setdefault(
+                method, {"calls": 0, "throttled": 0, "retried": 0, "failed": 0, "waited": 0.0}
+            )
+            counters[key] += amount
+
+    def stats(self):
+        """メソッドごとの calls / throttled（429の回数）/ retried / failed / waited（待った秒数）"""
+        with self._lock:
+            return {method: dict(counters) for method, counters in self._counters.items()}
+
+    def _reserve(self, method):
+        bucket = self._buckets.get(method)
+        wait = bucket.reserve() if bucket else 0.0
+        if wait > 0:
+            self._count(method, "waited", wait)
+        return wait
+
+    def _backoff(self, method, error, attempt):
+        """再試行するなら待つ秒数、しないならNone"""
+        if attempt >= self.max_retries or not is_retryable(error):
+            self._count(method, "failed")
+            return None
+        seconds = retry_after(error)
+        if seconds is not None:
+            self._count(method, "throttled")
+            bucket = self._buckets.get(method)
+            if bucket:
+                bucket.pause(seconds)
+            delay = random.uniform(0, 1)
+            if not bucket:
+                delay += seconds
+        else:
+            delay = min(30, 2 ** attempt) * random.uniform(0.5, 1)
+        self._count(method, "retried")
+        log.warning("[SlackGateway] %s failed (%s), retry %s/%s", method, error, attempt + 1, self.max_retries)
+        return delay
+
+    def call(self, client, method, **kwargs):
+        with metrics.timer("slack_call_seconds", method=method):
+            return self._call(client, method, **kwargs)
+
+    def _call(self, client, method, **kwargs):
+        attempt = 0
+        while True:
+            wait = self._reserve(method)
+            if wait > 0:
+                time.sleep(wait)
+            self._count(method, "calls")
+            try:
+                return getattr(client, method)(**kwargs)
+            except Exception as e:
+                delay = self._backoff(method, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def call_async(self, client, method, **kwargs):
+        with metrics.timer("slack_call_seconds", method=method):
+            return await self._call_async(client, method, **kwargs)
+
+    async def _call_async(self, client, method, **kwargs):
+        attempt = 0
+        while True:
+            wait = self._reserve(method)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._count(method, "calls")
+            try:
+                return await getattr(client, method)(**kwargs)
+            except Exception as e:
+                delay = self._backoff(method, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+slack_gateway = SlackGateway()
+metrics.register("slack", slack_gateway.stats, label="method")
+
+class SlackApi:
+    """WebClient / AsyncWebClient のメソッド呼び出しを slack_gateway 経由にするラッパー"""
+
+    def __init__(self, client, gateway):
+        self._client = client
+        self._gateway = gateway
+
+    def __getattr__(self, method):
+        if asyncio.iscoroutinefunction(getattr(self._client, method)):
+            return functools.partial(self._gateway.call_async, self._client, method)
+        return functools.partial(self._gateway.call, self._client, method)
+
+def slack_api(client):
+    return SlackApi(client, slack_gateway)
+
+# SLACK_OFFLINE=1 では起動時に auth.test でトークンを確かめない（ベンチマーク・テストをSlackにつながずに動かす用）
+SLACK_OFFLINE = os.environ.get("SLACK_OFFLINE", "0") == "1"
+
+app = App(token=os.environ["SLACK_BOT_TOKEN"], token_verification_enabled=not SLACK_OFFLINE)
+
+# 1回に眠る最大秒数（壁時計を見直して、時計の補正やスリープ復帰で0時を過ぎていないか確かめる間隔）
+ROLLOVER_MAX_SLEEP = float(os.environ.get("ROLLOVER_MAX_SLEEP", "60"))
+
+def next_midnight(day: date) -> datetime:
+    """dayの翌日のJSTの0時"""
+    return calendar().day(day.toordinal() + 1).dt
+
+class MidnightScheduler:
+    """
+    JSTの0時ちょうどに on_rollover を呼ぶ
+    - 0時までの残りを壁時計から計算し直しながら最大 max_sleep 秒ずつ眠る
+    - 眠っている間に日付が変わっていれば（スリープ復帰など）すぐに呼ぶ
+    - 予定の0時からどれだけ遅れて呼んだかを stats() で返す
+    """
+
+    def __init__(self, on_rollover, max_sleep=ROLLOVER_MAX_SLEEP, on_wake=None):
+        self.on_rollover = on_rollover
+        self.on_wake = on_wake  # 眠りから覚めるたびに呼ぶ（テナントの掃除など）
+        self.max_sleep = max_sleep
+        self._lock = threading.Lock()
+        self.rollovers = 0
+        self.failed = 0
+        self.lateness_last = 0.0  # 予定の0時から実際に呼ぶまでの遅れ（秒）
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rollovers": self.rollovers,
+                "failed": self.failed,
+                "lateness_last_ms": self.lateness_last * 1000,
+                "lateness_avg_ms": self.lateness_total / self.rollovers * 1000 if self.rollovers else 0.0,
+                "lateness_max_ms": self.lateness_max * 1000,
+            }
+
+    def run(self):
+        now = datetime.now(TZ)
+        current_date = now.date()
+        log.info("[MidnightScheduler] Started. Current date: %s, next rollover at %s", current_date, next_midnight(current_date))
+        while True:
+            try:
+                now = datetime.now(TZ)
+                if now.date() > current_date:
+                    self._fire(next_midnight(current_date), now)
+                    current_date = now.date()
+                    continue
+                if now.date() < current_date:
+                    # 時計が巻き戻った場合は、その日付の0時を待ち直す
+                    log.info("[MidnightScheduler] Clock moved back to %s", now.date())
+                    current_date = now.date()
+                remaining = (next_midnight(current_date) - now).total_seconds()
+                time.sleep(min(remaining, self.max_sleep))
+                if self.on_wake is not None:
+                    self.on_wake()
+            except Exception as e:
+                log.warning("[MidnightScheduler] Error: %s", e)
+                time.sleep(self.max_sleep)
+
+    def _fire(self, scheduled, now):
+        lateness = (now - scheduled).total_seconds()
+        log.info("[MidnightScheduler] Date changed to %s (%.0fms after %s)", now.date(), lateness * 1000, scheduled)
+        try:
+            self.on_rollover()
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            log.warning("[MidnightScheduler] Rollover failed: %s", e)
+        with self._lock:
+            self.rollovers += 1
+            self.lateness_last = lateness
+            self.lateness_total += lateness
+            self.lateness_max = max(self.lateness_max, lateness)
+
+def midnight_rollover():
+    """0時の処理: 全てのボードで過去の日付を削除し、ステータス行列の窓をずらしてボードを更新する"""
+    if not is_leader():
+        # 過去の日付の削除とボードの更新はリーダーが行う（書き込みは refresh() で取り込む）
+        for tenant in tenants.loaded():
+            with tenant.active():
+                store.roll_matrix()
+        return
+    for tenant in tenants.all():
+        if tenant.key is not None and not tenant.has_board():
+            continue
+        with tenant.active():
+            try:
+                removed = cleanup_old_dates()
+                store.roll_matrix()
+                request_board_update(app.client, "date changed")
+                log.debug("[midnight_rollover] %s: removed %s old entries, board update requested", tenant, removed)
+            except Exception as e:
+                log.warning("[midnight_rollover] %s: failed: %s", tenant, e)
+
+midnight_scheduler = MidnightScheduler(midnight_rollover, on_wake=tenants.evict_idle)
+metrics.register("rollover", midnight_scheduler.stats)
 
 def date_change_checker():
     """
     日付が変わったときに自動的にボードを更新するバックグラウンドタスク
     """
-    last_date = datetime.now(TZ).date()
-    debug_log(f"[date_change_checker] Started. Current date: {last_date}")
-    
-    while True:
-        try:
-            time.sleep(3600)  # 1時間ごとにチェック
-            current_date = datetime.now(TZ).date()
-            
-            if current_date != last_date:
-                debug_log(f"[date_change_checker] Date changed: {last_date} -> {current_date}")
-                last_date = current_date
-                
-                # クライアントを取得してボードを更新
-                try:
-                    update_board_message(app.client)
-                    debug_log(f"[date_change_checker] Board updated successfully")
-                except Exception as e:
-                    debug_log(f"[date_change_checker] Failed to update board: {e}")
-        except Exception as e:
-            debug_log(f"[date_change_checker] Error: {e}")
-            time.sleep(3600)
+    midnight_scheduler.run()
 
 def cleanup_old_dates():
     """過去の日付を削除"""
-    today = datetime.now(TZ).date()
-    removed_count = 0
-    debug_log(f"[cleanup_old_dates] Today is {today}")
-    
-    for user_name in list(state["schedules"].keys()):
-        user_schedule = state["schedules"][user_name]
-        for date_key in list(user_schedule.keys()):
-            try:
-                date_obj = datetime.strptime(date_key, "%Y-%m-%d").date()
-                debug_log(f"[cleanup_old_dates] Checking {user_name} {date_key}: date_obj={date_obj}, today={today}, is_old={date_obj < today}")
-                if date_obj < today:
-                    debug_log(f"[cleanup_old_dates] Removing old date: {user_name} {date_key}")
-                    del user_schedule[date_key]
-                    removed_count += 1
-            except Exception as e:
-                debug_log(f"[cleanup_old_dates] Error parsing date {date_key}: {e}")
-        
-        # スケジュールが空になったユーザーを削除
-        if not user_schedule:
-            del state["schedules"][user_name]
+    today = today_key()
+    log.debug("[cleanup_old_dates] Today is %s", today)
     
+    removed_count = commit_record({"op": "expire", "before": today})
+    metrics.count("cleanups_total")
+    metrics.count("cleaned_entries_total", removed_count)
     if removed_count > 0:
-        debug_log(f"Cleaned up {removed_count} old entries")
-        save_state(state)
+        log.info("Cleaned up %s old entries", removed_count)
     
     return removed_count
 
-def ensure_board_message(client):
-    ch = state["board_message"]["channel"]
-    ts = state["board_message"]["ts"]
+def ensure_board_message(client, snapshot=None):
+    board_message = (snapshot or store.snapshot()).board_message
+    ch = board_message["channel"]
+    ts = board_message["ts"]
     if ch and ts:
         return ch, ts
     return None, None
 
-def update_board_message(client, skip_cleanup=False):
-    """ボードメッセージを更新（今日と今週を表示）"""
+def board_window():
+    """ピン留めボードに表示される日付の範囲 (start_key, end_key)（今日から7日間）"""
+    window = calendar()
+    return window.today_key, window.key_after(6)
+
+def record_touches_board(record):
+    """変更レコードがピン留めボードの表示範囲に触れるかどうか"""
+    if record["op"] == "expire":
+        # 過去の日付しか消さないので表示は変わらない
+        return False
+    start, end = board_window()
+    if "dates" in record:
+        return any(start <= date_key <= end for date_key in record["dates"])
+    if "start" in record:
+        return record["start"] <= end and start <= record["end"]
+    return True
+
+# ボードを何通のメッセージに分けるか（/setup のときに使う。分けた後の構成は state["board_message"] に残る）
+BOARD_SHARDS = max(int(os.environ.get("BOARD_SHARDS", "1")), 1)
+
+def board_shards(board_message):
+    """
+    ボードのメッセージの一覧 [{"ts": ..., "from": ...}]（シャード分割していなければ1通）
+    シャードiには、表示名（casefold）が shards[i]["from"] 以上・shards[i+1]["from"] 未満のユーザーを載せる
+    """
+    return board_message.get("shards") or [{"ts": board_message.get("ts"), "from": ""}]
+
+def shard_of(shards, label):
+    """表示名がどのシャードに載るか"""
+    froms = [shard["from"] for shard in shards]
+    return max(bisect.bisect_right(froms, label.casefold()) - 1, 0)
+
+def plan_board_shards(schedules, names, count=BOARD_SHARDS):
+    """
+    今いるユーザーを表示名の順にcount通へほぼ同じ人数ずつ分ける境界を決める（誰もいなければアルファベットで分ける）
+    人数がcountより少ない・同じ表示名が続くときは、空のシャードができないよう通数を減らす
+    """
+    labels = sorted(label.casefold() for label in resolve_names(names, schedules.keys()).values())
+    population = labels or list("abcdefghijklmnopqrstuvwxyz")
+    count = min(count, len(population))
+    froms = [""]
+    previous = population[0]  # 先頭のシャードには一番前のユーザーが載る
+    for i in range(1, count):
+        label = population[i * len(population) // count]
+        if label > previous:
+            froms.append(label)
+            previous = label
+    return [{"ts": None, "from": label} for label in froms]
+
+@metrics.timed("render_seconds")
+def render_board_shards(schedules, board_message, names=None, matrix=None, users=None):
+    """
+    ボードのメッセージごとの (ts, 本文) のリストを返す
+    usersを渡した場合は、そのユーザーが載るシャードだけを描画する
+    """
+    shards = board_shards(board_message)
+    with reading(schedules):
+        if len(shards) == 1:
+            return [(shards[0]["ts"], render_board_message(schedules, names, matrix))]
+
+        users_in_board = schedules.keys()
+        labels = resolve_names(names, set(users_in_board) | set(users or ()))
+        members = [[] for _ in shards]
+        for user in users_in_board:
+            members[shard_of(shards, labels[user])].append(user)
+        targets = range(len(shards)) if users is None else sorted({shard_of(shards, labels[user]) for user in users})
+
+        resolved = lambda keys: {key: labels.get(key, key) for key in keys}
+        result = []
+        for i in targets:
+            # シャードは人数が少ないので、行列を使わずにそのユーザーの予定から直接描画する
+            sub = {user: schedules[user] for user in members[i]}
+            result.append((shards[i]["ts"], f"📋 {i + 1}/{len(shards)}\n{render_board_message(sub, resolved)}"))
+        return result
+
+# 最後に反映したボード本文のハッシュ {ts: digest}（同じ内容なら chat.update しない）
+_published_board = {}
+
+# 最後に全てのシャードを反映したときの表示名の世代 {先頭のts: generation}
+_published_generation = {}
+
+def board_update_users(board_message, users):
+    """
+    ボード更新で描画するユーザー（Noneなら全体）
+    前に全体を反映してから表示名が変わっていたら、ユーザーが別のシャードへ移ったかもしれないので全体にする
+    """
+    if users is not None and _published_generation.get(board_message.get("ts")) != user_directory.generation:
+        return None
+    return users
+
+def mark_board_published(board_message, users, generation):
+    """ボード更新を反映し終えたことを記録する（全体を反映したときだけ表示名の世代を覚える）"""
+    if users is None:
+        _published_generation[board_message.get("ts")] = generation
+
+def board_digest(text):
+    """末尾の「最終更新」の行を除いたボード本文のハッシュ"""
+    body = LAST_UPDATED_PATTERN.sub("", text, count=1)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def board_unchanged(ts, digest):
+    return _published_board.get(ts) == digest
+
+@metrics.timed("render_seconds")
+def render_board_message(schedules, names=None, matrix=None):
+    """ピン留めボードの本文（今日と今週）"""
+    return f"{render_board(schedules, names=names)}\n\n{render_board_week(schedules, names=names, matrix=matrix)}"
+
+@metrics.timed("board_update_seconds")
+def update_board_message(client, skip_cleanup=False, force=False, users=None):
+    """
+    ボードメッセージを更新（今日と今週を表示）し、やり直しが必要ならFalseを返す
+    usersを渡した場合は、そのユーザーが載るシャードだけを更新する
+    """
     try:
         ch, ts = ensure_board_message(client)
         if not (ch and ts):
-            debug_log("[update_board_message] No board message found, skipping update")
-            return
+            log.debug("[update_board_message] No board message found, skipping update")
+            return True
         
         # クリーンアップ（skip_cleanup=Trueの場合はスキップ）
         if not skip_cleanup:
             cleanup_old_dates()
         
-        # 今日と今週を表示
-        today_board = render_board(state["schedules"])
-        week_board = render_board_week(state["schedules"])
-        
-        text = f"{today_board}\n\n{week_board}"
-        debug_log(f"[update_board_message] Updating board in channel={ch}")
-        client.chat_update(channel=ch, ts=ts, text=text)
-        debug_log("[update_board_message] Board updated successfully")
+        # 今日と今週を表示（同じスナップショットから描画する）
+        snapshot = store.snapshot()
+        generation = user_directory.generation
+        users = board_update_users(snapshot.board_message, users)
+        for ts, text in render_board_shards(
+            snapshot.schedules, snapshot.board_message, name_resolver(client), snapshot.matrix, users
+        ):
+            digest = board_digest(text)
+            if not force and board_unchanged(ts, digest):
+                log.debug("[update_board_message] Board content unchanged, skipping update: ts=%s", ts)
+                metrics.count("board_updates_total", result="unchanged")
+                continue
+            
+            log.debug("[update_board_message] Updating board in channel=%s, ts=%s", ch, ts)
+            slack_api(client).chat_update(channel=ch, ts=ts, text=text)
+            _published_board[ts] = digest
+            metrics.count("board_updates_total", result="updated")
+        mark_board_published(snapshot.board_message, users, generation)
+        log.debug("[update_board_message] Board updated successfully")
+        return True
     except Exception as e:
-        debug_log(f"[update_board_message] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("[update_board_message] ERROR: %s", e)
+        metrics.count("board_updates_total", result="failed")
+        # レート制限・通信エラーならFalse（パブリッシャーがあとでやり直す）
+        return not is_retryable(e)
+
+# ボード更新の間引き: 更新間隔の最小値（秒）と、最初の変更から反映までの上限（秒）
+BOARD_PUBLISH_WINDOW = float(os.environ.get("BOARD_PUBLISH_WINDOW", "2"))
+BOARD_PUBLISH_MAX_DELAY = float(os.environ.get("BOARD_PUBLISH_MAX_DELAY", "10"))
+
+class BoardPublisher:
+    """
+    ボード更新の要求をまとめて chat.update するバックグラウンドスレッド
+    - 更新はwindow秒に最大1回（要求が続く間は静かになるまで待つ）
+    - 最初の要求からmax_delay秒経ったら、要求が続いていても反映する
+    - 反映時点の最新stateを描画するので、途中の状態は捨てられる
+    """
+
+    def __init__(self, client, window=BOARD_PUBLISH_WINDOW, max_delay=BOARD_PUBLISH_MAX_DELAY, tenant=None):
+        self.client = client
+        self.tenant = tenant or current_tenant()
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self.coalesced = 0  # まとめられた（個別には反映しなかった）要求の数
+        self.published = 0
+        self._cond = threading.Condition()
+        self._dirty_since = None
+        self._dirty_users = set()  # 変更のあったユーザー（Noneならボード全体）
+        self._last_request = 0.0
+        self._last_publish = 0.0
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="board-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """更新待ちがなくなったらスレッドを終える（テナントをメモリから外すとき）"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def idle(self):
+        """反映待ちの更新要求がないか"""
+        with self._cond:
+            return self._dirty_since is None
+
+    def mark_dirty(self, reason="", users=None):
+        """ボード更新を要求する（usersを渡したらそのユーザーが載るシャードだけ、Noneなら全体）"""
+        with self._cond:
+            self._record_request(users)
+            self._cond.notify()
+        log.debug("[BoardPublisher] dirty: %s", reason)
+
+    def _record_request(self, users=None):
+        """更新要求を記録する（self._condを保持した状態で呼ぶ）"""
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+            self._dirty_users = set()
+        else:
+            self.coalesced += 1
+        if users is None or self._dirty_users is None:
+            self._dirty_users = None
+        else:
+            self._dirty_users.update(users)
+        self._last_request = now
+
+    def _take_dirty(self):
+        """反映する分の要求を取り出す（self._condを保持した状態で呼ぶ）"""
+        self._dirty_since = None
+        users, self._dirty_users = self._dirty_users, set()
+        return users
+
+    def _due(self):
+        """次に反映してよい時刻（self._condを保持した状態で呼ぶ）"""
+        quiet_at = self._last_request + self.window
+        deadline = self._dirty_since + self.max_delay
+        return max(min(quiet_at, deadline), self._last_publish + self.window)
+
+    def _wait_until_due(self):
+        """次に反映してよい時刻まで待つ（self._condを保持した状態で呼ぶ）"""
+        while True:
+            wait = self._due() - time.monotonic()
+            if wait <= 0:
+                return
+            self._cond.wait(wait)
+
+    def _run(self):
+        with self.tenant.active():
+            self._publish_forever()
+
+    def _publish_forever(self):
+        while True:
+            with self._cond:
+                while self._dirty_since is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                self._wait_until_due()
+                users = self._take_dirty()
+
+            if update_board_message(self.client, users=users):
+                self.published += 1
+            else:
+                self.mark_dirty("retry after failure", users)
+            self._last_publish = time.monotonic()
+            log.debug("[BoardPublisher] published=%s, coalesced=%s", self.published, self.coalesced)
+
+def request_board_update(client, reason="", record=None, force=False):
+    """
+    ボード更新を要求する（パブリッシャーが動いていなければその場で更新）
+    recordを渡した場合、ボードの表示範囲外だけを変更したなら何もしない
+    forceなら本文が前回と同じでも chat.update する（/update）
+    リーダーでなければ leader.db に書いてリーダーに頼む
+    """
+    if record is not None and not record_touches_board(record):
+        log.debug("[request_board_update] Outside visible window, skipping: %s", reason)
+        return
+    if not is_leader():
+        log.debug("[request_board_update] Not the leader, asking it to update: %s", reason)
+        board_requests.add(current_tenant(), force)
+        return
+    if force:
+        for shard in board_shards(store.snapshot().board_message):
+            _published_board.pop(shard["ts"], None)
+    users = records_users(record) if record is not None and record["op"] != "expire" else None
+    board_publisher = current_tenant().board_publisher()
+    if board_publisher is not None and board_publisher.running:
+        board_publisher.mark_dirty(reason, users)
+    else:
+        update_board_message(client, users=users)
+
+# ジョブキューの上限（これを超える変更はコマンドの応答時点で断る）
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "100"))
+
+BUSY_MESSAGE = "⏳ 混み合っています。少し待ってからもう一度実行してください"
+
+class JobQueue:
+    """
+    stateを変更するジョブを1本のワーカースレッドで順に実行する有界キュー
+    - コマンドはパースと検証だけしてすぐ ack し、保存やボード更新はジョブとして渡す
+    - キューが満杯なら submit は None を返す（呼び出し側が「混み合っています」と返す）
+    - ワーカーが動いていなければ submit した場で実行する（sync_board.py やテスト用）
+    """
+
+    def __init__(self, max_size=JOB_QUEUE_SIZE):
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.wait_total = 0.0  # キューで待った時間の合計（秒）
+        self.wait_max = 0.0
+        self.run_total = 0.0   # 実行にかかった時間の合計（秒）
+        self.run_max = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="job-queue", daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, name, func, *args, **kwargs):
+        """ジョブを積んで Future を返す（満杯ならNone）。ジョブは積んだ時点のテナントに対して実行する"""
+        job = (name, func, args, kwargs, Future(), time.monotonic(), contextvars.copy_context())
+        if not self.running:
+            with self._lock:
+                self.submitted += 1
+            self._execute(job)
+            return job[4]
+        # 積むのと深さの記録を同じロックの中で行う（同時に積まれても最大の深さを取りこぼさない）
+        with self._lock:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.rejected += 1
+                full = True
+            else:
+                self.submitted += 1
+                self.max_depth = max(self.max_depth, self._queue.qsize())
+                full = False
+        if full:
+            log.warning("[JobQueue] Queue full, rejected %s", name)
+            return None
+        return job[4]
+
+    def stats(self):
+        with self._lock:
+            done = self.completed + self.failed
+            return {
+                "depth": self._queue.qsize(),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_avg_ms": self.wait_total / done * 1000 if done else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+                "run_avg_ms": self.run_total / done * 1000 if done else 0.0,
+                "run_max_ms": self.run_max * 1000,
+            }
+
+    def _execute(self, job):
+        name, func, args, kwargs, future, enqueued_at, context = job
+        if not future.set_running_or_notify_cancel():
+            return
+        started = time.monotonic()
+        try:
+            result = context.run(func, *args, **kwargs)
+        except Exception as e:
+            ok = False
+            log.exception("[JobQueue] %s ERROR: %s", name, e)
+            future.set_exception(e)
+        else:
+            ok = True
+            future.set_result(result)
+        finished = time.monotonic()
+        wait, run = started - enqueued_at, finished - started
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.run_total += run
+            self.run_max = max(self.run_max, run)
+        log.debug("[JobQueue] %s wait=%.1fms run=%.1fms depth=%s", name, wait * 1000, run * 1000, self._queue.qsize())
+
+    def _run(self):
+        while True:
+            self._execute(self._queue.get())
+
+job_queue = JobQueue()
+metrics.register("job_queue", job_queue.stats)
+
+# SlackのユーザーIDの形（schedulesのキー、"UEDA" のような名前も当てはまるので移行の判定には users.list を使う）
+USER_ID_PATTERN = re.compile(r"[UW][A-Z0-9]{2,}")
+
+# ユーザー名キャッシュの有効期限（秒）と最大件数
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "21600"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "5000"))
+
+def profile_name(user):
+    """users.info / users.list / user_change のユーザー情報から表示名を取り出す"""
+    prof = user.get("profile", {})
+    return prof.get("display_name") or prof.get("real_name") or user["id"]
+
+class UserDirectory:
+    """
+    user_id → 表示名 のキャッシュ（TTL + LRU）
+    起動時に users.list で一括取得し、user_change イベントで個別に入れ替える
+    """
+
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # 表示名が変わるたびに増える（描画キャッシュのキーに使う）
+        self._entries = OrderedDict()  # user_id -> (name, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """キャッシュにある表示名を返す（なければNone）"""
+        with self._lock:
+            name = self._peek(user_id)
+            if name is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return name
+
+    def _peek(self, user_id):
+        """ヒット・ミスを数えずにキャッシュを引く（self._lockを保持した状態で呼ぶ）"""
+        item = self._entries.get(user_id)
+        if item is None or item[1] < time.monotonic():
+            return None
+        self._entries.move_to_end(user_id)
+        return item[0]
+
+    def put(self, user_id, name):
+        with self._lock:
+            old = self._entries.get(user_id)
+            if old is None or old[0] != name:
+                self.generation += 1
+            self._entries[user_id] = (name, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.generation += 1
+
+    def lookup(self, client, user_id):
+        """表示名を返す（キャッシュになければ users.info で取得）"""
+        name = self.get(user_id)
+        if name is None:
+            name = profile_name(slack_api(client).users_info(user=user_id)["user"])
+            self.put(user_id, name)
+        return name
+
+    def lookup_each(self, client, user_ids):
+        """
+        複数ユーザーの表示名を返す（user_idでないキーや取得できないユーザーはそのまま）
+        キャッシュにないユーザーは1人ずつ users.info で取得する（まとめて取るには先に warm / async_prefetch_names を使う）
+        """
+        result = {}
+        for user_id in user_ids:
+            name = self.get(user_id)
+            if name is None and USER_ID_PATTERN.fullmatch(user_id):
+                try:
+                    name = self.lookup(client, user_id)
+                except Exception as e:
+                    log.warning("[UserDirectory] Failed to look up %s: %s", user_id, e)
+            result[user_id] = name or user_id
+        return result
+
+    def missing(self, user_ids):
+        """キャッシュにない（users.info で取得が必要な）user_idのリスト"""
+        return [user_id for user_id in user_ids
+                if USER_ID_PATTERN.fullmatch(user_id) and self.get(user_id) is None]
+
+    def cached_many(self, user_ids):
+        """キャッシュだけで表示名を解決する（ないものはキーのまま、APIは呼ばない）"""
+        with self._lock:
+            return {user_id: self._peek(user_id) or user_id for user_id in user_ids}
+
+    def ids_by_name(self):
+        """表示名 → user_id（キャッシュ済みのユーザーのみ、同じ表示名が複数いる名前は含めない）"""
+        with self._lock:
+            owners = {}
+            for user_id, (name, _) in self._entries.items():
+                owners.setdefault(name, []).append(user_id)
+        result = {}
+        for name, user_ids in owners.items():
+            if len(user_ids) > 1:
+                log.warning("[UserDirectory] Display name '%s' is shared by %s, skipping", name, ", ".join(user_ids))
+                continue
+            result[name] = user_ids[0]
+        return result
+
+    def warm(self, client):
+        """users.list を全ページ取得してキャッシュを埋める（取得したuser_idの集合を返す）"""
+        cursor = None
+        user_ids = set()
+        while True:
+            resp = slack_api(client).users_list(limit=200, cursor=cursor)
+            for member in resp.get("members", []):
+                self.put(member["id"], profile_name(member))
+                user_ids.add(member["id"])
+            cursor = resp.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+        log.info("[UserDirectory] Warmed with %s user(s)", len(user_ids))
+        return user_ids
+
+    async def warm_async(self, client):
+        """warm の AsyncWebClient 版"""
+        cursor = None
+        user_ids = set()
+        while True:
+            resp = await slack_api(client).users_list(limit=200, cursor=cursor)
+            for member in resp.get("members", []):
+                self.put(member["id"], profile_name(member))
+                user_ids.add(member["id"])
+            cursor = resp.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+        log.info("[UserDirectory] Warmed with %s user(s)", len(user_ids))
+        return user_ids
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "generation": self.generation}
+
+user_directory = UserDirectory()
+metrics.register("user_directory", user_directory.stats)
 
 def user_name(client, user_id):
-    prof = client.users_info(user=user_id)["user"]["profile"]
-    return prof.get("display_name") or prof.get("real_name") or user_id
+    return user_directory.lookup(client, user_id)
+
+def name_resolver(client):
+    """レンダラーに渡す表示名の一括解決関数"""
+    return lambda keys: user_directory.lookup_each(client, keys)
+
+def migrate_schedule_keys(data, client):
+    """
+    表示名をキーにした古いschedulesを user_id キーに付け替える
+    キーが user_id かどうかは形ではなく users.list の結果で判定する（"UEDA" のような名前も user_id の形に見えるため）
+    """
+    if data["schedules"]:
+        if client is None:
+            log.info("[migrate_schedule_keys] No Slack client, postponing migration of %s user(s)", len(data["schedules"]))
+            return
+        try:
+            known_ids = user_directory.warm(client)
+        except Exception as e:
+            log.warning("[migrate_schedule_keys] Failed to fetch users, postponing migration: %s", e)
+            return
+        legacy = [key for key in data["schedules"] if key not in known_ids]
+        ids_by_name = user_directory.ids_by_name()
+        for name in legacy:
+            user_id = ids_by_name.get(name)
+            if user_id is None:
+                # 退職者など解決できない名前はそのまま残す（表示はキーのまま）
+                log.warning("[migrate_schedule_keys] Could not resolve '%s', keeping as is", name)
+                continue
+            apply_record(data["schedules"], {"op": "rename", "user": name, "to": user_id})
+            log.debug("[migrate_schedule_keys] %s -> %s", name, user_id)
+    data["key_format"] = "user_id"
+    save_state(data)
+
+@app.event("user_change")
+def on_user_change(event):
+    """表示名の変更をキャッシュに反映"""
+    user = event["user"]
+    user_directory.invalidate(user["id"])
+    user_directory.put(user["id"], profile_name(user))
+    log.debug("[user_change] %s -> %s", user['id'], profile_name(user))
 
 def normalize_note(text: str) -> str:
     return (text or "").strip()
@@ -497,490 +2899,278 @@ def normalize_note(text: str) -> str:
 def set_status_for_dates(client, user_id, status, dates: List[datetime], note: str = ""):
     """指定した日付にステータスを設定"""
     try:
-        name = user_name(client, user_id)
-        debug_log(f"[set_status_for_dates] user={name}, status={status}, dates_count={len(dates)}")
+        log.debug("[set_status_for_dates] user=%s, status=%s, dates_count=%s", user_id, status, len(dates))
         
-        if name not in state["schedules"]:
-            state["schedules"][name] = {}
+        date_keys = [date_to_key(date) for date in dates]
+        record = {"op": "set", "user": user_id, "dates": date_keys, "status": status, "note": note}
+        commit_record(record)
+        log.debug("  Set %s %s = %s (%s)", user_id, date_keys, status, note)
         
-        for date in dates:
-            date_key = date_to_key(date)
-            state["schedules"][name][date_key] = {
-                "status": status,
-                "note": note
-            }
-            debug_log(f"  Set {name} {date_key} = {status} ({note})")
-        
-        save_state(state)
-        debug_log("[set_status_for_dates] State saved")
-        update_board_message(client)
-        debug_log("[set_status_for_dates] Complete")
+        log.debug("[set_status_for_dates] State saved")
+        request_board_update(client, f"set {user_id}", record)
+        log.debug("[set_status_for_dates] Complete")
     except Exception as e:
-        debug_log(f"[set_status_for_dates] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("[set_status_for_dates] ERROR: %s", e)
         raise
 
+def setup_board(client, channel_id):
+    """在室ボードを投稿してピン留めする（前のボードはピン留めを外す、BOARD_SHARDS通に分けて投稿する）"""
+    # If a previous board message is known, unpin it (best-effort).
+    snapshot = store.snapshot()
+    prev_ch = snapshot.board_message.get("channel")
+    if prev_ch and snapshot.board_message.get("ts"):
+        for shard in board_shards(snapshot.board_message):
+            try:
+                slack_api(client).pins_remove(channel=prev_ch, timestamp=shard["ts"])
+            except Exception:
+                # Ignore failures (e.g., message deleted, missing permissions, etc.)
+                pass
+
+    # Create new board messages and pin them
+    names = name_resolver(client)
+    with reading(snapshot.schedules):
+        shards = plan_board_shards(snapshot.schedules, names)
+        board_message = {"channel": channel_id, "ts": None, "shards": shards}
+        rendered = render_board_shards(snapshot.schedules, board_message, names, snapshot.matrix)
+    for shard, (_, text) in zip(shards, rendered):
+        msg = slack_api(client).chat_postMessage(channel=channel_id, text=text)
+        shard["ts"] = msg["ts"]
+        slack_api(client).pins_add(channel=channel_id, timestamp=shard["ts"])
+        _published_board[shard["ts"]] = board_digest(text)
+    store.set_board_message(channel_id, shards[0]["ts"], shards if len(shards) > 1 else None)
+
+SETUP_DONE_MESSAGE = "在室ボードを作成してピン留めしました。以降 /in /out /pm /home /note /maybe /trip /will /can /clear で更新できます。"
+
+def reply_when_done(future, respond, reply):
+    """ジョブの完了後に response_url で結果を返す"""
+    def done(f):
+        try:
+            respond(reply(f.result()))
+        except Exception as e:
+            respond(f"⚠️ エラーが発生しました: {str(e)}")
+    future.add_done_callback(done)
+
 @app.command("/setup")
-def setup(ack, body, client):
+@command_handler
+def setup(ack, body, client, respond):
     if not is_admin(body["user_id"]):
         ack("⚠️ このコマンドは管理者のみ実行できます")
         return
 
+    future = job_queue.submit("/setup", setup_board, client, body["channel_id"])
+    if future is None:
+        ack(BUSY_MESSAGE)
+        return
     ack("在室ボードをセットアップ中...")
-    channel_id = body["channel_id"]
-
-    # If a previous board message is known, unpin it (best-effort).
-    prev_ch = state.get("board_message", {}).get("channel")
-    prev_ts = state.get("board_message", {}).get("ts")
-    if prev_ch and prev_ts:
-        try:
-            client.pins_remove(channel=prev_ch, timestamp=prev_ts)
-        except Exception:
-            # Ignore failures (e.g., message deleted, missing permissions, etc.)
-            pass
-
-    # Create a new board message and pin it
-    text = f"{render_board(state['schedules'])}\n\n{render_board_week(state['schedules'])}"
-    msg = client.chat_postMessage(channel=channel_id, text=text)
-    ts = msg["ts"]
-    client.pins_add(channel=channel_id, timestamp=ts)
-    state["board_message"] = {"channel": channel_id, "ts": ts}
-    save_state(state)
-    ack("在室ボードを作成してピン留めしました。以降 /in /out /pm /home /note /maybe /trip /will /can /clear で更新できます。")
-
-@app.command("/in")
-def cmd_in(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/in] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=False)
-        debug_log(f"[/in] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"✅ in にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"✅ in にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "in", dates, note)
-        debug_log(f"[/in] success")
-    except Exception as e:
-        debug_log(f"[/in] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
-
-@app.command("/out")
-def cmd_out(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/out] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=False)
-        debug_log(f"[/out] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"❌ out にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"❌ out にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "out", dates, note)
-        debug_log(f"[/out] success")
-    except Exception as e:
-        debug_log(f"[/out] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
-
-@app.command("/pm")
-def cmd_pm(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/pm] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=False)
-        debug_log(f"[/pm] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"🕒 pm にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"🕒 pm にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "pm", dates, note)
-        debug_log(f"[/pm] success")
-    except Exception as e:
-        debug_log(f"[/pm] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
-
-@app.command("/home")
-def cmd_home(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/home] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=False)
-        debug_log(f"[/home] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"🏠 home にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"🏠 home にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "home", dates, note)
-        debug_log(f"[/home] success")
-    except Exception as e:
-        debug_log(f"[/home] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
+    reply_when_done(future, respond, lambda _: SETUP_DONE_MESSAGE)
 
-@app.command("/maybe")
-def cmd_maybe(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/maybe] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=True)
-        debug_log(f"[/maybe] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"🤔 maybe にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"🤔 maybe にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "maybe", dates, note)
-        debug_log(f"[/maybe] success")
-    except Exception as e:
-        debug_log(f"[/maybe] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
+# ステータスコマンド: ステータス → (絵文字, 日付指定を許可するか)
+STATUS_COMMANDS = {
+    "in": ("✅", False),
+    "out": ("❌", False),
+    "pm": ("🕒", False),
+    "home": ("🏠", False),
+    "maybe": ("🤔", True),
+    "trip": ("✈️", True),
+    "will": ("📅", True),
+    "can": ("💡", True),
+}
 
-@app.command("/trip")
-def cmd_trip(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/trip] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=True)
-        debug_log(f"[/trip] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"✈️ trip にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"✈️ trip にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "trip", dates, note)
-        debug_log(f"[/trip] success")
-    except Exception as e:
-        debug_log(f"[/trip] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
+def parse_status_command(status, text):
+    """ステータスコマンドの引数をパースして (日付リスト, note, 返信メッセージ) を返す"""
+    emoji, allow_date = STATUS_COMMANDS[status]
+    dates, note = parse_command_text(text, allow_weekday=True, allow_date=allow_date)
+    log.debug("[/%s] parsed: dates=%s, note='%s'", status, LazyDates(dates), note)
+    
+    date_strs = [d.strftime("%m/%d") for d in dates]
+    if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
+        msg = f"{emoji} {status} にしました" + (f"（{note}）" if note else "")
+    else:
+        msg = f"{emoji} {status} にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
+    return dates, note, msg
 
-@app.command("/will")
-def cmd_will(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/will] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=True)
-        debug_log(f"[/will] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"📅 will にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"📅 will にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "will", dates, note)
-        debug_log(f"[/will] success")
-    except Exception as e:
-        debug_log(f"[/will] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
+def make_status_command(status):
+    """/in /out などのステータスコマンドのハンドラーを作る"""
+    def handler(ack, body, client):
+        try:
+            text = body.get("text", "").strip()
+            log.debug("[/%s] user=%s, text='%s'", status, body['user_id'], text)
+            if board_missing():
+                ack(NO_BOARD_MESSAGE)
+                return
+            
+            dates, note, msg = parse_status_command(status, text)
+            if job_queue.submit(f"/{status}", set_status_for_dates, client, body["user_id"], status, dates, note) is None:
+                ack(BUSY_MESSAGE)
+                return
+            ack(msg)
+            log.debug("[/%s] queued", status)
+        except Exception as e:
+            log.exception("[/%s] ERROR: %s", status, e)
+            ack(f"⚠️ エラーが発生しました: {str(e)}")
+    handler.__name__ = f"cmd_{status}"
+    return command_handler(handler)
 
-@app.command("/can")
-def cmd_can(ack, body, client):
-    try:
-        text = body.get("text", "").strip()
-        debug_log(f"[/can] user={body['user_id']}, text='{text}'")
-        
-        dates, note = parse_command_text(text, allow_weekday=True, allow_date=True)
-        debug_log(f"[/can] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"💡 can にしました" + (f"（{note}）" if note else "")
-        else:
-            msg = f"💡 can にしました: {', '.join(date_strs)}" + (f"（{note}）" if note else "")
-        
-        ack(msg)
-        set_status_for_dates(client, body["user_id"], "can", dates, note)
-        debug_log(f"[/can] success")
-    except Exception as e:
-        debug_log(f"[/can] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
+cmd_in = app.command("/in")(make_status_command("in"))
+cmd_out = app.command("/out")(make_status_command("out"))
+cmd_pm = app.command("/pm")(make_status_command("pm"))
+cmd_home = app.command("/home")(make_status_command("home"))
+cmd_maybe = app.command("/maybe")(make_status_command("maybe"))
+cmd_trip = app.command("/trip")(make_status_command("trip"))
+cmd_will = app.command("/will")(make_status_command("will"))
+cmd_can = app.command("/can")(make_status_command("can"))
 
-@app.command("/clear")
-def cmd_clear(ack, body, client):
-    text = body.get("text", "").strip().lower()
-    name = user_name(client, body["user_id"])
-    
-    if name not in state["schedules"]:
-        ack("🧹 削除するステータスがありません")
-        return
+def plan_clear(user_id, text):
+    """
+    /clear の引数から (変更レコード, 削除件数から返信メッセージを作る関数) を作る
+    使い方が誤っていれば (None, 返信メッセージ)。件数はジョブで実際に削除したときに分かる
+    """
+    window = calendar()
+    today = window.today_key
     
-    user_schedule = state["schedules"][name]
-    now = datetime.now(TZ)
+    def removed_message(message):
+        return lambda removed: message.format(removed=removed) if removed else "🧹 削除するステータスがありません"
     
     if text == "all":
         # 全て削除
-        count = len(user_schedule)
-        state["schedules"][name] = {}
-        if not state["schedules"][name]:
-            del state["schedules"][name]
-        ack(f"🧹 全てのステータスを削除しました（{count}件）")
+        record = {"op": "clear", "user": user_id}
+        reply = removed_message("🧹 全てのステータスを削除しました（{removed}件）")
     elif text == "week":
         # 今日から7日間
-        removed = 0
-        for i in range(7):
-            date = now + timedelta(days=i)
-            date_key = date_to_key(date)
-            if date_key in user_schedule:
-                del user_schedule[date_key]
-                removed += 1
-        if not user_schedule:
-            del state["schedules"][name]
-        ack(f"🧹 今週のステータスを削除しました（{removed}件）")
+        record = {"op": "clear", "user": user_id, "start": today, "end": window.key_after(6)}
+        reply = removed_message("🧹 今週のステータスを削除しました（{removed}件）")
     elif text == "" or text is None:
         # 今日のみ
-        today = today_key()
-        if today in user_schedule:
-            del user_schedule[today]
-            if not user_schedule:
-                del state["schedules"][name]
-            ack("🧹 今日のステータスを削除しました")
-        else:
-            ack("🧹 今日のステータスはありません")
+        record = {"op": "clear", "user": user_id, "start": today, "end": today}
+        reply = lambda removed: "🧹 今日のステータスを削除しました" if removed else "🧹 今日のステータスはありません"
     else:
         # "3", "3 week", "3 weeks" のパース
         match = re.match(r'(\d+)\s*(weeks?)?', text)
-        if match:
-            weeks = int(match.group(1))
-            if 1 <= weeks <= 10:
-                days = weeks * 7
-                removed = 0
-                for i in range(days):
-                    date = now + timedelta(days=i)
-                    date_key = date_to_key(date)
-                    if date_key in user_schedule:
-                        del user_schedule[date_key]
-                        removed += 1
-                if not user_schedule:
-                    del state["schedules"][name]
-                ack(f"🧹 {weeks}週間のステータスを削除しました（{removed}件）")
-            else:
-                ack("⚠️ 週数は1〜10の範囲で指定してください")
-                return
-        else:
-            ack("⚠️ 使い方: /clear [week|all|数字]")
-            return
+        if not match:
+            return None, "⚠️ 使い方: /clear [week|all|数字]"
+        weeks = int(match.group(1))
+        if not 1 <= weeks <= 10:
+            return None, "⚠️ 週数は1〜10の範囲で指定してください"
+        days = weeks * 7
+        record = {"op": "clear", "user": user_id, "start": today, "end": window.key_after(days - 1)}
+        reply = removed_message(f"🧹 {weeks}週間のステータスを削除しました（{{removed}}件）")
     
-    save_state(state)
-    update_board_message(client)
+    return record, reply
+
+def clear_for_user(client, record):
+    """/clear のジョブ: 削除してボード更新を要求し、削除件数を返す（先に並んだ変更を反映したあとで数える）"""
+    removed = commit_record(record)
+    if removed:
+        request_board_update(client, f"clear {record['user']}", record)
+    return removed
+
+@app.command("/clear")
+@command_handler
+def cmd_clear(ack, body, client, respond):
+    if board_missing():
+        ack(NO_BOARD_MESSAGE)
+        return
+    record, reply = plan_clear(body["user_id"], body.get("text", "").strip().lower())
+    if record is None:
+        ack(reply)
+        return
+    future = job_queue.submit("/clear", clear_for_user, client, record)
+    if future is None:
+        ack(BUSY_MESSAGE)
+        return
+    ack()
+    reply_when_done(future, respond, reply)
+
+def set_note_for_dates(client, user_id, dates: List[datetime], note: str):
+    """各日付に対してnoteを設定（既存のステータスを保持、なければ空）"""
+    date_keys = [date_to_key(date) for date in dates]
+    record = {"op": "note", "user": user_id, "dates": date_keys, "note": note}
+    commit_record(record)
+    log.debug("  Set %s %s note = '%s'", user_id, date_keys, note)
+    request_board_update(client, f"note {user_id}", record)
+
+def note_reply(dates: List[datetime], note: str) -> str:
+    date_strs = [d.strftime("%m/%d") for d in dates]
+    if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
+        return f"📝 note を更新" + (f": {note}" if note else "（空）")
+    return f"📝 note を更新: {', '.join(date_strs)}" + (f" - {note}" if note else "（空）")
 
 @app.command("/note")
+@command_handler
 def cmd_note(ack, body, client):
     try:
         text = body.get("text", "").strip()
-        debug_log(f"[/note] user={body['user_id']}, text='{text}'")
+        log.debug("[/note] user=%s, text='%s'", body['user_id'], text)
+        if board_missing():
+            ack(NO_BOARD_MESSAGE)
+            return
         
-        name = user_name(client, body["user_id"])
+        user_id = body["user_id"]
         
         # 日付とnoteをパース
         dates, note = parse_command_text(text, allow_weekday=True, allow_date=True)
-        debug_log(f"[/note] parsed: dates={[d.strftime('%Y-%m-%d') for d in dates]}, note='{note}'")
-        
-        # 各日付に対してnoteを設定（既存のステータスを保持、なければ空）
-        for date in dates:
-            date_key = date_to_key(date)
-            
-            # 既存のステータスを取得、なければ空文字列
-            if name in state["schedules"] and date_key in state["schedules"][name]:
-                current_status = state["schedules"][name][date_key].get("status", "")
-            else:
-                current_status = ""
-            
-            # ステータスとnoteを設定
-            if name not in state["schedules"]:
-                state["schedules"][name] = {}
-            
-            state["schedules"][name][date_key] = {
-                "status": current_status,
-                "note": note
-            }
-            debug_log(f"  Set {name} {date_key} note = '{note}' (status='{current_status}')")
-        
-        save_state(state)
-        update_board_message(client)
-        
-        date_strs = [d.strftime("%m/%d") for d in dates]
-        if len(dates) == 1 and dates[0].date() == datetime.now(TZ).date():
-            msg = f"📝 note を更新" + (f": {note}" if note else "（空）")
-        else:
-            msg = f"📝 note を更新: {', '.join(date_strs)}" + (f" - {note}" if note else "（空）")
+        log.debug("[/note] parsed: dates=%s, note='%s'", LazyDates(dates), note)
         
-        ack(msg)
-        debug_log(f"[/note] success")
+        if job_queue.submit("/note", set_note_for_dates, client, user_id, dates, note) is None:
+            ack(BUSY_MESSAGE)
+            return
+        ack(note_reply(dates, note))
+        log.debug("[/note] queued")
     except Exception as e:
-        debug_log(f"[/note] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("[/note] ERROR: %s", e)
         ack(f"⚠️ エラーが発生しました: {str(e)}")
 
-def render_board_range(schedules, days: int):
+@metrics.timed("render_seconds")
+def render_board_range(schedules, days: int, names=None, matrix=None):
     """指定日数分のボードを表示（コードブロック形式）"""
     lines = [f"【在室ボード - {days}日間】"]
-    now = datetime.now(TZ)
     
     # 全ユーザーを収集
-    all_users = set()
-    for i in range(days):
-        date = now + timedelta(days=i)
-        date_key = date_to_key(date)
-        for user_name, user_schedule in schedules.items():
-            if date_key in user_schedule:
-                all_users.add(user_name)
+    rows = status_rows(schedules, days, matrix)
     
-    if not all_users:
+    if not rows:
         lines.append("（まだ誰も登録していません）")
         return "```\n" + "\n".join(lines) + "\n```"
     
-    status_emoji = {
-        "in": "✅",
-        "pm": "🕒",
-        "out": "❌",
-        "home": "🏠",
-        "maybe": "🤔",
-        "trip": "✈️",
-        "will": "📅",
-        "can": "💡",
-    }
-    
+    dates = calendar().first(days)
+    weekdays = [d.label for d in dates]
+    labels = resolve_names(names, rows)
     weeks = (days + 6) // 7  # 切り上げで週数を計算
     
     # 2週間以上の場合は縦に曜日を並べる
     if weeks >= 2:
-        for user_name_item in sorted(all_users):
-            user_line = f"\n{user_name_item}"
-            user_schedule = schedules.get(user_name_item, {})
-            
-            lines.append(user_line)
+        # 日付2桁 + 絵文字(表示幅2) = 表示幅4
+        day_labels = [f"{d.day:>2}" for d in dates]
+        # 曜日: 全角1文字(表示幅2) + 前後スペース1ずつ = 表示幅4（最初の週だけ表示）
+        header = "  " + "".join(f" {weekday} " for weekday in weekdays[:7])
+        for user_key in sorted(rows, key=labels.get):
+            emojis, _ = rows[user_key]
+            cells = [label + emoji for label, emoji in zip(day_labels, emojis)]
             
+            lines.append(f"\n{labels[user_key]}")
+            lines.append(header)
             # 週ごとに処理
-            for week_idx in range(weeks):
-                start_day = week_idx * 7
-                end_day = min(start_day + 7, days)
-                
-                if week_idx == 0:
-                    # 最初の週だけ曜日ヘッダーを追加
-                    header_parts = []
-                    day_parts = []
-                    for i in range(start_day, end_day):
-                        date = now + timedelta(days=i)
-                        weekday = ["月", "火", "水", "木", "金", "土", "日"][date.weekday()]
-                        # 曜日: 全角1文字(表示幅2) + 前後スペース1ずつ = 表示幅4
-                        header_parts.append(f" {weekday} ")
-                        
-                        date_key = date_to_key(date)
-                        if date_key in user_schedule:
-                            info = user_schedule[date_key]
-                            status = info.get("status", "—")
-                            emoji = status_emoji.get(status, "➖")
-                            # 日付2桁 + 絵文字(表示幅2) = 表示幅4
-                            day_parts.append(f"{date.day:>2}{emoji}")
-                        else:
-                            day_parts.append(f"{date.day:>2}➖")
-                    
-                    lines.append("  " + "".join(header_parts))
-                    lines.append("  " + "".join(day_parts))
-                else:
-                    # 2週目以降は日付とステータスのみ
-                    day_parts = []
-                    for i in range(start_day, end_day):
-                        date = now + timedelta(days=i)
-                        date_key = date_to_key(date)
-                        
-                        if date_key in user_schedule:
-                            info = user_schedule[date_key]
-                            status = info.get("status", "—")
-                            emoji = status_emoji.get(status, "➖")
-                            day_parts.append(f"{date.day:>2}{emoji}")
-                        else:
-                            day_parts.append(f"{date.day:>2}➖")
-                    
-                    lines.append("  " + "".join(day_parts))
+            for start_day in range(0, days, 7):
+                lines.append("  " + "".join(cells[start_day:start_day + 7]))
     else:
         # 1週間の場合は従来通り
-        for user_name_item in sorted(all_users):
-            user_line = f"\n{user_name_item}"
-            user_schedule = schedules.get(user_name_item, {})
-            
-            day_parts = []
-            note_parts = []  # noteがある日付を記録
-            
-            for i in range(days):
-                date = now + timedelta(days=i)
-                date_key = date_to_key(date)
-                weekday = ["月", "火", "水", "木", "金", "土", "日"][date.weekday()]
-                
-                if date_key in user_schedule:
-                    info = user_schedule[date_key]
-                    status = info.get("status", "—")
-                    note = info.get("note", "")
-                    emoji = status_emoji.get(status, "➖")
-                    day_parts.append(f"{date.day}({weekday}){emoji}")
-                    
-                    # noteがあれば記録
-                    if note:
-                        note_parts.append(f"{date.day}({weekday}): {note}")
-                else:
-                    day_parts.append(f"{date.day}({weekday})➖")
-            
-            lines.append(user_line)
-            lines.append("  " + " | ".join(day_parts))
+        day_labels = [f"{d.day}({weekday})" for d, weekday in zip(dates, weekdays)]
+        for user_key in sorted(rows, key=labels.get):
+            emojis, notes = rows[user_key]
+            lines.append(f"\n{labels[user_key]}")
+            lines.append("  " + " | ".join(label + emoji for label, emoji in zip(day_labels, emojis)))
             
             # noteがあれば表示
-            if note_parts:
-                lines.append("  📝 " + " | ".join(note_parts))
+            if notes:
+                lines.append("  📝 " + " | ".join(f"{day_labels[i]}: {note}" for i, note in notes))
     
     lines.append(f"\n最終更新: {datetime.now(TZ).strftime('%H:%M')}")
     return "```\n" + "\n".join(lines) + "\n```"
 
-def render_user_schedule(schedules, target_user: str):
-    """特定ユーザーの全予定を表示"""
-    lines = [f"【{target_user} の予定】"]
-    now = datetime.now(TZ)
+def render_user_schedule(schedules, target_user: str, display_name: Optional[str] = None):
+    """特定ユーザーの全予定を表示（display_nameを省略するとキーをそのまま表示）"""
+    lines = [f"【{display_name or target_user} の予定】"]
+    window = calendar()
     
     user_schedule = schedules.get(target_user, {})
     
@@ -988,42 +3178,21 @@ def render_user_schedule(schedules, target_user: str):
         lines.append("（予定がありません）")
         return "\n".join(lines)
     
-    status_emoji = {
-        "in": "✅",
-        "pm": "🕒",
-        "out": "❌",
-        "home": "🏠",
-        "maybe": "🤔",
-        "trip": "✈️",
-        "will": "📅",
-        "can": "💡",
-    }
-    
-    # 全ての予定日を取得してソート
-    all_dates = []
-    for date_key in user_schedule.keys():
-        try:
-            date_obj = datetime.strptime(date_key, "%Y-%m-%d")
-            # 今日以降のみ
-            if date_obj.date() >= now.date():
-                all_dates.append(date_obj)
-        except:
-            pass
-    
-    all_dates.sort()
+    # 今日以降の予定を日付順に取得（日付キーとして読めないものは飛ばす）
+    upcoming = []
+    for date_key, info in user_entries(schedules, target_user, window.today_key):
+        day = window.lookup(date_key)
+        if day is not None:
+            upcoming.append((day, info))
     
-    if not all_dates:
+    if not upcoming:
         lines.append("（今後の予定がありません）")
         return "\n".join(lines)
     
-    for date in all_dates:
-        date_key = date_to_key(date)
-        weekday = ["月", "火", "水", "木", "金", "土", "日"][date.weekday()]
-        
-        info = user_schedule[date_key]
+    for day, info in upcoming:
         status = info.get("status", "—")
         note = info.get("note", "")
-        emoji = status_emoji.get(status, "")
+        emoji = STATUS_EMOJI.get(status, "")
         
         if emoji:
             status_str = f"{emoji} {status}"
@@ -1031,26 +3200,165 @@ def render_user_schedule(schedules, target_user: str):
             status_str = status
         
         note_str = f"（{note}）" if note else ""
-        lines.append(f"- {date.month}/{date.day}({weekday}): {status_str}{note_str}")
+        lines.append(f"- {day.month}/{day.day}({day.label}): {status_str}{note_str}")
     
     return "\n".join(lines)
 
+# /lab @ユーザー の形式
+LAB_MENTION_PATTERN = re.compile(r'<@([A-Z0-9]+)(?:\|[^>]+)?>')
+
+# 描画済みの /lab の表示をいくつまで覚えておくか
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "64"))
+
+# 表示の末尾の「最終更新」の行（範囲表示は後ろにコードブロックの ``` が続く）。noteに同じ文字列があっても触らない
+LAST_UPDATED_PATTERN = re.compile(r"^最終更新: \d{2}:\d{2}(?=(?:\n```)?\Z)", re.MULTILINE)
+
+class RenderCache:
+    """
+    描画済みの /lab の表示のLRUキャッシュ
+    キーは (表示の種類, 日数または日付キー, stateのバージョン, JSTの日付, 表示名の世代)。
+    変更・日付の変わり目・表示名の変更で後ろの3つが変わったら、古い表示は二度と使われないので全て捨てる
+    """
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._current = None  # 今覚えている表示の (version, today, generation)
+        self._lock = threading.Lock()
+
+    def _roll(self, key):
+        # self._lockを保持した状態で呼ぶ
+        if key[2:] != self._current:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._current = key[2:]
+
+    def get(self, key):
+        """覚えている表示を返す（なければNone）。最終更新の時刻は今に差し替える"""
+        with self._lock:
+            self._roll(key)
+            text = self._entries.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return LAST_UPDATED_PATTERN.sub(f"最終更新: {datetime.now(TZ).strftime('%H:%M')}", text, count=1)
+
+    def put(self, key, text):
+        with self._lock:
+            if key[2:] != self._current or key[4] != user_directory.generation:
+                # 描画している間に変更があった（描画中の表示名の取得で世代が進んだ場合も、どちらの世代の名前か分からないので覚えない）
+                return
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+metrics.register(
+    "render_cache",
+    lambda: {tenant.label: tenant.render_cache.stats() for tenant in tenants.loaded()},
+    label="tenant",
+)
+metrics.register(
+    "board_publisher",
+    lambda: {
+        tenant.label: {"published": tenant.publisher.published, "coalesced": tenant.publisher.coalesced}
+        for tenant in tenants.loaded() if tenant.publisher is not None
+    },
+    label="tenant",
+)
+
+def lab_view(text):
+    """/lab の引数（@ユーザー指定以外）から表示の種類 (view, 日数または日付キー) を返す（使い方の誤りはNone）"""
+    text_lower = text.lower()
+    day_dates, token_type = parse_single_token(text_lower)
+    if token_type in ("date", "weekday"):
+        return "day", date_to_key(day_dates[0])
+    if text_lower == "":
+        return "today", 1
+    if text_lower == "week":
+        return "range", 7
+    match = re.match(r'(\d+)\s*(weeks?)?', text_lower)
+    if not match or not 1 <= int(match.group(1)) <= 10:
+        return None
+    return "range", int(match.group(1)) * 7
+
+def lab_cache_key(text, snapshot):
+    """/lab の表示の描画キャッシュのキー（キャッシュしない表示はNone）"""
+    view = lab_view(text)
+    if view is None:
+        return None
+    return view + (snapshot.version, calendar().today, user_directory.generation)
+
+def lab_window(text):
+    """/lab の表示に出る期間 (start_key, end_key)（使い方の誤りはNone）"""
+    view = lab_view(text)
+    if view is None:
+        return None
+    kind, arg = view
+    if kind == "day":
+        return arg, arg
+    window = calendar()
+    return window.today_key, window.key_after(arg - 1)
+
+def render_lab_view(text, schedules, names, matrix=None):
+    """/lab の引数（@ユーザー指定以外）に応じた表示内容を返す"""
+    # 日付・曜日指定（"/lab 2/14", "/lab fri"）はその日に誰がいるかを表示
+    text_lower = text.lower()
+    day_dates, token_type = parse_single_token(text_lower)
+    if token_type in ("date", "weekday"):
+        return render_board(schedules, target_date=day_dates[0], names=names)
+    
+    # 週数のパース
+    if text_lower == "" or text_lower is None:
+        # 今日のみ
+        return render_board(schedules, names=names)
+    if text_lower == "week":
+        # 今週（7日間）
+        return render_board_range(schedules, 7, names=names, matrix=matrix)
+    
+    # "3", "3 week", "3 weeks"
+    match = re.match(r'(\d+)\s*(weeks?)?', text_lower)
+    if not match:
+        return "⚠️ 使い方: /lab [week|数字|日付|@ユーザー]"
+    weeks = int(match.group(1))
+    if not 1 <= weeks <= 10:
+        return "⚠️ 週数は1〜10の範囲で指定してください"
+    return render_board_range(schedules, weeks * 7, names=names, matrix=matrix)
+
 @app.command("/lab")
+@command_handler
 def cmd_lab(ack, body, client):
+    if board_missing():
+        ack(NO_BOARD_MESSAGE)
+        return
     text = body.get("text", "").strip()
     channel_id = body["channel_id"]
     user_id = body["user_id"]
     
+    # 読み出しは1つのスナップショットから行う
+    snapshot = store.snapshot()
+    schedules = snapshot.schedules
+    
     # @ユーザー指定のチェック
-    mention_match = re.match(r'<@([A-Z0-9]+)(?:\|[^>]+)?>', text)
+    mention_match = LAB_MENTION_PATTERN.match(text)
     if mention_match:
         target_user_id = mention_match.group(1)
         target_name = user_name(client, target_user_id)
         
         # 全ての予定を表示
-        schedule_text = render_user_schedule(state["schedules"], target_name)
+        schedule_text = render_user_schedule(schedules, target_user_id, target_name)
         
-        client.chat_postEphemeral(
+        slack_api(client).chat_postEphemeral(
             channel=channel_id,
             user=user_id,
             text=schedule_text
@@ -1058,100 +3366,914 @@ def cmd_lab(ack, body, client):
         ack()
         return
     
-    # 週数のパース
-    text_lower = text.lower()
-    if text_lower == "" or text_lower is None:
-        # 今日のみ
-        board_text = render_board(state["schedules"])
-        ack(board_text)
-    elif text_lower == "week":
-        # 今週（7日間）
-        board_text = render_board_range(state["schedules"], 7)
-        ack(board_text)
+    key = lab_cache_key(text, snapshot)
+    render_cache = current_tenant().render_cache
+    view = render_cache.get(key) if key else None
+    if view is None:
+        with reading(schedules):
+            view = render_lab_view(text, schedules, name_resolver(client), snapshot.matrix)
+        if key:
+            render_cache.put(key, view)
+    ack(view)
+
+def is_bot_message(msg, bot_user_id):
+    return msg.get("user") == bot_user_id or bool(msg.get("bot_id"))
+
+DELETE_DONE_MESSAGE = "🗑 削除完了: presence-bot のメッセージ {deleted} 件\n⚠️ ボードメッセージも削除されました。/setup を実行して在室ボードを再作成してください。"
+DELETE_RUNNING_MESSAGE = "⚠️ 削除は既に実行中です"
+
+# /delete の同時削除数と、管理者への進捗報告の間隔（秒）
+DELETE_WORKERS = int(os.environ.get("DELETE_WORKERS", "4"))
+DELETE_PROGRESS_INTERVAL = float(os.environ.get("DELETE_PROGRESS_INTERVAL", "30"))
+
+class DeletionJob:
+    """
+    チャンネル内のボットのメッセージを削除するジョブ
+    - conversations.history を読みながら、読んだページの削除を並行して進める
+      （速さの上限は slack_api の chat.delete のトークンバケットが決める）
+    - ページの削除が終わるたびに次のカーソルを delete_job.json に保存し、
+      途中で再起動しても続きから再開できる
+    - DELETE_PROGRESS_INTERVAL 秒ごとに実行した管理者へ進捗を送る
+    """
+
+    def __init__(self, client, channel_id, user_id, cursor=None, deleted=0, failed=0):
+        self.client = client
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.cursor = cursor
+        self.deleted = deleted
+        self.failed = failed
+        self._last_report = time.monotonic()
+
+    def to_dict(self):
+        return {
+            "channel": self.channel_id,
+            "user": self.user_id,
+            "cursor": self.cursor,
+            "deleted": self.deleted,
+            "failed": self.failed,
+        }
+
+    @classmethod
+    def from_dict(cls, client, job):
+        return cls(client, job["channel"], job["user"], job.get("cursor"), job.get("deleted", 0), job.get("failed", 0))
+
+    def run(self):
+        api = slack_api(self.client)
+        bot_user_id = api.auth_test()["user_id"]
+        store.set_delete_job(self.to_dict())
+        # 削除中のページ（削除のFuture, そのページの次のカーソル）。先読みは1ページまで
+        pending = []
+        try:
+            with ThreadPoolExecutor(max_workers=DELETE_WORKERS, thread_name_prefix="delete") as pool:
+                cursor = self.cursor
+                while True:
+                    resp = api.conversations_history(channel=self.channel_id, limit=200, cursor=cursor)
+                    futures = [
+                        pool.submit(self._delete, msg["ts"])
+                        for msg in resp.get("messages", [])
+                        if is_bot_message(msg, bot_user_id)
+                    ]
+                    cursor = resp.get("response_metadata", {}).get("next_cursor")
+                    pending.append((futures, cursor))
+                    while len(pending) > 1 or (pending and not cursor):
+                        self._finish_page(*pending.pop(0))
+                    if not cursor:
+                        break
+        except Exception:
+            # 途中のページで削除できた分も数える（カーソルは進めない）
+            for futures, _ in pending:
+                self._count(futures)
+            store.set_delete_job(self.to_dict())
+            raise
+
+        store.set_delete_job(None)
+        store.set_board_message(None, None)
+        log.info("[DeletionJob] Done: deleted=%s, failed=%s", self.deleted, self.failed)
+        return self.deleted
+
+    def _delete(self, ts):
+        try:
+            slack_api(self.client).chat_delete(channel=self.channel_id, ts=ts)
+            return True
+        except SlackApiError as e:
+            if e.response.get("error") == "message_not_found":
+                # 再開時など、既に消えているメッセージ
+                return None
+            log.warning("[DeletionJob] Failed to delete %s: %s", ts, e)
+            return False
+        except Exception as e:
+            log.warning("[DeletionJob] Failed to delete %s: %s", ts, e)
+            return False
+
+    def _count(self, futures):
+        for future in futures:
+            result = future.result()
+            if result:
+                self.deleted += 1
+            elif result is False:
+                self.failed += 1
+
+    def _finish_page(self, futures, next_cursor):
+        """ページの削除を待ち、次のカーソルを保存する"""
+        self._count(futures)
+        self.cursor = next_cursor
+        store.set_delete_job(self.to_dict())
+        if next_cursor and time.monotonic() - self._last_report >= DELETE_PROGRESS_INTERVAL:
+            self._last_report = time.monotonic()
+            self._notify(f"🗑 削除中… {self.deleted} 件削除しました")
+
+    def _notify(self, text):
+        try:
+            slack_api(self.client).chat_postEphemeral(channel=self.channel_id, user=self.user_id, text=text)
+        except Exception as e:
+            log.warning("[DeletionJob] Failed to report progress: %s", e)
+
+def start_deletion(job):
+    """削除ジョブを今のテナントに対してバックグラウンドで開始する（既に実行中ならFalse）"""
+    tenant = current_tenant()
+    if tenant.deletion is not None and tenant.deletion.is_alive():
+        return False
+
+    def run():
+        try:
+            deleted = job.run()
+        except Exception as e:
+            log.exception("[DeletionJob] ERROR: %s", e)
+            job._notify(f"⚠️ 削除が中断されました（{job.deleted} 件削除済み）: {str(e)}\n/delete を再実行すると続きから再開します")
+            return
+        job._notify(DELETE_DONE_MESSAGE.format(deleted=deleted))
+
+    tenant.deletion = threading.Thread(target=contextvars.copy_context().run, args=(run,), name="delete-job", daemon=True)
+    tenant.deletion.start()
+    return True
+
+def delete_bot_messages(client, channel_id, user_id):
+    """/delete: 中断した削除があればその続きから、なければ最初から削除を始める"""
+    saved = store.delete_job()
+    if saved and saved["channel"] == channel_id:
+        job = DeletionJob.from_dict(client, dict(saved, user=user_id))
     else:
-        # "3", "3 week", "3 weeks"
-        match = re.match(r'(\d+)\s*(weeks?)?', text_lower)
-        if match:
-            weeks = int(match.group(1))
-            if 1 <= weeks <= 10:
-                days = weeks * 7
-                board_text = render_board_range(state["schedules"], days)
-                ack(board_text)
-            else:
-                ack("⚠️ 週数は1〜10の範囲で指定してください")
-        else:
-            ack("⚠️ 使い方: /lab [week|数字|@ユーザー]")
+        job = DeletionJob(client, channel_id, user_id)
+    return start_deletion(job)
 
-def delete_bot_messages(client, channel_id):
-    bot_user_id = client.auth_test()["user_id"]
-    deleted = 0
-    cursor = None
+def resume_deletion(client):
+    """テナントのstateを読み込んだとき（起動時）に、再起動で中断した削除を再開する（MULTI_PROCESS=1 ではリーダーが）"""
+    if not is_leader():
+        return
+    saved = store.delete_job()
+    if saved:
+        log.info("[DeletionJob] Resuming in channel=%s (deleted=%s)", saved['channel'], saved.get('deleted', 0))
+        start_deletion(DeletionJob.from_dict(client, saved))
 
-    while True:
-        resp = client.conversations_history(
-            channel=channel_id,
-            limit=200,
-            cursor=cursor
-        )
-        for msg in resp.get("messages", []):
-            if msg.get("user") == bot_user_id or msg.get("bot_id"):
-                try:
-                    client.chat_delete(channel=channel_id, ts=msg["ts"])
-                    deleted += 1
-                except Exception:
-                    pass
-        cursor = resp.get("response_metadata", {}).get("next_cursor")
-        if not cursor:
-            break
+def update_reply(removed):
+    if removed > 0:
+        return f"🔄 在室ボードを更新しました（過去の日付 {removed} 件を削除）"
+    return "🔄 在室ボードを更新しました"
 
-    state["board_message"] = {"channel": None, "ts": None}
-    save_state(state)
-    return deleted
+def refresh_board(client):
+    """/update のジョブ: 過去の日付を削除してボードを強制更新し、削除件数を返す（リーダーでなければリーダーに頼む）"""
+    removed = cleanup_old_dates()
+    if is_leader():
+        update_board_message(client, skip_cleanup=True, force=True)
+    else:
+        request_board_update(client, "/update", force=True)
+    return removed
 
 @app.command("/update")
-def cmd_update(ack, body, client):
+@command_handler
+def cmd_update(ack, body, client, respond):
     """在室ボードを手動更新"""
-    try:
-        debug_log(f"[/update] user={body['user_id']}")
-        
-        # クリーンアップと更新（クリーンアップは1回だけ）
-        removed = cleanup_old_dates()
-        update_board_message(client, skip_cleanup=True)
-        
-        if removed > 0:
-            ack(f"🔄 在室ボードを更新しました（過去の日付 {removed} 件を削除）")
-        else:
-            ack("🔄 在室ボードを更新しました")
-        
-        debug_log(f"[/update] success")
-    except Exception as e:
-        debug_log(f"[/update] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        ack(f"⚠️ エラーが発生しました: {str(e)}")
+    log.debug("[/update] user=%s", body['user_id'])
+    if board_missing():
+        ack(NO_BOARD_MESSAGE)
+        return
+    
+    future = job_queue.submit("/update", refresh_board, client)
+    if future is None:
+        ack(BUSY_MESSAGE)
+        return
+    ack("🔄 在室ボードを更新中...")
+    reply_when_done(future, respond, update_reply)
 
 @app.command("/delete")
+@command_handler
 def cmd_delete(ack, body, client):
     if not is_admin(body["user_id"]):
         ack("⚠️ このコマンドは管理者のみ実行できます")
         return
 
-    ack("🗑 presence-bot のメッセージを削除中…")
-    channel_id = body["channel_id"]
-    deleted = delete_bot_messages(client, channel_id)
+    if not delete_bot_messages(client, body["channel_id"], body["user_id"]):
+        ack(DELETE_RUNNING_MESSAGE)
+        return
+    ack("🗑 presence-bot のメッセージを削除中…（終わったらお知らせします）")
 
-    client.chat_postEphemeral(
-        channel=channel_id,
-        user=body["user_id"],
-        text=f"🗑 削除完了: presence-bot のメッセージ {deleted} 件\n⚠️ ボードメッセージも削除されました。/setup を実行して在室ボードを再作成してください。"
-    )
+def render_stats():
+    """/stats の表示: 所要時間の p50 / p99、回数、各コンポーネントの stats()"""
+    summary = metrics.summary()
+    counters = metrics.counters()
+    if not summary and not counters:
+        return "📊 まだ記録がありません"
+
+    lines = ["📊 presence-bot の統計", "```"]
+    lines.append(f"{'latency':<56}{'count':>7}{'p50':>10}{'p99':>10}")
+    for (name, labels), values in sorted(summary.items()):
+        label = name + prometheus_labels(labels)
+        lines.append(f"{label:<56}{values['count']:>7}{values['p50_ms']:>8.1f}ms{values['p99_ms']:>8.1f}ms")
+    lines.append("")
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f"{name + prometheus_labels(labels)} {value}")
+    lines.append("")
+    for name, labels, value in sorted(metrics.gauges()):
+        lines.append(f"{name + prometheus_labels(labels)} {value:g}")
+    lines.append("```")
+    return "\n".join(lines)
+
+@app.command("/stats")
+@command_handler
+def cmd_stats(ack, body):
+    """コマンド・保存・描画・Slack APIの所要時間と各種の回数を表示（管理者のみ）"""
+    if not is_admin(body["user_id"]):
+        ack("⚠️ このコマンドは管理者のみ実行できます")
+        return
+    ack(render_stats())
+
+LOGS_DEFAULT_LIMIT = 50
+LOGS_MAX_CHARS = 3500  # Slackの1メッセージに収まるよう、古い行から削る
+
+def render_logs(text):
+    """/logs [件数] [レベル] の表示: メモリに残っている直近のログ"""
+    limit, level = LOGS_DEFAULT_LIMIT, logging.NOTSET
+    for token in text.split():
+        if token.isdigit():
+            limit = int(token)
+        else:
+            try:
+                level = log_level(token)
+            except ValueError:
+                return f"⚠️ 件数かレベル（DEBUG / INFO / WARNING / ERROR）を指定してください: {token}"
+    if LOG_BUFFER_SIZE <= 0:
+        return "📜 LOG_BUFFER_SIZE=0 のため、ログを残していません"
+
+    lines = log_buffer.dump(limit, level)
+    if not lines:
+        return "📜 該当するログはありません"
+    kept, size = [], 0
+    for line in reversed(lines):
+        size += len(line) + 1
+        if size > LOGS_MAX_CHARS and kept:
+            break
+        kept.append(line[:LOGS_MAX_CHARS])
+    kept.reverse()
+    return f"📜 直近のログ {len(kept)} 件\n```\n" + "\n".join(kept) + "\n```"
+
+@app.command("/logs")
+@command_handler
+def cmd_logs(ack, body):
+    """メモリに残っている直近のログを表示（管理者のみ）"""
+    if not is_admin(body["user_id"]):
+        ack("⚠️ このコマンドは管理者のみ実行できます")
+        return
+    ack(render_logs(body.get("text", "")))
+
+
+# ========== リーダー選出（MULTI_PROCESS=1） ==========
+# leader.db の leases テーブルのリースを LEASE_TTL 秒ごとに延長し続けているプロセスがリーダー
+# リーダーが止まるとリースの期限が切れ、他のプロセスが引き継ぐ（同じホスト・同じ時計が前提）
+
+LEASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name    TEXT PRIMARY KEY,
+    holder  TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+BOARD_REQUESTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS board_requests (
+    tenant  TEXT PRIMARY KEY,
+    force   INTEGER NOT NULL
+);
+"""
+
+class BoardRequests:
+    """
+    リーダーでないプロセスからリーダーへのボード更新の依頼（leader.db の board_requests テーブル）
+    リーダーが読み込んでいない（メモリから外した）テナントへの書き込みも、これでボードに反映される
+    """
+
+    def __init__(self, path=LEADER_FILE):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        # コマンドのスレッドからもリーダー選出のスレッドからも使うので、スレッドごとに接続する
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(BOARD_REQUESTS_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def add(self, tenant, force=False):
+        """テナントのボード更新を依頼する（同じテナントの依頼は1つにまとめる）"""
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT INTO board_requests (tenant, force) VALUES (?, ?) "
+                    "ON CONFLICT (tenant) DO UPDATE SET force = MAX(force, excluded.force)",
+                    (tenant.label, int(force)),
+                )
+        except sqlite3.Error as e:
+            log.warning("[BoardRequests] Failed to ask the leader to update %s: %s", tenant, e)
+
+    def drain(self):
+        """依頼を全て取り出す {Tenant: force}"""
+        conn = self._conn()
+        with conn:
+            rows = conn.execute("SELECT tenant, force FROM board_requests").fetchall()
+            if rows:
+                conn.execute("DELETE FROM board_requests")
+        return {tenants.by_label(label): bool(force) for label, force in rows}
+
+board_requests = BoardRequests()
+
+class LeaderLease:
+    """
+    リースによるリーダー選出
+    - try_acquire() はリースが空いているか期限切れか自分のものなら、期限を延ばして True を返す
+    - is_leader は最後に延長できてから ttl 秒以内か（延長に失敗し続けたら自分から降りる）
+    """
+
+    def __init__(self, path=LEADER_FILE, name="leader", ttl=LEASE_TTL, holder=None):
+        self.path = path
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}"
+        self._valid_until = 0.0  # time.monotonic() でのリースの期限
+        self._conn = None
+
+    def _connect(self):
+        # リースはリーダー選出のスレッドからだけ読み書きする
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(LEASE_SCHEMA)
+        return self._conn
+
+    def try_acquire(self):
+        """リースを取る（持っていれば延長する）。取れたらTrue"""
+        started = time.monotonic()
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            cur = conn.execute(
+                "INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires "
+                "WHERE leases.holder = excluded.holder OR leases.expires < ?",
+                (self.name, self.holder, now + self.ttl, now),
+            )
+        self._valid_until = started + self.ttl if cur.rowcount == 1 else 0.0
+        return self.is_leader
+
+    def release(self):
+        """リースを手放す（終了時。次のリーダーが期限切れを待たずに引き継げる）"""
+        self._valid_until = 0.0
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+
+    @property
+    def is_leader(self):
+        return time.monotonic() < self._valid_until
+
+class LeaderElection:
+    """
+    リースを取り続け、リーダーの間だけシングルトンの仕事をするスレッド
+    - リーダーになったとき: 0時の処理（前のリーダーが取りこぼした分）と中断した /delete の再開
+    - リーダーの間: 他のプロセスの書き込みを見つけたり、board_requests で頼まれたりしたらボード更新を要求する
+      （ボードを更新するのはリーダーだけ）
+    main でボードパブリッシャーを設定してから start_leader_election() で開始する
+    """
+
+    def __init__(self, lease, interval=1.0):
+        self.lease = lease
+        self.interval = interval
+        self.elections = 0
+        self._attempted = None
+        self._seen = {}  # Tenant → ボードに反映済みの foreign_changes
+        self._elected = None  # on_elected() を実行しているスレッド
+        self._stop = threading.Event()
+
+    def run(self):
+        log.info("[LeaderElection] Started as %s", self.lease.holder)
+        while not self._stop.is_set():
+            self.tick()
+            self._stop.wait(self.interval)
+        self.lease.release()
+
+    def stop(self):
+        self._stop.set()
+
+    def tick(self):
+        was_leader = self.lease.is_leader
+        now = time.monotonic()
+        if self._attempted is None or now - self._attempted >= self.lease.ttl / 3:
+            self._attempted = now
+            try:
+                self.lease.try_acquire()
+            except sqlite3.Error as e:
+                log.warning("[LeaderElection] Failed to renew lease: %s", e)
+        if not self.lease.is_leader:
+            if was_leader:
+                log.info("[LeaderElection] Lost leadership")
+                self._seen.clear()
+            return
+        if not was_leader:
+            self.elections += 1
+            log.info("[LeaderElection] Became leader (%s)", self.lease.holder)
+            # 0時の処理やボード更新に時間がかかってもリースの延長を止めないよう、別のスレッドで行う
+            if self._elected is None or not self._elected.is_alive():
+                self._elected = threading.Thread(target=self.on_elected, name="leader-elected", daemon=True)
+                self._elected.start()
+        self.watch()
+
+    def on_elected(self):
+        midnight_rollover()
+        for tenant in tenants.all():
+            if not tenant.persisted:
+                continue
+            with tenant.active():
+                try:
+                    resume_deletion(app.client)
+                except Exception as e:
+                    log.warning("[LeaderElection] %s: failed to resume deletion: %s", tenant, e)
+
+    def watch(self):
+        """
+        読み込み済みのテナントと更新を頼まれたテナントについて、他のプロセスの書き込みを取り込み、
+        まだボードに反映していなければ更新を要求する（頼まれたテナントは読み込んでいなければ読み込む）
+        """
+        try:
+            requested = board_requests.drain()
+        except sqlite3.Error as e:
+            log.warning("[LeaderElection] Failed to read board requests: %s", e)
+            requested = {}
+        watched = tenants.loaded()
+        watched += [tenant for tenant in requested if tenant not in watched]
+        for tenant in watched:
+            with tenant.active():
+                try:
+                    tenant.store.refresh()
+                    seen = tenant.store.foreign_changes
+                    if tenant in requested or self._seen.get(tenant) != seen:
+                        self._seen[tenant] = seen
+                        request_board_update(app.client, "changed by another process", force=requested.get(tenant, False))
+                except Exception as e:
+                    log.warning("[LeaderElection] %s: failed to sync board: %s", tenant, e)
+
+leader_election = LeaderElection(LeaderLease())
+metrics.register("leader", lambda: {"is_leader": int(is_leader()), "elections": leader_election.elections})
+
+def is_leader():
+    """0時の処理・ボードの更新・/delete の再開をしてよいか（MULTI_PROCESS=0 なら常にTrue）"""
+    return not MULTI_PROCESS or leader_election.lease.is_leader
+
+def start_leader_election():
+    """リーダー選出のスレッドを開始する（tenants.publisher_factory を設定してから呼ぶ）"""
+    threading.Thread(target=leader_election.run, name="leader-election", daemon=True).start()
+    log.info("[main] Leader election thread started")
+
+
+# ========== 非同期モード ==========
+# ASYNC_MODE=1 のときは AsyncApp / AsyncWebClient / AsyncSocketModeHandler で動かす
+# Slack API の待ち時間でワーカースレッドを塞がないので、ボード更新や名前解決が並行して進む
+# （stateの変更とファイル書き込みは同期版と同じ関数をスレッドプールで実行する）
+ASYNC_MODE = os.environ.get("ASYNC_MODE", "0") == "1"
+
+def run_sync(func, *args, **kwargs):
+    """同期関数をデフォルトのスレッドプールで実行する（イベントループを塞がない、テナントは引き継ぐ）"""
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
+def read_schedules(func, schedules, *args):
+    """schedules を読む同期関数を1つの読み取りトランザクションで実行する（run_sync と組み合わせて使う）"""
+    with reading(schedules):
+        return func(schedules, *args)
+
+def scheduled_user_ids(schedules, window=None):
+    """window (start_key, end_key) の期間に予定のあるユーザー、Noneなら schedules の全員"""
+    if window is None:
+        return list(schedules.keys())
+    return list(entries_between(schedules, *window))
+
+class AsyncBoardPublisher(BoardPublisher):
+    """BoardPublisher のasyncio版（スレッドの代わりにイベントループ上のタスクで反映する）"""
+
+    def __init__(self, client, window=BOARD_PUBLISH_WINDOW, max_delay=BOARD_PUBLISH_MAX_DELAY, tenant=None):
+        super().__init__(client, window, max_delay, tenant)
+        self._loop = None
+        self._event = None
+        self._task = None
+
+    def start(self, loop=None):
+        """イベントループ上から呼ぶ（ジョブのスレッドなど別スレッドから呼ぶ場合はそのループを渡す）"""
+        self._loop = loop or asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        if loop is None:
+            self._task = self._loop.create_task(self._run_async())
+        else:
+            self._task = asyncio.run_coroutine_threadsafe(self._run_async(), loop)
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def stop(self):
+        if isinstance(self._task, asyncio.Future):
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        elif self._task is not None:
+            self._task.cancel()
+
+    def mark_dirty(self, reason="", users=None):
+        # 日付変更チェックなど別スレッドからも呼ばれる
+        with self._cond:
+            self._record_request(users)
+        self._loop.call_soon_threadsafe(self._event.set)
+        log.debug("[AsyncBoardPublisher] dirty: %s", reason)
+
+    async def _run_async(self):
+        with self.tenant.active():
+            await self._publish_forever_async()
+
+    async def _publish_forever_async(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            with self._cond:
+                if self._dirty_since is None:
+                    continue
+            while True:
+                with self._cond:
+                    wait = self._due() - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            with self._cond:
+                users = self._take_dirty()
+
+            if await async_update_board_message(self.client, users=users):
+                self.published += 1
+            else:
+                self.mark_dirty("retry after failure", users)
+            self._last_publish = time.monotonic()
+            log.debug("[AsyncBoardPublisher] published=%s, coalesced=%s", self.published, self.coalesced)
+
+async def async_prefetch_names(client, user_ids):
+    """キャッシュにない表示名を users.info で並行して取得する"""
+    async def fetch(user_id):
+        try:
+            resp = await slack_api(client).users_info(user=user_id)
+            user_directory.put(user_id, profile_name(resp["user"]))
+        except Exception as e:
+            log.warning("[async_prefetch_names] Failed to look up %s: %s", user_id, e)
+
+    missing = user_directory.missing(user_ids)
+    if missing:
+        await asyncio.gather(*(fetch(user_id) for user_id in missing))
+
+async def async_name_resolver(client, schedules, window=None):
+    """
+    表示するユーザーの表示名を先に取得し、キャッシュだけで引く解決関数を返す
+    window (start_key, end_key) を渡すとその期間に予定のあるユーザーだけ、Noneなら schedules の全員
+    """
+    user_ids = await run_sync(scheduled_user_ids, schedules, window)
+    await async_prefetch_names(client, user_ids)
+    return user_directory.cached_many
+
+async def async_user_name(client, user_id):
+    name = user_directory.get(user_id)
+    if name is None:
+        resp = await slack_api(client).users_info(user=user_id)
+        name = profile_name(resp["user"])
+        user_directory.put(user_id, name)
+    return name
+
+@metrics.timed("board_update_seconds")
+async def async_update_board_message(client, skip_cleanup=False, force=False, users=None):
+    """update_board_message のasyncio版"""
+    try:
+        snapshot = await run_sync(store.snapshot)
+        ch, ts = ensure_board_message(client, snapshot)
+        if not (ch and ts):
+            log.debug("[async_update_board_message] No board message found, skipping update")
+            return True
+        
+        if not skip_cleanup:
+            await run_sync(cleanup_old_dates)
+            snapshot = await run_sync(store.snapshot)
+        
+        generation = user_directory.generation
+        users = board_update_users(snapshot.board_message, users)
+        # シャード分割していれば、どのメッセージに載るかを決めるのに全員の表示名が要る
+        window = board_window() if len(board_shards(snapshot.board_message)) == 1 else None
+        names = await async_name_resolver(client, snapshot.schedules, window)
+        rendered = await run_sync(read_schedules, render_board_shards, snapshot.schedules, snapshot.board_message, names, snapshot.matrix, users)
+        for ts, text in rendered:
+            digest = board_digest(text)
+            if not force and board_unchanged(ts, digest):
+                log.debug("[async_update_board_message] Board content unchanged, skipping update: ts=%s", ts)
+                metrics.count("board_updates_total", result="unchanged")
+                continue
+            
+            log.debug("[async_update_board_message] Updating board in channel=%s, ts=%s", ch, ts)
+            await slack_api(client).chat_update(channel=ch, ts=ts, text=text)
+            _published_board[ts] = digest
+            metrics.count("board_updates_total", result="updated")
+        mark_board_published(snapshot.board_message, users, generation)
+        log.debug("[async_update_board_message] Board updated successfully")
+        return True
+    except Exception as e:
+        log.exception("[async_update_board_message] ERROR: %s", e)
+        metrics.count("board_updates_total", result="failed")
+        # レート制限・通信エラーならFalse（パブリッシャーがあとでやり直す）
+        return not is_retryable(e)
+
+def build_async_app():
+    """同じコマンドを登録した AsyncApp を作る"""
+    from slack_bolt.async_app import AsyncApp
+
+    async_app = AsyncApp(token=os.environ["SLACK_BOT_TOKEN"])
 
+    @async_app.event("user_change")
+    async def async_on_user_change(event):
+        on_user_change(event)
+
+    @async_app.command("/setup")
+    @command_handler
+    async def async_setup(ack, body, client, respond):
+        if not is_admin(body["user_id"]):
+            await ack("⚠️ このコマンドは管理者のみ実行できます")
+            return
+
+        await ack("在室ボードをセットアップ中...")
+        channel_id = body["channel_id"]
+
+        snapshot = await run_sync(store.snapshot)
+        prev_ch = snapshot.board_message.get("channel")
+        if prev_ch and snapshot.board_message.get("ts"):
+            for shard in board_shards(snapshot.board_message):
+                try:
+                    await slack_api(client).pins_remove(channel=prev_ch, timestamp=shard["ts"])
+                except Exception:
+                    pass
+
+        names = await async_name_resolver(client, snapshot.schedules)
+        def plan_and_render(schedules):
+            shards = plan_board_shards(schedules, names)
+            board_message = {"channel": channel_id, "ts": None, "shards": shards}
+            return shards, render_board_shards(schedules, board_message, names, snapshot.matrix)
+        shards, rendered = await run_sync(read_schedules, plan_and_render, snapshot.schedules)
+        for shard, (_, text) in zip(shards, rendered):
+            msg = await slack_api(client).chat_postMessage(channel=channel_id, text=text)
+            shard["ts"] = msg["ts"]
+            await slack_api(client).pins_add(channel=channel_id, timestamp=shard["ts"])
+            _published_board[shard["ts"]] = board_digest(text)
+        await run_sync(store.set_board_message, channel_id, shards[0]["ts"], shards if len(shards) > 1 else None)
+        await respond(SETUP_DONE_MESSAGE)
+
+    def make_async_status_command(status):
+        async def handler(ack, body):
+            try:
+                text = body.get("text", "").strip()
+                log.debug("[/%s] user=%s, text='%s'", status, body['user_id'], text)
+                if await run_sync(board_missing):
+                    await ack(NO_BOARD_MESSAGE)
+                    return
+                
+                dates, note, msg = parse_status_command(status, text)
+                # ボード更新の要求はパブリッシャーに渡るので、ジョブでは同期クライアントは使われない
+                if job_queue.submit(f"/{status}", set_status_for_dates, app.client, body["user_id"], status, dates, note) is None:
+                    await ack(BUSY_MESSAGE)
+                    return
+                await ack(msg)
+                log.debug("[/%s] queued", status)
+            except Exception as e:
+                log.exception("[/%s] ERROR: %s", status, e)
+                await ack(f"⚠️ エラーが発生しました: {str(e)}")
+        handler.__name__ = f"async_cmd_{status}"
+        return command_handler(handler)
+
+    for status in STATUS_COMMANDS:
+        async_app.command(f"/{status}")(make_async_status_command(status))
+
+    @async_app.command("/clear")
+    @command_handler
+    async def async_cmd_clear(ack, body, respond):
+        if await run_sync(board_missing):
+            await ack(NO_BOARD_MESSAGE)
+            return
+        record, reply = plan_clear(body["user_id"], body.get("text", "").strip().lower())
+        if record is None:
+            await ack(reply)
+            return
+        future = job_queue.submit("/clear", clear_for_user, app.client, record)
+        if future is None:
+            await ack(BUSY_MESSAGE)
+            return
+        await ack()
+        try:
+            await respond(reply(await asyncio.wrap_future(future)))
+        except Exception as e:
+            log.exception("[/clear] ERROR: %s", e)
+            await respond(f"⚠️ エラーが発生しました: {str(e)}")
+
+    @async_app.command("/note")
+    @command_handler
+    async def async_cmd_note(ack, body):
+        try:
+            text = body.get("text", "").strip()
+            log.debug("[/note] user=%s, text='%s'", body['user_id'], text)
+            if await run_sync(board_missing):
+                await ack(NO_BOARD_MESSAGE)
+                return
+            
+            user_id = body["user_id"]
+            dates, note = parse_command_text(text, allow_weekday=True, allow_date=True)
+            if job_queue.submit("/note", set_note_for_dates, app.client, user_id, dates, note) is None:
+                await ack(BUSY_MESSAGE)
+                return
+            await ack(note_reply(dates, note))
+            log.debug("[/note] queued")
+        except Exception as e:
+            log.exception("[/note] ERROR: %s", e)
+            await ack(f"⚠️ エラーが発生しました: {str(e)}")
+
+    @async_app.command("/lab")
+    @command_handler
+    async def async_cmd_lab(ack, body, client):
+        if await run_sync(board_missing):
+            await ack(NO_BOARD_MESSAGE)
+            return
+        text = body.get("text", "").strip()
+        snapshot = await run_sync(store.snapshot)
+        schedules = snapshot.schedules
+        
+        mention_match = LAB_MENTION_PATTERN.match(text)
+        if mention_match:
+            target_user_id = mention_match.group(1)
+            target_name = await async_user_name(client, target_user_id)
+            await slack_api(client).chat_postEphemeral(
+                channel=body["channel_id"],
+                user=body["user_id"],
+                text=await run_sync(render_user_schedule, schedules, target_user_id, target_name)
+            )
+            await ack()
+            return
+        
+        key = lab_cache_key(text, snapshot)
+        render_cache = current_tenant().render_cache
+        view = render_cache.get(key) if key else None
+        if view is None:
+            window = lab_window(text)
+            # 使い方の誤りの表示には表示名を使わない
+            names = await async_name_resolver(client, schedules, window) if window else user_directory.cached_many
+            view = await run_sync(read_schedules, functools.partial(render_lab_view, text), schedules, names, snapshot.matrix)
+            if key:
+                render_cache.put(key, view)
+        await ack(view)
+
+    @async_app.command("/update")
+    @command_handler
+    async def async_cmd_update(ack, body, client, respond):
+        log.debug("[/update] user=%s", body['user_id'])
+        if await run_sync(board_missing):
+            await ack(NO_BOARD_MESSAGE)
+            return
+        
+        future = job_queue.submit("/update", cleanup_old_dates)
+        if future is None:
+            await ack(BUSY_MESSAGE)
+            return
+        await ack("🔄 在室ボードを更新中...")
+        try:
+            removed = await asyncio.wrap_future(future)
+            if is_leader():
+                await async_update_board_message(client, skip_cleanup=True, force=True)
+            else:
+                await run_sync(request_board_update, client, "/update", force=True)
+            await respond(update_reply(removed))
+        except Exception as e:
+            log.error("[/update] ERROR: %s", e)
+            await respond(f"⚠️ エラーが発生しました: {str(e)}")
+
+    @async_app.command("/delete")
+    @command_handler
+    async def async_cmd_delete(ack, body):
+        if not is_admin(body["user_id"]):
+            await ack("⚠️ このコマンドは管理者のみ実行できます")
+            return
+
+        # 削除は同期クライアントでバックグラウンドスレッドが進める（chat.deleteの上限で律速される）
+        if not delete_bot_messages(app.client, body["channel_id"], body["user_id"]):
+            await ack(DELETE_RUNNING_MESSAGE)
+            return
+        await ack("🗑 presence-bot のメッセージを削除中…（終わったらお知らせします）")
+
+    @async_app.command("/stats")
+    @command_handler
+    async def async_cmd_stats(ack, body):
+        if not is_admin(body["user_id"]):
+            await ack("⚠️ このコマンドは管理者のみ実行できます")
+            return
+        await ack(render_stats())
+
+    @async_app.command("/logs")
+    @command_handler
+    async def async_cmd_logs(ack, body):
+        if not is_admin(body["user_id"]):
+            await ack("⚠️ このコマンドは管理者のみ実行できます")
+            return
+        await ack(render_logs(body.get("text", "")))
+
+    return async_app
+
+async def run_async():
+    """asyncioモードで起動する"""
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+
+    async_app = build_async_app()
+
+    # ユーザー名キャッシュを users.list でまとめて取得
+    async def warm_user_directory():
+        try:
+            await user_directory.warm_async(async_app.client)
+        except Exception as e:
+            log.warning("[main] Failed to warm user directory: %s", e)
+    warm_task = asyncio.get_running_loop().create_task(warm_user_directory())
+
+    # ボード更新をまとめて反映するパブリッシャーを、テナントごとに最初の更新要求で開始
+    loop = asyncio.get_running_loop()
+    def start_publisher(tenant):
+        publisher = AsyncBoardPublisher(async_app.client, tenant=tenant)
+        publisher.start(loop)
+        log.info("[main] Async board publisher started for %s", tenant)
+        return publisher
+    tenants.publisher_factory = start_publisher
+
+    if MULTI_PROCESS:
+        # リーダー選出を開始（リーダーになるまで0時の処理・ボード更新はしない）
+        start_leader_election()
+
+    await AsyncSocketModeHandler(async_app, os.environ["SLACK_APP_TOKEN"]).start_async()
+    warm_task.cancel()
 
 if __name__ == "__main__":
     # 日付変更チェック用のバックグラウンドスレッドを開始
     checker_thread = threading.Thread(target=date_change_checker, daemon=True)
     checker_thread.start()
-    debug_log("[main] Date change checker thread started")
+    log.info("[main] Date change checker thread started")
+    
+    # stateを変更するジョブを順に実行するワーカーを開始
+    job_queue.start()
+    log.info("[main] Job queue worker started")
+    
+    # 再起動で中断した /delete があれば、そのテナントのstateを読み込んだときに続きから再開
+    tenants.on_load = lambda tenant: resume_deletion(app.client)
+    if not MULTI_TENANT:
+        # 単一ボードは起動時に読み込む（テナントごとのstateは最初に使うときに読み込む）
+        tenants.default.store
+    
+    if METRICS_PORT:
+        # /metrics をPrometheusのテキスト形式で公開
+        serve_metrics()
+        log.info("[main] Metrics served on http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    
+    if ASYNC_MODE:
+        log.info("[main] Starting in asyncio mode")
+        asyncio.run(run_async())
+    else:
+        # ユーザー名キャッシュを users.list でまとめて取得
+        def warm_user_directory():
+            try:
+                user_directory.warm(app.client)
+            except Exception as e:
+                log.warning("[main] Failed to warm user directory: %s", e)
+        threading.Thread(target=warm_user_directory, daemon=True).start()
+    
+        # ボード更新をまとめて反映するパブリッシャーを、テナントごとに最初の更新要求で開始
+        def start_publisher(tenant):
+            publisher = BoardPublisher(app.client, tenant=tenant)
+            publisher.start()
+            log.info("[main] Board publisher thread started for %s", tenant)
+            return publisher
+        tenants.publisher_factory = start_publisher
+    
+        if MULTI_PROCESS:
+            # リーダー選出を開始（リーダーになるまで0時の処理・ボード更新はしない）
+            start_leader_election()
     
-    # Slack Botを起動
-    SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
+        # Slack Botを起動
+        SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start()
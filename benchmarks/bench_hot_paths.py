@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+ボードの描画・パーサー・過去日付の削除・保存と読み込みの時間を、合成したstateで計るベンチマーク
+
+    python benchmarks/bench_hot_paths.py                  # baseline.json と比べる
+    python benchmarks/bench_hot_paths.py --save           # 今回の結果を baseline.json に保存
+    python benchmarks/bench_hot_paths.py --sizes 100x70x16,2000x70x32
+
+サイズは ユーザー数x今日からの日数xメモの文字数。時計は FROZEN_NOW に固定する。
+マシンの速さの違いを消すため、決まった処理（calibrate）の時間で割った値を baseline と比べ、
+tolerance 倍以上遅くなったものがあれば終了コード1で終わる（min-ms より短いものは揺れが大きいので判定しない）
+時間は少なくとも MIN_REPEAT 回計った中央値（1回だけ速かった・遅かった回に引きずられない）
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# app の state.json を読み書きしないよう、空のディレクトリで import する
+os.chdir(tempfile.mkdtemp())
+# 標準出力へのログの時間を計らないようにする（メモリに残す分は本番と同じく計る）
+os.environ["LOG_LEVEL"] = "WARNING"
+# Slackにつながずに import する（トークンはダミーでよい）
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+
+from datetime import datetime, timedelta
+
+import app
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = "10x14x8,100x70x16,1000x70x32"
+FROZEN_NOW = datetime(2026, 1, 5, 9, 30, tzinfo=app.TZ)  # 月曜日
+PAST_DAYS = 7  # 過去日付の削除で消える、昨日までの日数
+MIN_REPEAT = 10  # これより少ない回数の中央値は揺れが大きく、CIで誤って遅くなったと判定する
+
+STATUSES = ["in", "out", "pm", "home", "maybe", "trip", "will", "can"]
+NOTE_CHARS = "会議出張午後から在宅通院外出リモート研修来客"
+
+class FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return FROZEN_NOW if tz is None else FROZEN_NOW.astimezone(tz)
+
+app.datetime = FrozenDatetime
+
+def make_state(users, days, note_len, seed=0):
+    """
+    ユーザー users 人 × 昨日までの PAST_DAYS 日と今日から days 日のstate
+    6割の日に予定があり、3割の予定に note_len 文字のメモ（20種類から選ぶ）が付く
+    """
+    rng = random.Random(seed)
+    notes = ["".join(rng.choice(NOTE_CHARS) for _ in range(note_len)) for _ in range(20)]
+    date_keys = [(FROZEN_NOW + timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(-PAST_DAYS, days)]
+    schedules = {}
+    for i in range(users):
+        user_schedule = {}
+        for date_key in date_keys:
+            if rng.random() < 0.6:
+                note = rng.choice(notes) if rng.random() < 0.3 else ""
+                user_schedule[date_key] = app.Entry.of(rng.choice(STATUSES), note)
+        schedules[f"U{i:08d}"] = user_schedule
+    return {
+        "schedules": app.Schedules(schedules),
+        "board_message": {"channel": "C00000000", "ts": "1.0"},
+        "key_format": "user_id",
+    }
+
+def parse_text(days, note_len):
+    """今日から days 日の期間指定とメモ"""
+    end = FROZEN_NOW + timedelta(days=days - 1)
+    return f'{FROZEN_NOW.month}/{FROZEN_NOW.day}-{end.month}/{end.day} "{"メ" * note_len}"'
+
+def measure(func, setup=None, repeat=5):
+    """
+    func の1回あたりの時間（秒、repeat 回の中央値）
+    setup があれば毎回 setup() の戻り値を渡して1回だけ計る（stateを変える処理用）
+    """
+    if setup is None:
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        return statistics.median(timer.repeat(repeat, number)) / number
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        started = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+def calibration_workload():
+    """マシンの速さを計るための決まった処理（辞書・文字列・ソート）"""
+    table = {f"U{i:08d}": i * 7 % 1000 for i in range(2000)}
+    return sorted((value, key.lower()) for key, value in table.items() if value % 3)
+
+def calibrate(repeat):
+    """calibration_workload の1回あたりの時間（秒、揺れを抑えるため多めに計った中央値）"""
+    return measure(calibration_workload, repeat=repeat * 3)
+
+def bench_size(users, days, note_len, repeat):
+    """1つのサイズで全てのベンチマークを計り {名前: 秒} を返す"""
+    state = make_state(users, days, note_len)
+    schedules = state["schedules"]
+    schedules.freeze()
+    directory = tempfile.mkdtemp()
+    results = {}
+
+    results["render_board_range(70)"] = measure(lambda: app.render_board_range(schedules, 70), repeat=repeat)
+    results["render_board_message"] = measure(lambda: app.render_board_message(schedules), repeat=repeat)
+    if app.np is not None:
+        matrix = app.StatusMatrix.build(schedules, app.today_ordinal())
+        results["render_board_range(70) matrix"] = measure(
+            lambda: app.render_board_range(schedules, 70, matrix=matrix), repeat=repeat
+        )
+
+    text = parse_text(days, note_len)
+    def parse_cold():
+        app.parse_token_spans.cache_clear()
+        return app.parse_command_text(text, allow_weekday=True, allow_date=True)
+    results["parse_command_text"] = measure(parse_cold, repeat=repeat)
+
+    tenant = app.Tenant(("bench", f"{users}x{days}x{note_len}"), directory)
+    with tenant.active():
+        results["save_state"] = measure(lambda: app.save_state(state), repeat=repeat)
+        results["load_state"] = measure(lambda: app.load_state(), repeat=repeat)
+
+    def fresh_tenant():
+        # 毎回、昨日までの予定が残っている state.json を書き直して読み込んだテナントで削除する
+        with tenant.active():
+            app.save_state(state)
+        fresh = app.Tenant(tenant.key, directory)
+        fresh.store
+        return fresh
+    def cleanup(fresh):
+        with fresh.active():
+            app.cleanup_old_dates()
+    results["cleanup_old_dates"] = measure(cleanup, setup=fresh_tenant, repeat=repeat)
+    return results
+
+def parse_sizes(text):
+    return [tuple(int(n) for n in size.split("x")) for size in text.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="ユーザー数x日数xメモの文字数 のカンマ区切り")
+    parser.add_argument("--repeat", type=int, default=MIN_REPEAT, help=f"計る回数（{MIN_REPEAT} 回より少なくはしない）")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="結果を baseline に保存する")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="baseline の何倍から遅くなったとみなすか")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="baseline がこれより短いものは判定しない")
+    args = parser.parse_args()
+    args.repeat = max(args.repeat, MIN_REPEAT)
+
+    baseline = {}
+    baseline_calibration = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        baseline_calibration = saved.get("calibration_ms")
+
+    # 計っている間にマシンの混み具合が変わるので、前後で計って速い方を使う
+    calibration = calibrate(args.repeat) * 1000
+    measured = {
+        f"{users}x{days}x{note_len}": bench_size(users, days, note_len, args.repeat)
+        for users, days, note_len in parse_sizes(args.sizes)
+    }
+    calibration = min(calibration, calibrate(args.repeat) * 1000)
+    # baseline を取ったマシンより今のマシンが何倍遅いか
+    speed = calibration / baseline_calibration if baseline_calibration else 1.0
+    print(f"calibration {calibration:.3f}ms" + (f" (baseline {baseline_calibration:.3f}ms, x{speed:.2f})" if baseline_calibration else ""))
+
+    results = {}
+    regressions = []
+    print(f"{'size':<14}{'benchmark':<32}{'ms':>10}{'baseline':>10}{'ratio':>8}")
+    for size, timings in measured.items():
+        results[size] = {}
+        for name, seconds in timings.items():
+            ms = seconds * 1000
+            results[size][name] = round(ms, 4)
+            base = baseline.get(size, {}).get(name)
+            if base:
+                ratio = ms / (base * speed)
+                mark = "  ⚠️" if ratio >= args.tolerance and base >= args.min_ms else ""
+                if mark:
+                    regressions.append(f"{size} {name}")
+                print(f"{size:<14}{name:<32}{ms:>10.3f}{base:>10.3f}{ratio:>7.2f}x{mark}")
+            else:
+                print(f"{size:<14}{name:<32}{ms:>10.3f}{'-':>10}{'-':>8}")
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "numpy": app.np is not None,
+                "storage_backend": app.STORAGE_BACKEND,
+                "calibration_ms": round(calibration, 4),
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"saved {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} regression(s) over {args.tolerance}x: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
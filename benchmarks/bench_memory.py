@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+schedulesのエントリ1万件あたりのメモリと state.json のサイズを比較するベンチマーク
+
+    python benchmarks/bench_memory.py [エントリ数]
+
+以前の形式（日付ごとに {"status", "note"} の辞書）と、Entry（__slots__ + 同じ内容を共有）を比べる
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# app の state.json を読み書きしないよう、空のディレクトリで import する
+os.chdir(tempfile.mkdtemp())
+# Slackにつながずに import する（トークンはダミーでよい）
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+
+from datetime import date, timedelta
+
+from app import Entry, pack_state
+
+STATUSES = ["in", "out", "pm", "home", "maybe", "trip", "will", "can"]
+NOTES = ["", "", "", "出張", "午後から", "リモート", "通院のため"]
+
+def make_commands(total, seed=0):
+    """コマンド1回分 (user, [date_key...], status, note) を total エントリ分つくる"""
+    rng = random.Random(seed)
+    start = date(2026, 1, 1)
+    commands = []
+    count = 0
+    while count < total:
+        user = f"U{rng.randrange(max(total // 50, 1)):08d}"
+        first = rng.randrange(60)
+        length = rng.choice([1, 1, 1, 5, 7, 31])
+        date_keys = [(start + timedelta(days=first + i)).isoformat() for i in range(length)][: total - count]
+        commands.append((user, date_keys, rng.choice(STATUSES), rng.choice(NOTES)))
+        count += len(date_keys)
+    return commands
+
+def build_dicts(commands):
+    # 以前の set_status_for_dates と同じく、日付ごとに新しい辞書を作る
+    schedules = {}
+    for user, date_keys, status, note in commands:
+        info = {"status": status, "note": note}
+        for date_key in date_keys:
+            schedules.setdefault(user, {})[date_key] = dict(info)
+    return schedules
+
+def build_entries(commands):
+    schedules = {}
+    for user, date_keys, status, note in commands:
+        info = Entry.of(status, note)
+        for date_key in date_keys:
+            schedules.setdefault(user, {})[date_key] = info
+    return schedules
+
+def traced(build, commands):
+    tracemalloc.start()
+    result = build(commands)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    commands = make_commands(total)
+    old, old_bytes = traced(build_dicts, commands)
+    new, new_bytes = traced(build_entries, commands)
+    # 同じ日付への上書きがあるので、実際に残ったエントリ数で割る
+    stored = sum(len(dates) for dates in new.values())
+    per = 10000 / stored
+    old_json = len(json.dumps({"schedules": old}, ensure_ascii=False, indent=2).encode("utf-8"))
+    new_json = len(json.dumps(pack_state({"schedules": new}), ensure_ascii=False, indent=2).encode("utf-8"))
+
+    print(f"entries: {stored}  (commands: {len(commands)}, distinct entries: {len(set(Entry.of(s, n) for _, _, s, n in commands))})")
+    print(f"{'':12}{'dict':>12}{'Entry':>12}{'reduction':>12}")
+    print(f"{'memory/10k':12}{old_bytes * per / 1024:>10.0f}KB{new_bytes * per / 1024:>10.0f}KB{1 - new_bytes / old_bytes:>12.0%}")
+    print(f"{'json/10k':12}{old_json * per / 1024:>10.0f}KB{new_json * per / 1024:>10.0f}KB{1 - new_json / old_json:>12.0%}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """
-state.jsonの内容で固定メッセージを即座に更新するスクリプト
+保存済みの状態（state.json / STORAGE_BACKEND=sqlite の場合は state.db）で
+固定メッセージを即座に更新するスクリプト
+MULTI_TENANT=1 のときは `python sync_board.py <team_id> <channel_id>` でボードを指定する
 """
 import os
 import sys
@@ -13,15 +15,17 @@ os.environ.setdefault("SSL_CERT_FILE", certifi.where())
 os.environ.setdefault("REQUESTS_CA_BUNDLE", certifi.where())
 
 # app.pyから必要な関数をインポート
-from app import state, render_board, render_board_week
+from app import store, tenants, MULTI_TENANT, render_board_shards, name_resolver, slack_api
 from slack_sdk import WebClient
 
 def sync_board():
-    """state.jsonの内容でボードメッセージを更新"""
+    """保存済みの状態でボードメッセージを更新"""
     client = WebClient(token=os.environ["SLACK_BOT_TOKEN"])
     
-    ch = state["board_message"]["channel"]
-    ts = state["board_message"]["ts"]
+    # 描画中に状態が変わっても崩れないよう、1つのスナップショットから読む
+    snapshot = store.snapshot()
+    ch = snapshot.board_message["channel"]
+    ts = snapshot.board_message["ts"]
     
     if not (ch and ts):
         print("❌ board_messageが設定されていません")
@@ -32,20 +36,26 @@ def sync_board():
     print(f"   Channel: {ch}")
     print(f"   Timestamp: {ts}")
     
-    # ボードをレンダリング
-    today_board = render_board(state["schedules"])
-    week_board = render_board_week(state["schedules"])
-    text = f"{today_board}\n\n{week_board}"
+    # ボードをレンダリング（シャード分割している場合は全てのメッセージ）
+    shards = render_board_shards(snapshot.schedules, snapshot.board_message, name_resolver(client))
     
     # 更新
     try:
-        client.chat_update(channel=ch, ts=ts, text=text)
-        print("✅ ボードメッセージを更新しました")
+        for shard_ts, text in shards:
+            slack_api(client).chat_update(channel=ch, ts=shard_ts, text=text)
+        print(f"✅ ボードメッセージを更新しました（{len(shards)}通）")
         return True
     except Exception as e:
         print(f"❌ エラー: {e}")
         return False
 
 if __name__ == "__main__":
-    success = sync_board()
+    if MULTI_TENANT:
+        if len(sys.argv) != 3:
+            print("使い方: python sync_board.py <team_id> <channel_id>")
+            sys.exit(1)
+        with tenants.get(sys.argv[1], sys.argv[2]).active():
+            success = sync_board()
+    else:
+        success = sync_board()
     sys.exit(0 if success else 1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+/delete の削除ジョブのテスト（途中で止まったら delete_job.json のカーソルから続きを再開する）
+"""
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Slackにつながずに import する（トークンはダミーでよい）
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+os.chdir(tempfile.mkdtemp(prefix="presence-bot-delete-"))
+
+import app
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+from app import DELETE_JOB_FILE, DeletionJob, SlackGateway, store
+
+PAGE_SIZE = 5
+
+class FakeClient:
+    """conversations.history をカーソルでページ分けして返す。fail_at ページ目を読もうとしたら一度だけ失敗する"""
+
+    def __init__(self, messages, removed, fail_at=None):
+        self.messages = messages  # ts -> user（消したメッセージも残して、ページの区切りを変えない）
+        self.removed = removed  # 消したメッセージのts（再開前後のクライアントで共有する）
+        self.fail_at = fail_at
+        self.cursors = []
+        self.deleted = []
+
+    def auth_test(self):
+        return {"user_id": "UBOT"}
+
+    def conversations_history(self, channel, limit, cursor=None):
+        self.cursors.append(cursor)
+        page = int(cursor or 0)
+        if page == self.fail_at:
+            self.fail_at = None
+            raise ConnectionError("connection reset")
+        history = sorted(self.messages, reverse=True)
+        messages = [{"ts": ts, "user": self.messages[ts]} for ts in history[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]]
+        next_cursor = str(page + 1) if (page + 1) * PAGE_SIZE < len(history) else ""
+        return {"messages": messages, "response_metadata": {"next_cursor": next_cursor}}
+
+    def chat_delete(self, channel, ts):
+        if ts in self.removed:
+            response = SlackResponse(
+                client=None, http_verb="POST", api_url="https://slack.com/api/chat.delete", req_args={},
+                data={"ok": False, "error": "message_not_found"}, headers={}, status_code=200,
+            )
+            raise SlackApiError("message_not_found", response)
+        self.removed.add(ts)
+        self.deleted.append(ts)
+
+    def chat_postEphemeral(self, **kwargs):
+        pass
+
+def run_tests():
+    passed = 0
+    failed = 0
+
+    def check(name, ok, detail=""):
+        nonlocal passed, failed
+        if ok:
+            print(f"  ✅ {name}")
+            passed += 1
+        else:
+            print(f"  ❌ FAIL {name} {detail}")
+            failed += 1
+
+    # レート制限で待たないよう、トークンバケットなしのゲートウェイを使う
+    app.slack_gateway = SlackGateway(limits={}, max_retries=0)
+    messages = {f"{1000 + i}.0": ("UBOT" if i % 3 else "U01") for i in range(20)}
+    bot_messages = sorted(ts for ts, user in messages.items() if user == "UBOT")
+
+    print("=" * 60)
+    print("途中で止まった削除の再開")
+    print("=" * 60)
+    store.set_board_message("C1", "1000.0")
+    removed = set()
+    client = FakeClient(messages, removed, fail_at=2)
+    job = DeletionJob(client, "C1", "UADMIN")
+    try:
+        job.run()
+        check("3ページ目の取得で止まる", False, "例外が出ない")
+    except ConnectionError:
+        check("3ページ目の取得で止まる", True)
+    saved = store.delete_job()
+    check("delete_job.json に進捗が残る", os.path.exists(DELETE_JOB_FILE) and saved is not None, saved)
+    # 1ページ目は削除を確かめてカーソルを進めた。2ページ目は削除中に止まったのでカーソルは進めない
+    check("カーソルは削除を確かめたページの次", saved["cursor"] == "1", saved)
+    check("止まったページで削除できた分も数える", saved["deleted"] == len(client.deleted) and saved["deleted"] > 0,
+          (saved, len(client.deleted)))
+
+    resumed_client = FakeClient(messages, removed)
+    resumed = DeletionJob.from_dict(resumed_client, saved)
+    deleted = resumed.run()
+    check("保存したカーソルから読み始める", resumed_client.cursors[0] == "1", resumed_client.cursors)
+    check("前に消したメッセージは数え直さない", not set(client.deleted) & set(resumed_client.deleted))
+    check("ボットのメッセージが全て消える", sorted(removed) == bot_messages)
+    check("他のユーザーのメッセージは消さない",
+          all(messages[ts] == "UBOT" for ts in client.deleted + resumed_client.deleted))
+    check("件数は再開前からの通算", deleted == len(bot_messages), deleted)
+    check("終わったら delete_job.json を消す", not os.path.exists(DELETE_JOB_FILE) and store.delete_job() is None)
+    check("ボードのメッセージの記録も消す", store.snapshot().board_message["channel"] is None)
+
+    print("=" * 60)
+    print(f"✅ {passed} passed, ❌ {failed} failed")
+    print("=" * 60)
+    return failed == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Slack API ゲートウェイのテスト（429 と Retry-After での再試行、トークンバケットの補充）
+"""
+import asyncio
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Slackにつながずに import する（トークンはダミーでよい）
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web import SlackResponse
+
+from app import SlackGateway, TokenBucket
+
+def slack_error(status, error, headers=None):
+    response = SlackResponse(
+        client=None, http_verb="POST", api_url="https://slack.com/api/chat.update", req_args={},
+        data={"ok": False, "error": error}, headers=headers or {}, status_code=status,
+    )
+    return SlackApiError(error, response)
+
+class FakeClient:
+    """先に errors を順に送出し、尽きたら成功する chat_update"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def chat_update(self, **kwargs):
+        self.calls.append(time.monotonic())
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"ok": True}
+
+class FakeAsyncClient(FakeClient):
+    async def chat_update(self, **kwargs):
+        return FakeClient.chat_update(self, **kwargs)
+
+def run_tests():
+    passed = 0
+    failed = 0
+
+    def check(name, ok, detail=""):
+        nonlocal passed, failed
+        if ok:
+            print(f"  ✅ {name}")
+            passed += 1
+        else:
+            print(f"  ❌ FAIL {name} {detail}")
+            failed += 1
+
+    print("=" * 60)
+    print("429 と Retry-After")
+    print("=" * 60)
+    gateway = SlackGateway(limits={"chat_update": 600}, max_retries=3)
+    client = FakeClient([slack_error(429, "ratelimited", {"retry-after": "0.5"})])
+    result = gateway.call(client, "chat_update", channel="C1", ts="1.0", text="x")
+    stats = gateway.stats()["chat_update"]
+    check("再試行して成功する", result == {"ok": True} and len(client.calls) == 2, client.calls)
+    check("Retry-After（小文字のヘッダー）の間は呼ばない", client.calls[1] - client.calls[0] >= 0.5,
+          client.calls[1] - client.calls[0])
+    check("throttled / retried を数える", stats["throttled"] == 1 and stats["retried"] == 1 and stats["calls"] == 2, stats)
+
+    gateway = SlackGateway(limits={"chat_update": 6000}, max_retries=2)
+    client = FakeClient([slack_error(429, "ratelimited", {"Retry-After": "0"}) for _ in range(3)])
+    try:
+        gateway.call(client, "chat_update", channel="C1", ts="1.0", text="x")
+        check("max_retries 回やり直したら諦める", False, "例外が出ない")
+    except SlackApiError:
+        check("max_retries 回やり直したら諦める", len(client.calls) == 3 and gateway.stats()["chat_update"]["failed"] == 1,
+              gateway.stats())
+
+    client = FakeClient([slack_error(400, "invalid_auth")])
+    try:
+        gateway.call(client, "chat_update", channel="C1", ts="1.0", text="x")
+        check("429 以外のAPIエラーは再試行しない", False, "例外が出ない")
+    except SlackApiError:
+        check("429 以外のAPIエラーは再試行しない", len(client.calls) == 1)
+
+    gateway = SlackGateway(limits={"chat_update": 600}, max_retries=3)
+    client = FakeAsyncClient([slack_error(429, "ratelimited", {"Retry-After": "0.3"})])
+    result = asyncio.run(gateway.call_async(client, "chat_update", channel="C1", ts="1.0", text="x"))
+    check("asyncio版も Retry-After を待って再試行する",
+          result == {"ok": True} and client.calls[1] - client.calls[0] >= 0.3, client.calls)
+
+    print("=" * 60)
+    print("トークンバケット")
+    print("=" * 60)
+    bucket = TokenBucket(per_minute=600, burst=2)  # 1秒に10個、2個までためられる
+    waits = [bucket.reserve() for _ in range(3)]
+    check("burst 個までは待たない", waits[:2] == [0.0, 0.0], waits)
+    check("使い切ったら補充されるまで待つ", 0.05 < waits[2] <= 0.1, waits)
+    time.sleep(0.35)
+    check("時間が経つと補充される", bucket.reserve() == 0.0)
+    check("補充は capacity で頭打ち", bucket.reserve() == 0.0 and bucket.reserve() > 0)
+    bucket = TokenBucket(per_minute=600, burst=2)
+    bucket.pause(1.0)
+    wait = bucket.reserve()
+    check("pause した秒数はトークンを出さない", 1.0 <= wait <= 1.15, wait)
+
+    print("=" * 60)
+    print(f"✅ {passed} passed, ❌ {failed} failed")
+    print("=" * 60)
+    return failed == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+ジャーナルのリプレイのテスト（追記途中でクラッシュした末尾行と、その後の追記・再起動）
+"""
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# ジャーナルモードで、Slackにつながずに import する（トークンはダミーでよい）
+os.environ["JOURNAL_MODE"] = "1"
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+os.chdir(tempfile.mkdtemp(prefix="presence-bot-journal-"))
+
+from app import JOURNAL_FILE, append_journal, load_json_state, save_state
+
+def set_record(user, date_key):
+    return {"op": "set", "user": user, "dates": [date_key], "status": "in", "note": ""}
+
+def restart():
+    """再起動したときと同じように state.json + state.journal から読み直す"""
+    return load_json_state()
+
+def run_tests():
+    passed = 0
+    failed = 0
+
+    def check(name, ok, detail=""):
+        nonlocal passed, failed
+        if ok:
+            print(f"  ✅ {name}")
+            passed += 1
+        else:
+            print(f"  ❌ FAIL {name} {detail}")
+            failed += 1
+
+    print("=" * 60)
+    print("末尾の壊れた行のあとに追記して再起動")
+    print("=" * 60)
+    # U01 は畳み込み済み、U02 は書いている途中でクラッシュした（リプレイするものは壊れた行だけ）
+    save_state(restart())
+    append_journal(set_record("U01", "2030-01-01"))
+    save_state(restart())
+    with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write('{"op":"set","user":"U02","da')
+
+    data = restart()
+    check("畳み込み済みのレコードは残る", "U01" in data["schedules"], sorted(data["schedules"]))
+    with open(JOURNAL_FILE, encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    check("壊れた行は切り詰められる", lines[-1] == "" and all(line.endswith("}") for line in lines[:-1]), lines)
+
+    append_journal(set_record("U03", "2030-01-02"))
+    data = restart()
+    check("再起動後の追記は失われない", "U03" in data["schedules"], sorted(data["schedules"]))
+    check("壊れた行のレコードは適用されない", "U02" not in data["schedules"], sorted(data["schedules"]))
+
+    print("=" * 60)
+    print("改行を書く前に止まった末尾行")
+    print("=" * 60)
+    save_state(data)
+    with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write('{"op":"set","user":"U04","dates":["2030-01-03"],"status":"in","note":"","seq":%d}' % (data["journal_seq"] + 1))
+    data = restart()
+    append_journal(set_record("U05", "2030-01-04"))
+    data = restart()
+    check("改行のない末尾行と次の追記が両方残る", {"U04", "U05"} <= set(data["schedules"]), sorted(data["schedules"]))
+
+    print("=" * 60)
+    print(f"✅ {passed} passed, ❌ {failed} failed")
+    print("=" * 60)
+    return failed == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
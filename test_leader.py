@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+リーダー選出のテスト（リースの取得・延長・期限切れでの引き継ぎ・手放しと、リーダーへのボード更新の依頼）
+"""
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Slackにつながずに import する（トークンはダミーでよい）
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+os.chdir(tempfile.mkdtemp(prefix="presence-bot-leader-"))
+
+from app import LEADER_FILE, BoardRequests, LeaderLease, tenants
+
+TTL = 0.5
+
+def run_tests():
+    passed = 0
+    failed = 0
+
+    def check(name, ok, detail=""):
+        nonlocal passed, failed
+        if ok:
+            print(f"  ✅ {name}")
+            passed += 1
+        else:
+            print(f"  ❌ FAIL {name} {detail}")
+            failed += 1
+
+    first = LeaderLease(LEADER_FILE, ttl=TTL, holder="first")
+    second = LeaderLease(LEADER_FILE, ttl=TTL, holder="second")
+
+    print("=" * 60)
+    print("取得と延長")
+    print("=" * 60)
+    check("空いているリースは取れる", first.try_acquire() and first.is_leader)
+    check("他のプロセスが持っている間は取れない", not second.try_acquire() and not second.is_leader)
+    for _ in range(3):
+        time.sleep(TTL / 2)
+        renewed = first.try_acquire()
+    check("ttl 以内に延長し続ければリーダーのまま", renewed and first.is_leader)
+    check("延長している間は他のプロセスは取れない", not second.try_acquire())
+
+    print("=" * 60)
+    print("期限切れと引き継ぎ")
+    print("=" * 60)
+    time.sleep(TTL + 0.1)
+    check("延長しなければ自分から降りる", not first.is_leader)
+    check("期限が切れたら他のプロセスが引き継ぐ", second.try_acquire() and second.is_leader)
+    check("引き継がれたら前のリーダーは取り戻せない", not first.try_acquire() and not first.is_leader)
+
+    print("=" * 60)
+    print("手放し")
+    print("=" * 60)
+    second.release()
+    check("手放したら自分はリーダーでない", not second.is_leader)
+    check("手放したら期限を待たずに取れる", first.try_acquire() and first.is_leader)
+    check("手放したのが自分でなければリースは残る", (second.release(), first.try_acquire())[1])
+
+    print("=" * 60)
+    print("リーダーへのボード更新の依頼")
+    print("=" * 60)
+    follower = BoardRequests(LEADER_FILE)
+    leader = BoardRequests(LEADER_FILE)
+    check("依頼がなければ空", leader.drain() == {})
+    channel = tenants.get("T1", "C1")
+    follower.add(channel)
+    follower.add(channel, force=True)
+    follower.add(tenants.default)
+    follower.add(tenants.default)
+    requested = leader.drain()
+    check("同じテナントの依頼は1つにまとまり、/update の強制は残る",
+          requested == {channel: True, tenants.default: False}, requested)
+    check("取り出した依頼は消える", leader.drain() == {})
+
+    print("=" * 60)
+    print(f"✅ {passed} passed, ❌ {failed} failed")
+    print("=" * 60)
+    return failed == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+SQLiteバックエンドのテスト（state.json からの移行と、revision による楽観的排他）
+"""
+import json
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# SQLiteバックエンドで、Slackにつながずに import する（トークンはダミーでよい）
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+os.chdir(tempfile.mkdtemp(prefix="presence-bot-sqlite-"))
+
+from app import DATA_FILE, SQLITE_FILE, SqliteSchedules, StaleStateError, load_sqlite_state
+
+SCHEDULES = {
+    "U01": {"2030-01-01": {"status": "in", "note": "会議"}, "2030-01-02": {"status": "home", "note": ""}},
+    "U02": {"2030-01-01": {"status": "out", "note": ""}},
+}
+
+def set_record(user, date_key, status="in"):
+    return {"op": "set", "user": user, "dates": [date_key], "status": status, "note": ""}
+
+def run_tests():
+    passed = 0
+    failed = 0
+
+    def check(name, ok, detail=""):
+        nonlocal passed, failed
+        if ok:
+            print(f"  ✅ {name}")
+            passed += 1
+        else:
+            print(f"  ❌ FAIL {name} {detail}")
+            failed += 1
+
+    print("=" * 60)
+    print("state.json からの移行")
+    print("=" * 60)
+    with open(DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump({"schedules": SCHEDULES, "board_message": {"channel": "C1", "ts": "1.0"}, "key_format": "user_id"}, f)
+    data = load_sqlite_state()
+    schedules = data["schedules"]
+    check("state.db が作られる", os.path.exists(SQLITE_FILE))
+    check("schedules が移行される", dict(schedules.items()) == SCHEDULES, dict(schedules.items()))
+    check("board_message などは meta に移行される",
+          data["board_message"] == {"channel": "C1", "ts": "1.0"} and data["key_format"] == "user_id", data)
+    check("インデックスを使う問い合わせも同じ内容",
+          schedules.entries_on("2030-01-01") == {"U01": SCHEDULES["U01"]["2030-01-01"], "U02": SCHEDULES["U02"]["2030-01-01"]})
+
+    os.remove(DATA_FILE)
+    again = load_sqlite_state()
+    check("2回目は state.db から読む（state.json がなくてもよい）",
+          dict(again["schedules"].items()) == SCHEDULES and again["board_message"]["ts"] == "1.0")
+
+    print("=" * 60)
+    print("revision による楽観的排他")
+    print("=" * 60)
+    first = SqliteSchedules(SQLITE_FILE)
+    second = SqliteSchedules(SQLITE_FILE)
+    first.load_meta()
+    second.load_meta()
+    check("先に書いた方は通る", first.apply(set_record("U03", "2030-01-03")) == 1)
+    try:
+        second.apply(set_record("U04", "2030-01-03"))
+        check("古い revision で書くと StaleStateError", False, "例外が出ない")
+    except StaleStateError:
+        check("古い revision で書くと StaleStateError", True)
+    check("失敗した書き込みは残らない", "U04" not in first and "U03" in first, first.keys())
+    try:
+        second.save_meta({"board_message": {"channel": None, "ts": None}})
+        check("meta の書き込みも StaleStateError", False, "例外が出ない")
+    except StaleStateError:
+        check("meta の書き込みも StaleStateError", True)
+    check("meta は上書きされない", first.load_meta()["board_message"]["ts"] == "1.0")
+
+    second.load_meta()
+    check("読み直せば書ける", second.apply(set_record("U04", "2030-01-03")) == 1 and "U04" in first)
+    check("revision は書き込みごとに1つ進む", first.latest_revision() == second.revision, (first.latest_revision(), second.revision))
+    check("予定を変えない書き込みは revision を進めない",
+          second.apply({"op": "clear", "user": "U99"}) == 0 and first.latest_revision() == second.revision)
+
+    print("=" * 60)
+    print(f"✅ {passed} passed, ❌ {failed} failed")
+    print("=" * 60)
+    return failed == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Timeline のテスト（ランダムな操作を普通の dict と同じように行い、内容と order の昇順が保たれるかを見る）
+"""
+import os
+import random
+import sys
+sys.path.insert(0, '.')
+# Slackにつながずに import する（トークンはダミーでよい）
+os.environ["SLACK_OFFLINE"] = "1"
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-offline")
+
+from app import Timeline
+
+KEYS = [f"2026-01-{day:02d}" for day in range(1, 32)]
+
+def random_operation(rng, timeline, expected):
+    """同じ操作を timeline と expected（dict）に行い、操作の名前と両方の戻り値を返す"""
+    key = rng.choice(KEYS)
+    value = rng.randrange(100)
+    name = rng.choice([
+        "set", "del", "pop", "pop_default", "popitem", "setdefault", "update", "ior",
+        "clear", "pop_between", "pop_before",
+    ])
+    if name == "set":
+        timeline[key] = value
+        expected[key] = value
+        return name, None, None
+    if name == "del":
+        if key not in expected:
+            return name, None, None
+        del timeline[key]
+        del expected[key]
+        return name, None, None
+    if name == "pop":
+        if key not in expected:
+            return name, None, None
+        return name, timeline.pop(key), expected.pop(key)
+    if name == "pop_default":
+        return name, timeline.pop(key, -1), expected.pop(key, -1)
+    if name == "popitem":
+        if not expected:
+            return name, None, None
+        popped = timeline.popitem()
+        return name, popped, (popped[0], expected.pop(popped[0]))
+    if name == "setdefault":
+        return name, timeline.setdefault(key, value), expected.setdefault(key, value)
+    if name == "update":
+        items = {rng.choice(KEYS): rng.randrange(100) for _ in range(3)}
+        timeline.update(items, extra=value)
+        expected.update(items, extra=value)
+        return name, None, None
+    if name == "ior":
+        items = {rng.choice(KEYS): rng.randrange(100) for _ in range(3)}
+        timeline |= items
+        expected |= items
+        return name, None, None
+    if name == "clear":
+        if rng.random() < 0.8:
+            return name, None, None  # 消してばかりだと中身が育たないので、たまにだけ
+        timeline.clear()
+        expected.clear()
+        return name, None, None
+    start, end = sorted(rng.sample(KEYS, 2))
+    if name == "pop_between":
+        result = timeline.pop_between(start, end)
+        want = [(k, expected.pop(k)) for k in sorted(expected) if start <= k <= end]
+        return name, result, want
+    result = timeline.pop_before(key)
+    want = [(k, expected.pop(k)) for k in sorted(expected) if k < key]
+    return name, result, want
+
+def run_tests(rounds=200, steps=100):
+    passed = 0
+    failed = 0
+    for seed in range(rounds):
+        rng = random.Random(seed)
+        initial = {rng.choice(KEYS): rng.randrange(100) for _ in range(10)}
+        timeline = Timeline(initial)
+        expected = dict(initial)
+        for step in range(steps):
+            name, got, want = random_operation(rng, timeline, expected)
+            problem = None
+            if got != want:
+                problem = f"戻り値 {got!r} != {want!r}"
+            elif dict(timeline) != expected:
+                problem = "内容が dict と違う"
+            elif timeline.order != sorted(expected):
+                problem = f"order が昇順のキーと違う: {timeline.order}"
+            elif timeline.copy().order != timeline.order:
+                problem = "copy() の order が違う"
+            if problem:
+                print(f"  ❌ FAIL seed={seed} step={step} {name}: {problem}")
+                failed += 1
+                break
+        else:
+            passed += 1
+
+    print("=" * 60)
+    print(f"✅ {passed} passed, ❌ {failed} failed")
+    print("=" * 60)
+    return failed == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if run_tests() else 1)